@@ -0,0 +1,170 @@
+import asyncio
+import time
+from asyncio import StreamReader, StreamWriter
+from concurrent.futures.thread import ThreadPoolExecutor
+from socket import socket
+from threading import Lock
+from typing import Dict, List, Optional, Tuple
+
+from infrastructure.wrappers.infra_logger import Logger
+
+from capacity_gossip import CapacityDirectory
+from config import config
+from connection_pool import ConnectionPool
+from database import Database
+from dataplan_tracker import DataplanTracker
+from protocol_monitor import ProtocolMonitor
+from super_proxy import CLOSING_PACKET, MAX_BACKLOG_CONNECTIONS_PER_COUNTRY, ACCEPTS, TUNNELS_OPENED, TUNNELS_CLOSED, ACTIVE_TUNNELS, \
+    report_remote_capacity
+from super_proxy_plugin import ConnectionInvalid, TunnelPlugins
+from utils.hot_path_logger import HotPathLogger
+from utils.no_available_connection_exception import NoAvailableConnection
+from utils.peer_scores import TunnelSetupTimer
+from utils.utils import reuse_port
+
+ASYNC_SOCKET_READ_SIZE = 64 * 1024
+
+
+class AsyncSuperProxy:
+    """
+    asyncio based alternative to SuperProxy. Exposes the same constructor, API and plugin hooks.
+    Every tunnel is served by two coroutines, one per direction. Each of them awaits drain() on the other side
+    before reading again, so a slow device only stalls its own tunnel.
+    Selected by setting config['proxy_engine'] to 'asyncio'. Doesn't speak the mux protocol, so it can't run with config['mux_enabled'].
+    """
+
+    def __init__(self, country_to_port_configuration: Dict[str, int], pool: ConnectionPool, db: Database, thread_pool_workers=1,
+                 capacity_directory: Optional[CapacityDirectory] = None):
+        self.logger = Logger('AsyncSuperProxy', level=config['log_level'])
+        self.hot_logger = HotPathLogger('AsyncSuperProxy', config['log_level'])
+        self.conn_pool = pool
+        self.capacity_directory = capacity_directory
+        self.thread_pool = ThreadPoolExecutor(max_workers=thread_pool_workers)
+        self.loop = asyncio.new_event_loop()
+        self.mutex = Lock()
+        self.used_peer_sockets: Dict[socket, str] = {}
+        self.plugins = [ProtocolMonitor(db), DataplanTracker(db)]
+        self.servers: List[asyncio.AbstractServer] = []
+        ACTIVE_TUNNELS.set_function(lambda: len(self.used_peer_sockets))
+        for country, port in country_to_port_configuration.items():
+            self.servers.append(self.loop.run_until_complete(self._configure_port(country, port)))
+        self.thread_pool.submit(self.loop.run_forever)
+
+    def get_active_sockets(self) -> List[Tuple[socket, str]]:
+        with self.mutex:
+            return [(k, v) for (k, v) in self.used_peer_sockets.items()]
+
+    def get_buffer_pool_stats(self) -> Dict[str, int]:
+        # asyncio streams allocate their own read buffers.
+        return {}
+
+    def get_accept_stats(self) -> Dict[str, Dict[str, int]]:
+        # asyncio accepts in batches by itself (backlog sized) and doesn't expose counters.
+        return {}
+
+    def get_device_bandwidth(self) -> Dict[str, Dict[str, Dict[str, float]]]:
+        # Bandwidth shaping is enforced by the selectors engine only.
+        return {}
+
+    def shutdown(self):
+        for server in self.servers:
+            self.loop.call_soon_threadsafe(server.close)
+
+    async def _configure_port(self, country_code, port) -> asyncio.AbstractServer:
+        server = await asyncio.start_server(lambda reader, writer: self._accept(reader, writer, country_code),
+                                            '0.0.0.0', port, backlog=config.get('country_port_backlog', MAX_BACKLOG_CONNECTIONS_PER_COUNTRY),
+                                            reuse_address=True,
+                                            reuse_port=reuse_port())
+        self.logger.info(f'Opened port {str(port)} for reaching devices in {country_code}')
+        return server
+
+    async def _accept(self, yogurt_reader: StreamReader, yogurt_writer: StreamWriter, country_code: str):
+        self.logger.info(f'received accept on port: {yogurt_writer.get_extra_info("sockname")[1]} which is configured to cc: {country_code}')
+        ACCEPTS.labels(country_code).inc()
+        try:
+            connection = self.conn_pool.pop_connection_by_country(country_code)
+            if connection.socket is None:
+                raise NoAvailableConnection(country_code)
+        except NoAvailableConnection as e:
+            self.logger.error("NoAvailableConnection: {0}".format(e))
+            report_remote_capacity(self.capacity_directory, country_code, self.hot_logger)
+            yogurt_writer.close()
+            return
+        peer_socket: socket = connection.socket
+        opened = False
+        try:
+            peer_socket.setblocking(False)
+            peer_reader, peer_writer = await asyncio.open_connection(sock=peer_socket, limit=ASYNC_SOCKET_READ_SIZE)
+            opened = True
+        except Exception as e:
+            self.logger.error(f'Failed to open a stream to {connection.device_id}', exc_info=e)
+            return
+        finally:
+            if not opened:
+                # the connection was popped, it must not stay counted as used.
+                peer_socket.close()
+                yogurt_writer.close()
+                self.conn_pool.release(peer_socket)
+        yogurt_socket = yogurt_writer.get_extra_info('socket')
+        with self.mutex:
+            self.used_peer_sockets[peer_socket] = country_code
+        for plugin in self.plugins:
+            plugin.register(yogurt_socket, peer_socket, connection.device_id)
+        tunnel_plugins = TunnelPlugins(self.plugins, yogurt_socket, peer_socket)
+        TUNNELS_OPENED.labels(country_code).inc()
+        setup = TunnelSetupTimer(self.conn_pool.peer_scores, connection.device_id)
+        upload = asyncio.ensure_future(self._pump(yogurt_reader, peer_writer, yogurt_socket, peer_socket, tunnel_plugins, setup, False))
+        download = asyncio.ensure_future(self._pump(peer_reader, yogurt_writer, peer_socket, yogurt_socket, tunnel_plugins, setup, True))
+        await asyncio.wait([upload, download], return_when=asyncio.FIRST_COMPLETED)
+        upload.cancel()
+        download.cancel()
+        for result in await asyncio.gather(upload, download, return_exceptions=True):
+            if isinstance(result, Exception):
+                self.logger.error('tunnel direction failed', exc_info=result)
+        await self._close_tunnel(yogurt_writer, peer_writer, peer_socket, tunnel_plugins)
+
+    async def _pump(self, reader: StreamReader, writer: StreamWriter, source, target, tunnel_plugins: TunnelPlugins,
+                    setup: TunnelSetupTimer, from_peer: bool):
+        try:
+            while True:
+                data = await reader.read(ASYNC_SOCKET_READ_SIZE)
+                if not data:
+                    if from_peer:
+                        setup.peer_failed()
+                    return
+                if not setup.done:
+                    if from_peer:
+                        setup.peer_answered(time.monotonic())
+                    else:
+                        setup.client_sent(time.monotonic())
+                tunnel_plugins.packet_transmitted(source, target, memoryview(data))
+                writer.write(data)
+                await writer.drain()
+        except ConnectionInvalid as e:
+            self.logger.error("Socks socket is in invalid state. {0}".format(e))
+        except ConnectionError as e:
+            if from_peer:
+                setup.peer_failed()
+            self.logger.debug(f'tunnel direction closed: {e!r}')
+        except Exception as e:
+            if from_peer:
+                setup.peer_failed()
+            self.logger.error(f'failed relaying from {source!r}', exc_info=e)
+
+    async def _close_tunnel(self, yogurt_writer: StreamWriter, peer_writer: StreamWriter, peer_socket: socket, tunnel_plugins: TunnelPlugins):
+        try:
+            peer_writer.write(CLOSING_PACKET)
+            await peer_writer.drain()
+        except Exception:
+            # sending a packet might not be possible as the socket might be already closed.
+            pass
+        for writer in (yogurt_writer, peer_writer):
+            writer.close()
+        tunnel_plugins.report_byte_counts()
+        for plugin in self.plugins:
+            plugin.unregister(peer_socket)
+        with self.mutex:
+            country_code = self.used_peer_sockets.pop(peer_socket)
+        self.conn_pool.release(peer_socket)
+        TUNNELS_CLOSED.labels(country_code).inc()
+        self.logger.debug(f'Closed tunnel of {peer_socket!r}')
@@ -0,0 +1,83 @@
+from threading import Lock
+from typing import Dict, Optional
+
+from config import config
+from dataplan_tracker import Collection
+from utils.token_bucket import TokenBucket
+
+DIRECTIONS = (Collection.DIRECTION_DOWNLOAD, Collection.DIRECTION_UPLOAD)
+DEFAULT_BURST_SECONDS = 1
+RATE_WINDOW_SECONDS = 1
+
+
+class DeviceBandwidth:
+    """
+    Token buckets and measured throughput of a single device, shared by all of its tunnels.
+    Directions are named like DataplanTracker's: download is read from the client, upload is read from the device.
+    """
+
+    def __init__(self, device_id: str, limits: Dict[str, int], burst_seconds: float, now: float) -> None:
+        self.device_id = device_id
+        self.limits = limits
+        self.buckets: Dict[str, Optional[TokenBucket]] = {
+            direction: TokenBucket(limits[direction], limits[direction] * burst_seconds, now) if limits.get(direction) else None
+            for direction in DIRECTIONS}
+        self.window_start = now
+        self.window_bytes: Dict[str, int] = {direction: 0 for direction in DIRECTIONS}
+        self.rates: Dict[str, float] = {direction: 0.0 for direction in DIRECTIONS}
+        self.tunnels = 0
+
+    def is_limited(self) -> bool:
+        return any(self.buckets.values())
+
+    def record(self, direction: str, amount: int, now: float):
+        elapsed = now - self.window_start
+        if elapsed >= RATE_WINDOW_SECONDS:
+            for d in DIRECTIONS:
+                self.rates[d] = self.window_bytes[d] / elapsed
+                self.window_bytes[d] = 0
+            self.window_start = now
+        self.window_bytes[direction] += amount
+
+    def as_dict(self, now: float) -> Dict[str, Dict[str, float]]:
+        # A device that stopped sending doesn't roll its window over, so a stale window means it is idle.
+        stale = now - self.window_start >= 2 * RATE_WINDOW_SECONDS
+        return {direction: {'bytes_per_second': 0.0 if stale else self.rates[direction], 'limit': self.limits.get(direction, 0)}
+                for direction in DIRECTIONS}
+
+
+class BandwidthShaper:
+    """
+    Resolves per device bandwidth limits from config['device_bandwidth_limits'] and keeps a DeviceBandwidth for every
+    device with an open tunnel. ASN limits override country limits, which override the default. 0 or missing means unlimited.
+    """
+
+    def __init__(self, limits: Optional[dict] = None, burst_seconds: Optional[float] = None) -> None:
+        self.limits: dict = limits if limits is not None else config.get('device_bandwidth_limits', {})
+        self.burst_seconds: float = burst_seconds if burst_seconds is not None else \
+            config.get('device_bandwidth_burst_seconds', DEFAULT_BURST_SECONDS)
+        self.devices: Dict[str, DeviceBandwidth] = {}
+        self.mutex = Lock()
+
+    def limits_for(self, country_code: str, asn: str) -> Dict[str, int]:
+        return {**self.limits.get('default', {}), **self.limits.get('countries', {}).get(country_code, {}),
+                **self.limits.get('asns', {}).get(str(asn), {})}
+
+    def acquire(self, device_id: str, country_code: str, asn: str, now: float) -> DeviceBandwidth:
+        with self.mutex:
+            device = self.devices.get(device_id)
+            if device is None:
+                device = self.devices[device_id] = DeviceBandwidth(device_id, self.limits_for(country_code, asn), self.burst_seconds, now)
+            device.tunnels += 1
+            return device
+
+    def release(self, device: DeviceBandwidth):
+        with self.mutex:
+            device.tunnels -= 1
+            if not device.tunnels:
+                del self.devices[device.device_id]
+
+    def as_dict(self, now: float) -> Dict[str, Dict[str, Dict[str, float]]]:
+        with self.mutex:
+            devices = list(self.devices.values())
+        return {device.device_id: device.as_dict(now) for device in devices}
@@ -0,0 +1,184 @@
+"""
+Benchmark of the device handshake on the peer port.
+
+PeerServer and ConnectionPool over an InMemoryDatabase run in a child process. The parent connects devices that send
+their handshake and wait for the mux HELLO the server answers with, so every handshake is timed end to end, and measures
+handshakes per second. --silent-devices connect first and never send their handshake, and --db-latency-ms delays every
+DB query, to show whether a stalled device or a slow DB holds up the devices behind it.
+
+    python -m benchmarks.handshake_benchmark --handshakes 5000 --concurrency 64 --silent-devices 8 --output handshakes.json
+"""
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import socket
+import time
+from concurrent.futures.thread import ThreadPoolExecutor
+from typing import Dict, Optional, Tuple
+
+from benchmarks.proxy_benchmark import BENCHMARK_ASN, BENCHMARK_COUNTRY, current_commit, percentile
+from config import config
+from mux_session import MUX_PROTOCOL_VERSION
+
+DEFAULT_PEER_PORT = 19082
+FIRST_IMEI = 350000000000000
+HELLO_READ_SIZE = 64
+
+
+def serve_peer_server(peer_port: int, db_latency_seconds: float, control) -> None:
+    """
+    Child process entry point. Answers 'written' and 'stop' commands on control.
+    """
+    config['log_level'] = logging.WARNING
+    config['worker_processes'] = 1
+    config['mux_enabled'] = True
+    from benchmarks.in_memory_database import InMemoryDatabase
+    from connection_pool import ConnectionPool
+    from data_classes.device_details import DeviceDetails
+    from peer_server import PeerServer
+
+    class SlowDatabase(InMemoryDatabase):
+        def find_one(self, collection: str, query: dict) -> Optional[dict]:
+            time.sleep(db_latency_seconds)
+            return super().find_one(collection, query)
+
+    class BenchmarkPeerServer(PeerServer):
+        # Loopback addresses have no GeoIP data, so every device is placed in BENCHMARK_COUNTRY.
+        def _check_geoip_db(self, geoip_db_list: list):
+            return True
+
+        @staticmethod
+        def _ip_to_cc_asn(ip) -> Tuple[str, str]:
+            return BENCHMARK_COUNTRY, BENCHMARK_ASN
+
+    db = SlowDatabase()
+    peer_server = BenchmarkPeerServer(db, peer_port, ConnectionPool())
+    peer_server.start()
+    control.send('ready')
+    while True:
+        command = control.recv()
+        if command == 'written':
+            control.send(len(db.find(DeviceDetails.COLLECTION_NAME)))
+        elif command == 'stop':
+            control.send('stopped')
+            # ConnectionPool and PeerServer threads are not daemons.
+            os._exit(0)
+
+
+class HandshakeBenchmark:
+    def __init__(self, handshakes: int, concurrency: int, silent_devices: int, db_latency_seconds: float, timeout_seconds: float,
+                 peer_port: int = DEFAULT_PEER_PORT) -> None:
+        self.handshakes = handshakes
+        self.concurrency = concurrency
+        self.silent_devices = silent_devices
+        self.db_latency_seconds = db_latency_seconds
+        self.timeout_seconds = timeout_seconds
+        self.peer_port = peer_port
+        self.control = None
+        self.process = None
+
+    def run(self) -> Dict:
+        self._start_server()
+        silent = []
+        try:
+            silent = [socket.create_connection(('127.0.0.1', self.peer_port)) for _ in range(self.silent_devices)]
+            started = time.perf_counter()
+            with ThreadPoolExecutor(self.concurrency) as executor:
+                results = list(executor.map(self._handshake, range(self.handshakes)))
+            elapsed = time.perf_counter() - started
+            written = self._server_command('written')
+        finally:
+            for sock in silent:
+                sock.close()
+            self._stop_server()
+        latencies = [latency for latency in results if latency is not None]
+        return {
+            'seconds': elapsed,
+            'handshakes': len(latencies),
+            'failed': len(results) - len(latencies),
+            'handshakes_per_second': len(latencies) / elapsed,
+            'handshake_ms': {'p50': percentile(latencies, 0.5) * 1000, 'p99': percentile(latencies, 0.99) * 1000,
+                             'max': max(latencies, default=0) * 1000},
+            'written_to_db_at_end': written,
+        }
+
+    def _handshake(self, index: int) -> Optional[float]:
+        """
+        :return: seconds from connecting to the HELLO, None if the server didn't answer within timeout_seconds.
+        """
+        started = time.perf_counter()
+        try:
+            with socket.create_connection(('127.0.0.1', self.peer_port), timeout=self.timeout_seconds) as sock:
+                sock.sendall(f'{FIRST_IMEI + index},benchmarkfcmid,1,{MUX_PROTOCOL_VERSION}'.encode())
+                if not sock.recv(HELLO_READ_SIZE):
+                    return None
+                return time.perf_counter() - started
+        except OSError:
+            return None
+
+    def _start_server(self):
+        context = multiprocessing.get_context('fork')
+        self.control, child_control = context.Pipe()
+        self.process = context.Process(target=serve_peer_server, args=(self.peer_port, self.db_latency_seconds, child_control),
+                                       daemon=True)
+        self.process.start()
+        if self.control.recv() != 'ready':
+            raise RuntimeError('peer server failed to start')
+        # the listening socket is bound by the server's thread.
+        deadline = time.monotonic() + self.timeout_seconds
+        while True:
+            try:
+                socket.create_connection(('127.0.0.1', self.peer_port)).close()
+                return
+            except ConnectionRefusedError:
+                if time.monotonic() > deadline:
+                    raise
+                time.sleep(0.01)
+
+    def _stop_server(self):
+        try:
+            self._server_command('stop')
+        except (EOFError, OSError):
+            pass
+        self.process.join(5)
+
+    def _server_command(self, command: str):
+        self.control.send(command)
+        return self.control.recv()
+
+
+def parse_args(argv=None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--handshakes', type=int, default=5000)
+    parser.add_argument('--concurrency', type=int, default=64)
+    parser.add_argument('--silent-devices', type=int, default=8)
+    parser.add_argument('--db-latency-ms', type=float, default=2)
+    parser.add_argument('--timeout-seconds', type=float, default=5, help='a handshake not answered in time counts as failed')
+    parser.add_argument('--peer-port', type=int, default=DEFAULT_PEER_PORT)
+    parser.add_argument('--output', default='benchmark_results_handshakes.json')
+    return parser.parse_args(argv)
+
+
+def run_benchmark(args: argparse.Namespace) -> Dict:
+    benchmark = HandshakeBenchmark(args.handshakes, args.concurrency, args.silent_devices, args.db_latency_ms / 1000,
+                                   args.timeout_seconds, args.peer_port)
+    return {
+        'commit': current_commit(),
+        'timestamp': time.time(),
+        'parameters': {key: value for key, value in vars(args).items() if key != 'output'},
+        'results': benchmark.run(),
+    }
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    results = run_benchmark(args)
+    with open(args.output, 'w') as output:
+        json.dump(results, output, indent=2)
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,58 @@
+import itertools
+from collections import defaultdict
+from threading import Lock
+from typing import Dict, List, Optional
+
+from data_classes.device_details import DeviceDetails
+
+
+class InMemoryDatabase:
+    """
+    Stand-in for Database that keeps documents in memory, so the proxy can be benchmarked without a live Mongo.
+    Implements only the subset of the Mongo wrapper the backend uses, with equality queries.
+    """
+
+    def __init__(self) -> None:
+        self.collections: Dict[str, List[dict]] = defaultdict(list)
+        self.ids = itertools.count(1)
+        self.mutex = Lock()
+
+    def create_index(self, *_):
+        pass
+
+    def insert_one(self, collection: str, document) -> bool:
+        document = dict(document if isinstance(document, dict) else vars(document))
+        with self.mutex:
+            document.setdefault(DeviceDetails.ID, next(self.ids))
+            self.collections[collection].append(document)
+        return True
+
+    def insert_many(self, collection: str, documents) -> bool:
+        for document in documents:
+            self.insert_one(collection, document)
+        return True
+
+    def find(self, collection: str, query: Optional[dict] = None) -> List[dict]:
+        with self.mutex:
+            return [document for document in self.collections[collection] if _matches(document, query or {})]
+
+    def find_one(self, collection: str, query: dict) -> Optional[dict]:
+        documents = self.find(collection, query)
+        return documents[0] if documents else None
+
+    def update_one(self, collection: str, document_id, update: dict) -> bool:
+        with self.mutex:
+            for document in self.collections[collection]:
+                if document[DeviceDetails.ID] == document_id:
+                    document.update(update)
+                    return True
+        return False
+
+    def delete_many(self, collection: str, query: dict) -> bool:
+        with self.mutex:
+            self.collections[collection] = [document for document in self.collections[collection] if not _matches(document, query)]
+        return True
+
+
+def _matches(document: dict, query: dict) -> bool:
+    return all(document.get(key) == value for key, value in query.items())
@@ -0,0 +1,169 @@
+"""
+Concurrency stress benchmark of ConnectionPool.
+
+Inserter threads insert connections while popper threads pop them by country, pausing --pop-interval-ms between pops,
+and prober threads probe the pool back to back the way KeepAliveProber does, taking each connection out for --probe-ms.
+--dead-fraction of the connections fail their probe, so probes evict while pops run.
+At the end every connection must have been either popped or evicted exactly once.
+
+    python -m benchmarks.pool_stress --inserters 4 --poppers 8 --connections 100000 --output pool_stress.json
+"""
+import argparse
+import json
+import random
+import threading
+import time
+from collections import Counter
+from typing import Dict, List
+
+from benchmarks.proxy_benchmark import current_commit, percentile
+from connection_pool import ConnectionPool
+from data_classes.connection import Connection
+from utils.no_available_connection_exception import NoAvailableConnection
+
+PROBER_THREADS = 2
+
+
+class StubSocket:
+    """
+    Stands in for a device socket. The pool only closes the sockets it evicts.
+    """
+
+    def __init__(self, index: int, dead: bool, closed: List[int]) -> None:
+        self.index = index
+        self.dead = dead
+        self.closed = closed
+
+    def close(self):
+        self.closed.append(self.index)
+
+
+class PoolStress:
+    def __init__(self, inserters: int, poppers: int, connections: int, countries: int, asns: int, dead_fraction: float,
+                 probe_seconds: float, pop_interval_seconds: float, selection_policy: str = None) -> None:
+        self.pop_interval_seconds = pop_interval_seconds
+        self.inserters = inserters
+        self.poppers = poppers
+        self.countries = [f'C{i}' for i in range(countries)]
+        self.asns = [str(i) for i in range(asns)]
+        self.probe_seconds = probe_seconds
+        # stub sockets can't be watched for hang ups.
+        self.pool = ConnectionPool(selection_policy, passive_liveness=False)
+        # the pool's own prober would only start its first cycle after FULL_KEEP_ALIVE_INTERVAL.
+        self.pool.prober.stop()
+        self.closed: List[int] = []
+        self.sockets = [StubSocket(i, random.random() < dead_fraction, self.closed) for i in range(connections)]
+        self.popped: List[List[Connection]] = [[] for _ in range(poppers)]
+        self.pop_latencies: List[List[float]] = [[] for _ in range(poppers)]
+        self.misses = [0] * poppers
+        self.probes = 0
+        self.done = threading.Event()
+
+    def run(self) -> Dict:
+        threads = [threading.Thread(target=self._insert, args=(self.sockets[i::self.inserters],)) for i in range(self.inserters)]
+        threads += [threading.Thread(target=self._pop, args=(i,)) for i in range(self.poppers)]
+        probers = [threading.Thread(target=self._probe) for _ in range(PROBER_THREADS)]
+        started = time.perf_counter()
+        for thread in threads + probers:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - started
+        self.done.set()
+        for thread in probers:
+            thread.join()
+        return self._results(elapsed)
+
+    def _insert(self, sockets: List[StubSocket]):
+        for sock in sockets:
+            self.pool.insert(Connection(sock, random.choice(self.countries), random.choice(self.asns), str(sock.index)))
+
+    def _pop(self, index: int):
+        popped, latencies = self.popped[index], self.pop_latencies[index]
+        while not self._all_accounted_for():
+            country = random.choice(self.countries)
+            started = time.perf_counter()
+            try:
+                connection = self.pool.pop_connection_by_country(country)
+            except NoAvailableConnection:
+                self.misses[index] += 1
+                time.sleep(0)
+                continue
+            latencies.append(time.perf_counter() - started)
+            popped.append(connection)
+            time.sleep(self.pop_interval_seconds)
+
+    def _all_accounted_for(self) -> bool:
+        popped = sum(len(popped) for popped in self.popped)
+        return popped + len(self.closed) >= len(self.sockets)
+
+    def _probe(self):
+        while not self.done.is_set():
+            for connection in self.pool.available_connections:
+                idle_since = self.pool.take_for_probe(connection)
+                if idle_since is None:
+                    continue
+                time.sleep(self.probe_seconds)
+                self.pool.probe_finished(connection, idle_since, not connection.socket.dead)
+                self.probes += 1
+                if self.done.is_set():
+                    return
+            time.sleep(0.001)
+
+    def _results(self, elapsed: float) -> Dict:
+        popped = Counter(connection.socket.index for popped in self.popped for connection in popped)
+        evicted = set(self.closed)
+        latencies = [latency for thread_latencies in self.pop_latencies for latency in thread_latencies]
+        return {
+            'seconds': elapsed,
+            'pops': len(latencies),
+            'pops_per_second': len(latencies) / elapsed,
+            'misses': sum(self.misses),
+            'evicted': len(evicted),
+            'evicted_twice': len(self.closed) - len(evicted),
+            'probes': self.probes,
+            'lost': len(self.sockets) - len(set(popped) | evicted),
+            'handed_out_twice': sum(1 for count in popped.values() if count > 1),
+            'popped_and_evicted': len(set(popped) & evicted),
+            'left_in_pool': len(self.pool),
+            'pop_latency_us': {'p50': percentile(latencies, 0.5) * 1e6, 'p99': percentile(latencies, 0.99) * 1e6,
+                               'max': max(latencies, default=0) * 1e6},
+        }
+
+
+def parse_args(argv=None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--inserters', type=int, default=4)
+    parser.add_argument('--poppers', type=int, default=8)
+    parser.add_argument('--connections', type=int, default=100000)
+    parser.add_argument('--countries', type=int, default=8)
+    parser.add_argument('--asns', type=int, default=16)
+    parser.add_argument('--dead-fraction', type=float, default=0.05)
+    parser.add_argument('--probe-ms', type=float, default=1)
+    parser.add_argument('--pop-interval-ms', type=float, default=0.5)
+    parser.add_argument('--selection-policy', default=None, choices=['round_robin', 'weighted_random', 'fifo', 'lowest_rtt'])
+    parser.add_argument('--output', default='benchmark_results_pool_stress.json')
+    return parser.parse_args(argv)
+
+
+def run_stress(args: argparse.Namespace) -> Dict:
+    stress = PoolStress(args.inserters, args.poppers, args.connections, args.countries, args.asns, args.dead_fraction,
+                        args.probe_ms / 1000, args.pop_interval_ms / 1000, args.selection_policy)
+    return {
+        'commit': current_commit(),
+        'timestamp': time.time(),
+        'parameters': {key: value for key, value in vars(args).items() if key != 'output'},
+        'results': stress.run(),
+    }
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    results = run_stress(args)
+    with open(args.output, 'w') as output:
+        json.dump(results, output, indent=2)
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
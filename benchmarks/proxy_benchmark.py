@@ -0,0 +1,409 @@
+"""
+End to end benchmark of the proxy on loopback.
+
+The proxy (SuperProxy or AsyncSuperProxy, PeerServer and ConnectionPool over an InMemoryDatabase) runs in a child process,
+so its CPU time can be measured on its own. The parent simulates devices that connect to the peer port and answer like
+the app's SOCKS server, and clients that tunnel through a country port.
+
+    python -m benchmarks.proxy_benchmark --engine selectors --devices 16 --clients 64 --output selectors.json
+    python -m benchmarks.proxy_benchmark --compare selectors.json asyncio.json
+"""
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import socket
+import struct
+import subprocess
+import threading
+import time
+from concurrent.futures.thread import ThreadPoolExecutor
+from typing import Dict, List, Optional, Tuple
+
+from config import config
+
+BENCHMARK_COUNTRY = 'BM'
+BENCHMARK_ASN = '0'
+DEFAULT_COUNTRY_PORT = 19080
+DEFAULT_PEER_PORT = 19081
+# command, payload length
+COMMAND_HEADER = struct.Struct('!4sQ')
+COMMAND_BULK = b'BULK'
+COMMAND_SINK = b'SINK'
+COMMAND_ECHO = b'ECHO'
+SINK_ACK = b'K'
+CHUNK_SIZE = 256 * 1024
+SOCKS_GREETING = b'\x05\x01\x00'
+SOCKS_METHOD_SELECTED = b'\x05\x00'
+TARGET = socket.inet_aton('1.2.3.4') + (443).to_bytes(2, 'big')
+SOCKS_CONNECT = b'\x05\x01\x00\x01' + TARGET
+SOCKS_CONNECTED = b'\x05\x00\x00\x01' + TARGET
+KEEP_ALIVE = b'KEAL'
+DEVICE_READY_TIMEOUT_SECONDS = 30
+OPEN_TUNNEL_ATTEMPTS = 200
+RETRY_SLEEP_SECONDS = 0.005
+MB = 1024 * 1024
+GB = 1024 * MB
+
+
+def recv_exact(sock: socket.socket, size: int) -> bytes:
+    data = bytearray()
+    while len(data) < size:
+        chunk = sock.recv(min(size - len(data), CHUNK_SIZE))
+        if not chunk:
+            raise ConnectionError(f'connection closed after {len(data)} of {size} bytes')
+        data += chunk
+    return bytes(data)
+
+
+def percentile(values: List[float], fraction: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def serve_proxy(engine: str, country_port: int, peer_port: int, control) -> None:
+    """
+    Child process entry point. Answers 'cpu', 'devices' and 'stop' commands on control.
+    """
+    config['service_whitelist_enabled'] = False
+    config['log_level'] = logging.WARNING
+    config['worker_processes'] = 1
+    from benchmarks.in_memory_database import InMemoryDatabase
+    from connection_pool import ConnectionPool
+    from main import PROXY_ENGINES
+    from peer_server import PeerServer
+
+    class BenchmarkPeerServer(PeerServer):
+        # Loopback addresses have no GeoIP data, so every device is placed in BENCHMARK_COUNTRY.
+        def _check_geoip_db(self, geoip_db_list: list):
+            return True
+
+        @staticmethod
+        def _ip_to_cc_asn(ip) -> Tuple[str, str]:
+            return BENCHMARK_COUNTRY, BENCHMARK_ASN
+
+    db = InMemoryDatabase()
+    pool = ConnectionPool()
+    peer_server = BenchmarkPeerServer(db, peer_port, pool)
+    peer_server.start()
+    PROXY_ENGINES[engine]({BENCHMARK_COUNTRY: country_port}, pool, db)
+    control.send('ready')
+    while True:
+        command = control.recv()
+        if command == 'cpu':
+            control.send(time.process_time())
+        elif command == 'devices':
+            control.send(len(pool))
+        elif command == 'stop':
+            control.send('stopped')
+            # ConnectionPool and PeerServer threads are not daemons.
+            os._exit(0)
+
+
+class SimulatedDevice(threading.Thread):
+    """
+    Connects to the peer port, serves one tunnel the way the app does and reconnects once the tunnel closes.
+    Inside a tunnel it answers the SOCKS handshake and then the benchmark commands:
+    BULK n - send n bytes. SINK n - read n bytes and acknowledge. ECHO - echo everything until the tunnel closes.
+    """
+
+    def __init__(self, index: int, peer_port: int, stop: threading.Event) -> None:
+        super().__init__(name=f'device-{index}', daemon=True)
+        self.imei = f'{350000000000000 + index}'
+        self.peer_port = peer_port
+        self.stop = stop
+        self.payload = bytes(CHUNK_SIZE)
+
+    def run(self):
+        while not self.stop.is_set():
+            try:
+                with socket.create_connection(('127.0.0.1', self.peer_port)) as sock:
+                    sock.sendall(f'{self.imei},benchmarkfcmid,1'.encode())
+                    self._serve_tunnel(sock)
+            except OSError:
+                time.sleep(RETRY_SLEEP_SECONDS)
+
+    def _serve_tunnel(self, sock: socket.socket):
+        while True:
+            greeting = sock.recv(len(SOCKS_GREETING))
+            if greeting != KEEP_ALIVE[:len(greeting)] or not greeting:
+                break
+            sock.sendall(greeting + recv_exact(sock, len(KEEP_ALIVE) - len(greeting)))
+        if greeting != SOCKS_GREETING:
+            return
+        sock.sendall(SOCKS_METHOD_SELECTED)
+        recv_exact(sock, len(SOCKS_CONNECT))
+        sock.sendall(SOCKS_CONNECTED)
+        while True:
+            command, size = COMMAND_HEADER.unpack(recv_exact(sock, COMMAND_HEADER.size))
+            if command == COMMAND_BULK:
+                self._send_bulk(sock, size)
+            elif command == COMMAND_SINK:
+                self._sink(sock, size)
+            elif command == COMMAND_ECHO:
+                self._echo(sock)
+                return
+            else:
+                # SuperProxy's closing packet, or garbage.
+                return
+
+    def _send_bulk(self, sock: socket.socket, size: int):
+        view = memoryview(self.payload)
+        while size:
+            sent = sock.send(view[:min(size, CHUNK_SIZE)])
+            size -= sent
+
+    @staticmethod
+    def _sink(sock: socket.socket, size: int):
+        while size:
+            chunk = sock.recv(min(size, CHUNK_SIZE))
+            if not chunk:
+                raise ConnectionError('tunnel closed while sinking')
+            size -= len(chunk)
+        sock.sendall(SINK_ACK)
+
+    @staticmethod
+    def _echo(sock: socket.socket):
+        while True:
+            data = sock.recv(CHUNK_SIZE)
+            if not data:
+                return
+            sock.sendall(data)
+
+
+class ProxyBenchmark:
+    def __init__(self, engine: str, devices: int, clients: int, bulk_mb: int, rr_seconds: float, message_size: int,
+                 country_port: int = DEFAULT_COUNTRY_PORT, peer_port: int = DEFAULT_PEER_PORT) -> None:
+        self.engine = engine
+        self.devices = devices
+        self.clients = clients
+        self.bulk_bytes = bulk_mb * MB
+        self.rr_seconds = rr_seconds
+        self.message_size = message_size
+        self.country_port = country_port
+        self.peer_port = peer_port
+        self.concurrency = min(devices, clients)
+        self.stop = threading.Event()
+        self.setup_retries = 0
+        self.retries_lock = threading.Lock()
+        self.control = None
+        self.process = None
+
+    def run(self) -> Dict:
+        self._start_proxy()
+        try:
+            for index in range(self.devices):
+                SimulatedDevice(index, self.peer_port, self.stop).start()
+            self._wait_for_devices()
+            setup_latencies = self._measure_tunnel_setup()
+            cpu_before = self._proxy_command('cpu')
+            download_seconds = self._measure_bulk(COMMAND_BULK)
+            upload_seconds = self._measure_bulk(COMMAND_SINK)
+            cpu_seconds = self._proxy_command('cpu') - cpu_before
+            round_trips = self._measure_round_trips()
+        finally:
+            self.stop.set()
+            self._stop_proxy()
+        return {
+            'bulk_download_mb_per_second': self.bulk_bytes / MB / download_seconds,
+            'bulk_upload_mb_per_second': self.bulk_bytes / MB / upload_seconds,
+            'cpu_seconds_per_gb': cpu_seconds / (2 * self.bulk_bytes / GB),
+            'tunnel_setup_ms': {'p50': percentile(setup_latencies, 0.5) * 1000, 'p99': percentile(setup_latencies, 0.99) * 1000,
+                                'mean': sum(setup_latencies) / len(setup_latencies) * 1000},
+            'tunnel_setup_retries': self.setup_retries,
+            'round_trips_per_second': round_trips / self.rr_seconds,
+        }
+
+    def _start_proxy(self):
+        context = multiprocessing.get_context('fork')
+        self.control, child_control = context.Pipe()
+        self.process = context.Process(target=serve_proxy, args=(self.engine, self.country_port, self.peer_port, child_control), daemon=True)
+        self.process.start()
+        if self.control.recv() != 'ready':
+            raise RuntimeError('proxy failed to start')
+
+    def _stop_proxy(self):
+        try:
+            self._proxy_command('stop')
+        except (EOFError, OSError):
+            pass
+        self.process.join(5)
+
+    def _proxy_command(self, command: str):
+        self.control.send(command)
+        return self.control.recv()
+
+    def _wait_for_devices(self):
+        deadline = time.monotonic() + DEVICE_READY_TIMEOUT_SECONDS
+        while self._proxy_command('devices') < self.devices:
+            if time.monotonic() > deadline:
+                raise TimeoutError(f'only {self._proxy_command("devices")} of {self.devices} devices connected')
+            time.sleep(0.05)
+
+    def _open_tunnel(self) -> Tuple[socket.socket, float]:
+        """
+        :return: client socket after the SOCKS handshake, and the setup time of the successful attempt.
+        Attempts that found no free device are retried, as devices reconnect after every tunnel.
+        """
+        for _ in range(OPEN_TUNNEL_ATTEMPTS):
+            started = time.perf_counter()
+            sock = socket.create_connection(('127.0.0.1', self.country_port))
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            try:
+                sock.sendall(SOCKS_GREETING)
+                recv_exact(sock, len(SOCKS_METHOD_SELECTED))
+                sock.sendall(SOCKS_CONNECT)
+                recv_exact(sock, len(SOCKS_CONNECTED))
+                return sock, time.perf_counter() - started
+            except OSError:
+                sock.close()
+                with self.retries_lock:
+                    self.setup_retries += 1
+                time.sleep(RETRY_SLEEP_SECONDS)
+        raise TimeoutError('no device became available for a tunnel')
+
+    def _measure_tunnel_setup(self) -> List[float]:
+        def open_and_close(_):
+            sock, latency = self._open_tunnel()
+            sock.close()
+            return latency
+
+        with ThreadPoolExecutor(self.concurrency) as executor:
+            return list(executor.map(open_and_close, range(self.clients)))
+
+    def _measure_bulk(self, command: bytes) -> float:
+        share = self.bulk_bytes // self.concurrency
+        tunnels = [self._open_tunnel()[0] for _ in range(self.concurrency)]
+        barrier = threading.Barrier(self.concurrency + 1)
+
+        def transfer(sock: socket.socket):
+            barrier.wait()
+            sock.sendall(COMMAND_HEADER.pack(command, share))
+            if command == COMMAND_BULK:
+                recv_exact_discard(sock, share)
+            else:
+                payload = memoryview(bytes(CHUNK_SIZE))
+                remaining = share
+                while remaining:
+                    remaining -= sock.send(payload[:min(remaining, CHUNK_SIZE)])
+                recv_exact(sock, len(SINK_ACK))
+
+        with ThreadPoolExecutor(self.concurrency) as executor:
+            futures = [executor.submit(transfer, sock) for sock in tunnels]
+            barrier.wait()
+            started = time.perf_counter()
+            for future in futures:
+                future.result()
+            elapsed = time.perf_counter() - started
+        for sock in tunnels:
+            sock.close()
+        return elapsed * self.bulk_bytes / (share * self.concurrency)
+
+    def _measure_round_trips(self) -> int:
+        tunnels = [self._open_tunnel()[0] for _ in range(self.concurrency)]
+        message = bytes(self.message_size)
+        deadline = time.perf_counter() + self.rr_seconds
+
+        def ping_pong(sock: socket.socket) -> int:
+            sock.sendall(COMMAND_HEADER.pack(COMMAND_ECHO, 0))
+            round_trips = 0
+            while time.perf_counter() < deadline:
+                sock.sendall(message)
+                recv_exact(sock, len(message))
+                round_trips += 1
+            return round_trips
+
+        with ThreadPoolExecutor(self.concurrency) as executor:
+            total = sum(executor.map(ping_pong, tunnels))
+        for sock in tunnels:
+            sock.close()
+        return total
+
+
+def recv_exact_discard(sock: socket.socket, size: int):
+    buffer = bytearray(CHUNK_SIZE)
+    while size:
+        received = sock.recv_into(buffer, min(size, CHUNK_SIZE))
+        if not received:
+            raise ConnectionError('tunnel closed during bulk transfer')
+        size -= received
+
+
+def current_commit() -> Optional[str]:
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmark(args: argparse.Namespace) -> Dict:
+    benchmark = ProxyBenchmark(args.engine, args.devices, args.clients, args.bulk_mb, args.rr_seconds, args.message_size,
+                               args.country_port, args.peer_port)
+    return {
+        'engine': args.engine,
+        'commit': current_commit(),
+        'timestamp': time.time(),
+        'parameters': {'devices': args.devices, 'clients': args.clients, 'bulk_mb': args.bulk_mb,
+                       'rr_seconds': args.rr_seconds, 'message_size': args.message_size},
+        'results': benchmark.run(),
+    }
+
+
+def compare(paths: List[str]) -> str:
+    runs = []
+    for path in paths:
+        with open(path) as results_file:
+            runs.append(json.load(results_file))
+    baseline = _flatten(runs[0]['results'])
+    lines = ['metric'.ljust(32) + ''.join(f"{run['engine']}@{run['commit']}".rjust(24) for run in runs)]
+    for metric, base in baseline.items():
+        cells = []
+        for run in runs:
+            value = _flatten(run['results']).get(metric)
+            ratio = f' ({value / base:.2f}x)' if value is not None and base else ''
+            cells.append(f'{value:.2f}{ratio}'.rjust(24) if value is not None else '-'.rjust(24))
+        lines.append(metric.ljust(32) + ''.join(cells))
+    return '\n'.join(lines)
+
+
+def _flatten(results: Dict, prefix='') -> Dict[str, float]:
+    flat = {}
+    for key, value in results.items():
+        if isinstance(value, dict):
+            flat.update(_flatten(value, f'{prefix}{key}.'))
+        else:
+            flat[prefix + key] = value
+    return flat
+
+
+def parse_args(argv=None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--engine', default='selectors', choices=['selectors', 'asyncio'])
+    parser.add_argument('--devices', type=int, default=16)
+    parser.add_argument('--clients', type=int, default=64)
+    parser.add_argument('--bulk-mb', type=int, default=256, help='bytes moved in each direction by the bulk test')
+    parser.add_argument('--rr-seconds', type=float, default=5)
+    parser.add_argument('--message-size', type=int, default=64)
+    parser.add_argument('--country-port', type=int, default=DEFAULT_COUNTRY_PORT)
+    parser.add_argument('--peer-port', type=int, default=DEFAULT_PEER_PORT)
+    parser.add_argument('--output', default='benchmark_results.json')
+    parser.add_argument('--compare', nargs='+', metavar='RESULTS', help='print a comparison of result files and exit')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.compare:
+        print(compare(args.compare))
+        return
+    results = run_benchmark(args)
+    with open(args.output, 'w') as output:
+        json.dump(results, output, indent=2)
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
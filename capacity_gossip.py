@@ -0,0 +1,225 @@
+import hashlib
+import hmac
+import json
+import selectors
+import socket
+import threading
+import time
+from threading import Lock
+from typing import Dict, List, Optional, Tuple
+
+from infrastructure.wrappers.infra_logger import Logger
+
+from utils.metrics import REGISTRY
+
+GOSSIP_DATAGRAMS = REGISTRY.counter('cluster_gossip_datagrams_total', 'Capacity gossip datagrams, by direction', ['direction'])
+CLUSTER_NODES = REGISTRY.gauge('cluster_nodes', 'Other backend nodes with fresh capacity in the directory')
+
+# stays under the IPv4 UDP payload limit.
+MAX_DATAGRAM_BYTES = 60000
+SIGNATURE_BYTES = hashlib.sha256().digest_size
+# a node whose capacity didn't change version for this many gossip intervals is dropped.
+EXPIRY_INTERVALS = 5
+
+
+class NodeCapacity:
+    """
+    Idle connections of one node by country and ASN, and the country ports clients reach it on.
+    version is the wall clock time the node published it at, so newer versions of a node win whatever path they came through.
+    """
+    __slots__ = ('node_id', 'address', 'ports', 'countries', 'version', 'seen_at')
+
+    def __init__(self, node_id: str, address: str, ports: Dict[str, int], countries: Dict[str, Dict[str, int]], version: float,
+                 seen_at: float) -> None:
+        self.node_id = node_id
+        self.address = address
+        self.ports = ports
+        self.countries = countries
+        self.version = version
+        self.seen_at = seen_at
+
+    def count(self, country_code: str, asn: Optional[str] = None) -> int:
+        asns = self.countries.get(country_code, {})
+        return sum(asns.values()) if asn is None else asns.get(asn, 0)
+
+    def as_dict(self) -> Dict:
+        return {'node': self.node_id, 'address': self.address, 'ports': self.ports, 'countries': self.countries, 'version': self.version}
+
+
+class CapacityDirectory:
+    """
+    Latest capacity of every node of the cluster, this one included. Thread safe.
+    """
+
+    def __init__(self, node_id: str, expiry_seconds: float) -> None:
+        self.node_id = node_id
+        self.expiry_seconds = expiry_seconds
+        self.nodes: Dict[str, NodeCapacity] = {}
+        self.lock = Lock()
+
+    def merge(self, entry: Dict, now: float) -> bool:
+        """
+        :return: whether the entry was newer than what the directory had for its node.
+        """
+        with self.lock:
+            known = self.nodes.get(entry['node'])
+            if known is not None and known.version >= entry['version']:
+                return False
+            self.nodes[entry['node']] = NodeCapacity(entry['node'], entry['address'], entry['ports'], entry['countries'], entry['version'], now)
+            return True
+
+    def expire(self, now: float) -> None:
+        with self.lock:
+            for node_id in [node_id for node_id, node in self.nodes.items() if now - node.seen_at > self.expiry_seconds]:
+                del self.nodes[node_id]
+
+    def entries(self) -> List[Dict]:
+        with self.lock:
+            return [node.as_dict() for node in self.nodes.values()]
+
+    def replace(self, entries: List[Dict], now: float) -> None:
+        """
+        Replace every node with entries, e.g. those another process's directory has.
+        """
+        with self.lock:
+            self.nodes = {entry['node']: NodeCapacity(entry['node'], entry['address'], entry['ports'], entry['countries'], entry['version'], now)
+                          for entry in entries}
+
+    def others(self) -> List[NodeCapacity]:
+        with self.lock:
+            return [node for node_id, node in self.nodes.items() if node_id != self.node_id]
+
+    def nodes_with_capacity(self, country_code: str, asn: Optional[str] = None) -> List[Dict]:
+        """
+        :return: the other nodes that have idle connections in the country, and ASN if given, the most first.
+        """
+        nodes = [(node.count(country_code, asn), node) for node in self.others()]
+        return [{'node': node.node_id, 'address': node.address, 'port': node.ports.get(country_code), 'connections': count}
+                for count, node in sorted(nodes, key=lambda pair: pair[0], reverse=True) if count]
+
+    def as_dict(self) -> Dict[str, Dict]:
+        """
+        :return: {node: {country: #}}
+        """
+        with self.lock:
+            return {node_id: {country_code: sum(asns.values()) for country_code, asns in node.countries.items()}
+                    for node_id, node in self.nodes.items()}
+
+
+def follow_directory(directory: CapacityDirectory, snapshots) -> None:
+    """
+    Keep directory a copy of the one WorkerSupervisor shares with its workers.
+    :param snapshots: queue of lists of entries, the other nodes of the shared directory.
+    """
+    while True:
+        directory.replace(snapshots.get(), time.monotonic())
+
+
+class CapacityGossip:
+    """
+    Shares the capacity of the backend nodes over UDP, so a node can tell clients where to find peers it doesn't have.
+    Every interval_seconds the node publishes its idle connection counts by country and ASN, read from the pool's counters,
+    and sends every fresh entry of its directory to its neighbours. Nodes merge the entries they receive by version, so
+    capacity spreads through the cluster without every node knowing every other one. Nodes that stopped publishing expire
+    after EXPIRY_INTERVALS intervals. Datagrams are json and carry as many entries as fit in MAX_DATAGRAM_BYTES.
+    They are signed with an HMAC of the cluster secret, datagrams with a wrong signature are dropped.
+    pool is anything that counts connections by country and ASN, a ConnectionPool or a WorkerSupervisor.
+    """
+
+    def __init__(self, pool, address: str, port: int, neighbours: List[Tuple[str, int]], country_to_port: Dict[str, int],
+                 interval_seconds: float, secret: str, bind_host: str = '0.0.0.0') -> None:
+        """
+        :param address: the host clients reach this node on.
+        :param port: UDP port to gossip on, 0 for any.
+        :param neighbours: (host, port) of the nodes to gossip with.
+        """
+        self.pool = pool
+        self.address = address
+        self.neighbours = neighbours
+        self.country_to_port = country_to_port
+        self.interval_seconds = interval_seconds
+        self.secret = secret.encode()
+        self.logger = Logger('CapacityGossip')
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.socket.bind((bind_host, port))
+        self.socket.setblocking(False)
+        self.node_id = f'{address}:{self.socket.getsockname()[1]}'
+        self.directory = CapacityDirectory(self.node_id, interval_seconds * EXPIRY_INTERVALS)
+        CLUSTER_NODES.set_function(lambda: len(self.directory.others()))
+        self.selector = selectors.DefaultSelector()
+        self.selector.register(self.socket, selectors.EVENT_READ)
+        self.should_stop = False
+        self.thread = threading.Thread(target=self._run, name='CapacityGossip', daemon=True)
+
+    def start(self) -> None:
+        self.thread.start()
+
+    def stop(self) -> None:
+        self.should_stop = True
+
+    def _run(self):
+        next_round = time.monotonic()
+        while not self.should_stop:
+            try:
+                now = time.monotonic()
+                if now >= next_round:
+                    self._gossip(now)
+                    next_round = now + self.interval_seconds
+                if self.selector.select(next_round - now):
+                    self._receive(time.monotonic())
+            except Exception as e:
+                self.logger.error('capacity gossip iteration failed', exc_info=e)
+        self.selector.close()
+        self.socket.close()
+
+    def _gossip(self, now: float):
+        self.directory.merge({'node': self.node_id, 'address': self.address, 'ports': self.country_to_port,
+                              'countries': self.pool.count_connections_by_country_and_asn(), 'version': time.time()}, now)
+        self.directory.expire(now)
+        for datagram in self._datagrams(self.directory.entries()):
+            for neighbour in self.neighbours:
+                try:
+                    self.socket.sendto(self._sign(datagram) + datagram, neighbour)
+                    GOSSIP_DATAGRAMS.labels('sent').inc()
+                except OSError as e:
+                    self.logger.debug(f'failed to gossip with {neighbour}. {e!r}')
+
+    def _datagrams(self, entries: List[Dict]) -> List[bytes]:
+        datagrams = []
+        encoded = []
+        size = 0
+        for entry in entries:
+            data = json.dumps(entry).encode()
+            if len(data) + 2 > MAX_DATAGRAM_BYTES - SIGNATURE_BYTES:
+                self.logger.error(f'capacity of {entry["node"]} is too big to gossip, {len(data)} bytes')
+                continue
+            if size + len(data) + 2 > MAX_DATAGRAM_BYTES - SIGNATURE_BYTES:
+                datagrams.append(b'[' + b','.join(encoded) + b']')
+                encoded, size = [], 0
+            encoded.append(data)
+            size += len(data) + 1
+        if encoded:
+            datagrams.append(b'[' + b','.join(encoded) + b']')
+        return datagrams
+
+    def _sign(self, datagram: bytes) -> bytes:
+        return hmac.new(self.secret, datagram, hashlib.sha256).digest()
+
+    def _receive(self, now: float):
+        while True:
+            try:
+                datagram, sender = self.socket.recvfrom(MAX_DATAGRAM_BYTES)
+            except BlockingIOError:
+                return
+            GOSSIP_DATAGRAMS.labels('received').inc()
+            signature, datagram = datagram[:SIGNATURE_BYTES], datagram[SIGNATURE_BYTES:]
+            if not hmac.compare_digest(signature, self._sign(datagram)):
+                self.logger.error(f'dropped capacity gossip with a wrong signature from {sender}')
+                continue
+            try:
+                entries = json.loads(datagram)
+                for entry in entries:
+                    if entry['node'] != self.node_id:
+                        self.directory.merge(entry, now)
+            except (ValueError, KeyError, TypeError) as e:
+                self.logger.error(f'invalid capacity gossip from {sender}. {e!r}')
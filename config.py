@@ -13,5 +13,62 @@ config = {
     'max_threads': 200,
     'country_to_port': {'N/A': 1234, 'BE': 2000, 'DE': 3000, 'LU': 4000, 'SE': 5000, 'NL': 6000, 'AE': 7000},
     'service_whitelist_enabled': True,
-    'service_whitelist': ['www.ipinfo.io']
+    'service_whitelist': ['www.ipinfo.io'],
+    'splice_relay_enabled': False,
+    # 'selectors' or 'asyncio'. The asyncio engine doesn't support mux_enabled.
+    'proxy_engine': 'selectors',
+    'worker_processes': 1,
+    # a process started with --takeover takes the idle peer sockets of the running one over, see graceful_restart.
+    # Single process mode only. Listening ports get SO_REUSEPORT so both processes can bind them.
+    'graceful_restart_enabled': False,
+    'graceful_restart_socket_path': '/run/dirtysocks/handover.sock',
+    'graceful_restart_drain_seconds': 600,
+    # other backend nodes to share capacity with, ['host:gossip port', ...]. Empty disables it, see capacity_gossip.
+    'cluster_neighbours': [],
+    # host clients reach this node on, the hostname if empty.
+    'cluster_node_address': '',
+    'cluster_gossip_port': 8600,
+    'cluster_gossip_interval_seconds': 2,
+    'cluster_gossip_secret': '',
+    'tunnel_buffer_high_watermark': 256 * 1024,
+    'tunnel_buffer_low_watermark': 64 * 1024,
+    'mux_enabled': False,
+    'mux_max_streams_per_device': 8,
+    'country_port_backlog': 1024,
+    'peer_server_backlog': 1024,
+    # devices that don't send their handshake within this many seconds of connecting are disconnected.
+    'peer_handshake_timeout_seconds': 10,
+    # GeoIP answers cached by /24 prefix, and how often to check for databases replaced by geoipupdate, see utils.geoip_lookup
+    'geoip_lookup': {'cache_size': 65536, 'reload_interval_seconds': 60},
+    # how pops by country pick an ASN: 'round_robin', 'weighted_random', 'fifo' (longest idle first)
+    # or 'lowest_rtt' (best round trip history first, see utils.peer_scores), see utils.connection_index
+    'pool_selection_policy': 'lowest_rtt',
+    'peer_rtt_scoring': {'max_devices': 500000, 'smoothing': 0.3, 'unmeasured_rtt_seconds': 0.3, 'failure_penalty_seconds': 2},
+    # watch idle peers for kernel reported hang ups, see peer_liveness_monitor. Keep alive packets are then only a deep check.
+    'pool_passive_liveness_enabled': True,
+    'pool_deep_probe_interval_seconds': 4 * 60 * 60,
+    'peer_tcp_keepalive': {'idle_seconds': 60, 'interval_seconds': 15, 'count': 4, 'user_timeout_seconds': 120},
+    'tunnel_handshake_timeout_seconds': 30,
+    'tunnel_idle_timeout_seconds': 600,
+    # how long a closing tunnel waits for the device to take its buffered bytes and the closing packet.
+    'tunnel_close_drain_seconds': 5,
+    # bytes per second by direction, e.g. {'upload': 512 * 1024, 'download': 2 * 1024 * 1024}. 0 or missing is unlimited.
+    'device_bandwidth_limits': {'default': {}, 'countries': {}, 'asns': {}},
+    'device_bandwidth_burst_seconds': 1,
+    # Stop accepting clients once a selector loop iteration is busier than this, until one is faster than the recover threshold.
+    'loop_lag_shed_seconds': 0.25,
+    'loop_lag_recover_seconds': 0.05,
+    'loop_slow_callback_seconds': 0.05,
+    'log_queue_size': 10000,
+    # '<logger name>.<call site>': {'sample_every': N, 'max_per_second': N}, see utils.hot_path_logger.LogSite
+    'log_sampling': {
+        'SuperProxy.transmit': {'sample_every': 100, 'max_per_second': 20},
+        'SuperProxy.packet': {'sample_every': 100, 'max_per_second': 20},
+        'SuperProxy.accept': {'max_per_second': 20},
+        'SuperProxy.miss': {'max_per_second': 20},
+        'AsyncSuperProxy.miss': {'max_per_second': 20},
+        'C-pool.insert': {'max_per_second': 20},
+        'C-pool.pop': {'max_per_second': 20},
+        'C-pool.evict': {'max_per_second': 20}
+    }
 }
@@ -1,30 +1,52 @@
-import time
-from collections import defaultdict
-from concurrent.futures.thread import ThreadPoolExecutor
-from functools import reduce
 import struct
-from threading import Timer
-from typing import Dict, List
+from threading import Lock, Timer
+from typing import Dict, List, Optional
 import socket
 from infrastructure.wrappers.infra_logger import Logger
 
+from config import config
 from data_classes.connection import Connection
+from keep_alive_prober import KeepAliveProber
+from peer_liveness_monitor import PeerLivenessMonitor
+from utils.connection_index import ConnectionIndex, ROUND_ROBIN
+from utils.hot_path_logger import HotPathLogger
+from utils.metrics import REGISTRY
 from utils.no_available_connection_exception import NoAvailableConnection
-from utils.temp_socket_timeout_setter import TempSocketTimeoutSetter
+from utils.peer_scores import PeerScores
 
-MAX_THREADS_FOR_PARALLEL_FILTER = 25
+ANY_ASN = '*'
+ANY_COUNTRY = '*'
+
+INSERTS = REGISTRY.counter('pool_inserts_total', 'Device connections inserted into the pool', ['country'])
+POPS = REGISTRY.counter('pool_pops_total', 'Device connections handed out for a tunnel', ['country', 'asn'])
+MISSES = REGISTRY.counter('pool_misses_total', 'Pops that found no available connection. asn is * when any ASN was accepted', ['country', 'asn'])
+DUPLICATE_EVICTIONS = REGISTRY.counter('pool_duplicate_evictions_total', 'Idle connections closed because their device reconnected',
+                                       ['country'])
+KEEP_ALIVE_EVICTIONS = REGISTRY.counter('pool_keep_alive_evictions_total', 'Connections removed because they failed the keep alive check',
+                                        ['country'])
+AVAILABLE_CONNECTIONS = REGISTRY.gauge('pool_available_connections', 'Connections waiting in the pool')
+USED_CONNECTIONS = REGISTRY.gauge('pool_used_connections', 'Connections handed out to tunnels that are still open')
 
 
 class ConnectionPool:
     """
     Connection-handling pool. Connections are ordered and can be fetched by country and ASN for later use by a socks server.
-    Connections are constantly kept alive and filtered out. Every FULL_KEEP_ALIVE_INTERVAL seconds, it sends a keep alive packet to each socket.
+    Connections are constantly kept alive and filtered out. Over every FULL_KEEP_ALIVE_INTERVAL seconds, the KeepAliveProber sends a keep alive packet to each socket.
     Sockets that don't respond KEEP_ALIVE_ATTEMPTS times within SOCKET_TIMEOUT_SECONDS are considered disconnected and are removed from the pool.
     API:
     1. insert - When a new peer is connected to a socket, its IP should be resolved into CC and asn, then wrapped in a Connection object and inserted.
     2. pop_connection_by_country - get an alive connection using only its country code.
     3. pop_connection_by_country_and_asn - get an alive connection using country code and ASN.
-    4. count_connections_by_country - returns a dict in the form {country: #}
+    4. pop_connection_by_device_id - get the connection of a specific device.
+    5. count_connections_by_country - returns a dict in the form {country: #}
+    A device has one idle connection at most. When a device reconnects, its older idle connection is closed.
+    Connections are kept in a ConnectionIndex, so counts are O(1) and country pops are spread over ASNs
+    according to config['pool_selection_policy']. The lowest_rtt policy hands out the device with the best round trip
+    history in peer_scores first, which keep alive probes and tunnel setups keep up to date.
+    Thread safe: the peer server inserts, the proxy pops and the prober probes concurrently. The prober takes a connection
+    out of the pool only while its probe is in flight, so pops never wait for a keep alive round trip.
+    With config['pool_passive_liveness_enabled'], idle connections are also watched by a PeerLivenessMonitor, which removes
+    them as soon as the kernel reports a hang up, and keep alive packets are only sent every config['pool_deep_probe_interval_seconds'].
     """
     TCP_SOCKET_STATE_CONNECTED = 1
     SLEEP_TIME_BETWEEN_KEEP_ALIVE_PACKETS = 1
@@ -32,7 +54,8 @@ class ConnectionPool:
     KEEP_ALIVE_ATTEMPTS = 3
     SLEEP_TIME_BETWEEN_ASN_KEEP_ALIVES = 0.2
     FULL_KEEP_ALIVE_INTERVAL = 60*15
-    CLEAN_USED_CONNECTIONS_INTERVAL = 120
+    # tunnels release their connections when they close, the scan only catches connections that were never released.
+    CLEAN_USED_CONNECTIONS_INTERVAL = 60*15
     KEEP_ALIVE_PACKET_DATA: str = "KEAL"
     WIFI_WARN_PACKET_DATA = 'waaxbkceuvmmonqxtxbequkjvarqkehqjzzetfvyagr' \
                             'kwafqujqiiqxuautddwfsobmegzaygdcawwdvjoodpr' \
@@ -42,12 +65,28 @@ class ConnectionPool:
                                 '7AFC2NUPDTYC7MBRX4VHHBDQT9TTRXQYD0SZ8TXGU7OUT' \
                                 'GL3TQUWOQ2ONKHYA12KWWZDDG9ZLYTS0FR1NT5OKLM'
 
-    def __init__(self) -> None:
-        self.available_connections: Dict[str, Dict[str, List[Connection]]] = defaultdict(lambda: defaultdict(list))
-        self.used_connections: List[Connection] = []
+    def __init__(self, selection_policy: Optional[str] = None, passive_liveness: Optional[bool] = None) -> None:
+        self.peer_scores = PeerScores(**config.get('peer_rtt_scoring', {}))
+        self.available_connections = ConnectionIndex(selection_policy or config.get('pool_selection_policy', ROUND_ROBIN),
+                                                     lambda connection: self.peer_scores.score(connection.device_id))
+        # connections handed out to tunnels, keyed by their socket.
+        self.used_connections: Dict[socket.socket, Connection] = {}
+        self.used_connections_lock = Lock()
         self.logger = Logger('C-pool')
-        Timer(ConnectionPool.FULL_KEEP_ALIVE_INTERVAL, self._test_all_available_connections_are_alive).start()
-        Timer(ConnectionPool.CLEAN_USED_CONNECTIONS_INTERVAL, self._clean_used_connections).start()
+        self.hot_logger = HotPathLogger('C-pool')
+        if passive_liveness is None:
+            passive_liveness = config.get('pool_passive_liveness_enabled', False)
+        self.liveness_monitor: Optional[PeerLivenessMonitor] = None
+        self.keep_alive_interval = self.FULL_KEEP_ALIVE_INTERVAL
+        if passive_liveness and PeerLivenessMonitor.is_supported():
+            self.liveness_monitor = PeerLivenessMonitor(self, config.get('peer_tcp_keepalive'))
+            self.liveness_monitor.start()
+            self.keep_alive_interval = config.get('pool_deep_probe_interval_seconds', self.FULL_KEEP_ALIVE_INTERVAL)
+        self.prober = KeepAliveProber(self)
+        self.prober.start()
+        self._start_timer(ConnectionPool.CLEAN_USED_CONNECTIONS_INTERVAL, self._clean_used_connections)
+        AVAILABLE_CONNECTIONS.set_function(self.__len__)
+        USED_CONNECTIONS.set_function(self.count_used_connections)
 
     def insert(self, connection: Connection) -> None:
         """
@@ -56,8 +95,16 @@ class ConnectionPool:
         :param connection: new peer
         :return: None.
         """
-        self.logger.info(f'New Peer: {connection.country_code}/{connection.asn}')
-        self.available_connections[connection.country_code][connection.asn].append(connection)
+        self.hot_logger.info('insert', 'New Peer: %s/%s', connection.country_code, connection.asn)
+        self.peer_scores.track(connection.device_id, connection.country_code, connection.asn)
+        self._watch(connection)
+        replaced = self.available_connections.add(connection)
+        INSERTS.labels(connection.country_code).inc()
+        if replaced is not None:
+            self.hot_logger.info('evict', 'Device reconnected, closing its previous connection %s', replaced)
+            self._unwatch(replaced)
+            replaced.socket.close()
+            DUPLICATE_EVICTIONS.labels(replaced.country_code).inc()
 
     def pop_connection_by_country(self, country_code: str) -> Connection:
         """
@@ -65,21 +112,17 @@ class ConnectionPool:
         :param country_code: country code to look for available connection.
         :return: Available peer.
         """
-        self.logger.info(f'Trying to pop connection from {country_code}')
-        if country_code not in self.available_connections.keys():
+        self.hot_logger.info('pop', 'Trying to pop connection from %s', country_code)
+        connection = self.available_connections.pop(country_code)
+        if connection is None:
+            self.hot_logger.error('pop', 'Connection list in empty')
+            MISSES.labels(country_code, ANY_ASN).inc()
             raise NoAvailableConnection(country_code)
-        asn_lists = self.available_connections[country_code].values()
-        self.logger.debug("ASN Lists: ", asn_lists)
-        if not asn_lists:
-            self.logger.error("No Available ASN at {0}".format(country_code))
-        for asn_list in asn_lists:
-            connection = self._pop_if_list_not_empty(asn_list)
-            if not connection:
-                self.logger.error("Connection list in empty")
-                continue
-            self.logger.info(f'Popping connection from {country_code}')
-            return connection
-        raise NoAvailableConnection(country_code)
+        self._unwatch(connection)
+        self._use_connection(connection)
+        self.hot_logger.info('pop', 'Popping connection from %s', country_code)
+        POPS.labels(country_code, connection.asn).inc()
+        return connection
 
     def pop_connection_by_country_and_asn(self, country_code: str, asn: str) -> Connection:
         """
@@ -88,22 +131,44 @@ class ConnectionPool:
         :param asn: Provider to look for available connection.
         :return: Available peer.
         """
-        self.logger.info(f'Popping connection from {country_code}/{asn}')
-        connection_list = self.available_connections[country_code][asn]
-        connection = self._pop_if_list_not_empty(connection_list)
+        self.hot_logger.info('pop', 'Popping connection from %s/%s', country_code, asn)
+        connection = self.available_connections.pop(country_code, asn)
         if connection:
+            self._unwatch(connection)
+            self._use_connection(connection)
+            POPS.labels(country_code, asn).inc()
             return connection
+        MISSES.labels(country_code, asn).inc()
         raise NoAvailableConnection(country_code, asn)
 
+    def pop_connection_by_device_id(self, device_id: str) -> Connection:
+        """
+        get the idle connection of a device.
+        :param device_id: IMEI of the device.
+        :return: Available peer.
+        """
+        connection = self.available_connections.pop_by_device_id(device_id)
+        if connection is None:
+            MISSES.labels(ANY_COUNTRY, ANY_ASN).inc()
+            raise NoAvailableConnection(ANY_COUNTRY, device_id)
+        self._unwatch(connection)
+        self._use_connection(connection)
+        POPS.labels(connection.country_code, connection.asn).inc()
+        return connection
+
     def count_connections_by_country(self) -> Dict[str, int]:
         """
         Check how many available connections we have per country.
         :return: Number of connection per country
         """
-        country_count = {}
-        for country, asn_dict in self.available_connections.items():
-            country_count[country] = reduce(lambda x, y: len(y) + x, asn_dict.values(), 0)
-        return country_count
+        return self.available_connections.count_by_country()
+
+    def count_connections_by_country_and_asn(self) -> Dict[str, Dict[str, int]]:
+        """
+        :return: {country: {asn: #}} of the countries with idle connections.
+        """
+        return {country_code: self.available_connections.count_by_asn(country_code)
+                for country_code, count in self.available_connections.count_by_country().items() if count}
 
     def get_all_device_ids(self, distinct=False):
         """
@@ -111,101 +176,131 @@ class ConnectionPool:
         :param distinct: unique results or not.
         :return: List of all available device ids.
         """
-        device_ids = []
-        for asn_dict in self.available_connections.values():
-            for connection_list in asn_dict.values():
-                for connection in connection_list:
-                    device_ids.append(connection.device_id)
-        device_ids.append([c.device_id for c in self.used_connections])
+        device_ids = self.available_connections.device_ids()
+        with self.used_connections_lock:
+            device_ids.extend(c.device_id for c in self.used_connections.values())
         if distinct:
             return list(set(device_ids))
         return device_ids
 
     def close_all_connections(self):
-        for asn_dict in self.available_connections.values():
-            for connection_list in asn_dict.values():
-                for connection in connection_list:
-                    connection.socket.close()
-        for connection in self.used_connections:
+        self.prober.stop()
+        if self.liveness_monitor is not None:
+            self.liveness_monitor.stop()
+        for connection in self.available_connections:
+            connection.socket.close()
+        with self.used_connections_lock:
+            used_connections = list(self.used_connections.values())
+        for connection in used_connections:
             connection.socket.close()
 
-    def _pop_if_list_not_empty(self, list_to_check: list) -> Connection:
-        if len(list_to_check) > 0:
-            connection: Connection = list_to_check.pop()
-            self._use_connection(connection)
-            return connection
+    def hand_over_connections(self) -> List[Connection]:
+        """
+        Stop keeping connections alive and take every idle connection out of the pool without closing it,
+        so another process can take them over.
+        """
+        self.prober.stop(wait=True)
+        if self.liveness_monitor is not None:
+            self.liveness_monitor.stop()
+        connections = []
+        for connection in self.available_connections:
+            if self.available_connections.remove(connection):
+                self._unwatch(connection)
+                connections.append(connection)
+        return connections
 
-    def _test_all_available_connections_are_alive(self) -> None:
-        self.logger.info(f'Starting keep alive cycle')
-        for country, asn_dict in self.available_connections.items():
-            for asn, connection_list in asn_dict.items():
-                try:
-                    alive_connections = list(self.parallel_filter(lambda c: self._is_connection_alive(c) and self._is_tcp_state_ok(c), connection_list))
-                    dead_connections = list(set(connection_list) - set(alive_connections))
-                    for c in dead_connections:
-                        c.socket.close()
-                    connection_list[:] = alive_connections
-                    self.logger.info(
-                        f'Keep alive check on {country}/{asn} removed {len(dead_connections)} connections. \n'
-                        f'{len(alive_connections)} devices are still connected in {country}/{asn}.')
-                except Exception as e:
-                    self.logger.error("keep alive was interrupted due to exception: ", exc_info=e)
-        Timer(ConnectionPool.FULL_KEEP_ALIVE_INTERVAL, self._test_all_available_connections_are_alive).start()
-
-    def _is_connection_alive(self, connection: Connection) -> bool:
-        _socket = connection.socket
-        with TempSocketTimeoutSetter(_socket, self.SOCKET_TIMEOUT_SECONDS):
-            alive = False
-            for _ in range(self.KEEP_ALIVE_ATTEMPTS):
-                alive = self._send_keep_alive_packet_and_check_response(_socket)
-                if alive:
-                    break
-                time.sleep(self.SLEEP_TIME_BETWEEN_KEEP_ALIVE_PACKETS)
-        return alive
-
-    def _send_keep_alive_packet_and_check_response(self, _socket) -> bool:
-        bytes_to_send = bytes(ConnectionPool.KEEP_ALIVE_PACKET_DATA, 'utf-8')
-        wifi_warn = bytes(ConnectionPool.WIFI_WARN_PACKET_DATA, 'utf-8')
-        debugger_warn = bytes(ConnectionPool.DEBUGGER_WARN_PACKET_DATA, 'utf-8')
-        try:
-            bytes_sent = _socket.send(bytes_to_send)
-            if bytes_sent != len(bytes_to_send):
-                return False
-            response = _socket.recv(bytes_sent)
-        except Exception:
-            return False
-        if response.hex() == wifi_warn.hex():
-            self.logger.error("Wifi connection has been detected")
-            return False
-        if response.hex() == debugger_warn.hex():
-            self.logger.error("Debugger connection has been detected")
-            return False
-        elif len(response) == 0:
-            return False
-        elif response.hex() == bytes_to_send.hex():
-            return True
-        else:
-            self.logger.error("Protocol Anomalies alert: receive unexpected response: {0}".format(response.hex()))
+    def release(self, peer_socket: socket.socket) -> None:
+        """
+        Called by the proxy when the tunnel or mux session using the socket has closed.
+        """
+        with self.used_connections_lock:
+            self.used_connections.pop(peer_socket, None)
+
+    def count_used_connections(self) -> int:
+        return len(self.used_connections)
+
+    def get_rtt_distribution(self) -> Dict[str, Dict]:
+        return self.peer_scores.distribution()
+
+    def take_for_probe(self, connection: Connection) -> Optional[float]:
+        """
+        Take an idle connection out of the pool while it is probed, so it can't be handed out with a probe in flight.
+        :return: the time the connection became idle, to be passed to probe_finished, or None if it was popped meanwhile.
+        """
+        idle_since = self.available_connections.take(connection)
+        if idle_since is not None:
+            self._unwatch(connection)
+        return idle_since
+
+    def probe_finished(self, connection: Connection, idle_since: float, alive: bool) -> None:
+        newer = self.available_connections.get_by_device_id(connection.device_id)
+        if alive and newer is None:
+            self._watch(connection)
+            self.available_connections.add(connection, idle_since)
+            return
+        if alive:
+            # the device reconnected while it was probed.
+            connection.socket.close()
+            DUPLICATE_EVICTIONS.labels(connection.country_code).inc()
+            return
+        self.hot_logger.info('evict', 'Keep alive failed, removing %s', connection)
+        connection.socket.close()
+        KEEP_ALIVE_EVICTIONS.labels(connection.country_code).inc()
+
+    def peer_hung_up(self, connection: Connection) -> bool:
+        """
+        Called by the liveness monitor when the kernel reports an idle connection closed or dead.
+        :return: whether the connection was still idle in the pool and got removed.
+        """
+        if not self.available_connections.remove(connection):
             return False
+        self.hot_logger.info('evict', 'Peer hung up, removing %s', connection)
+        connection.socket.close()
+        return True
+
+    def _watch(self, connection: Connection):
+        # watched before it is added, so a connection popped right away is never left watched.
+        if self.liveness_monitor is not None:
+            self.liveness_monitor.watch(connection)
+
+    def _unwatch(self, connection: Connection):
+        if self.liveness_monitor is not None:
+            self.liveness_monitor.unwatch(connection)
 
     def _use_connection(self, connection):
-        self.used_connections.append(connection)
+        with self.used_connections_lock:
+            self.used_connections[connection.socket] = connection
 
     def _clean_used_connections(self):
-        alive_connections = list(self.parallel_filter(self._is_tcp_state_ok, self.used_connections))
-        self.used_connections[:] = alive_connections
-        Timer(ConnectionPool.CLEAN_USED_CONNECTIONS_INTERVAL, self._clean_used_connections).start()
+        with self.used_connections_lock:
+            snapshot = list(self.used_connections.values())
+        dead_connections = [c for c in snapshot if not self._is_socket_open(c)]
+        if dead_connections:
+            self.logger.warning(f'{len(dead_connections)} used connections were closed without being released')
+            with self.used_connections_lock:
+                for connection in dead_connections:
+                    self.used_connections.pop(connection.socket, None)
+        self._start_timer(ConnectionPool.CLEAN_USED_CONNECTIONS_INTERVAL, self._clean_used_connections)
 
-    def _is_tcp_state_ok(self, connection):
-        s = connection.socket
-        return self.get_socket_state(s) == ConnectionPool.TCP_SOCKET_STATE_CONNECTED
+    def _is_socket_open(self, connection) -> bool:
+        try:
+            return self.is_tcp_state_ok(connection)
+        except OSError:
+            return False
 
     @staticmethod
-    def parallel_filter(func, candidates):
-        pool = ThreadPoolExecutor(len(candidates) if len(candidates) < MAX_THREADS_FOR_PARALLEL_FILTER else MAX_THREADS_FOR_PARALLEL_FILTER)
-        filtered_list = [c for c, keep in zip(candidates, pool.map(func, candidates)) if keep]
-        pool.shutdown(True)
-        return filtered_list
+    def _start_timer(interval: float, function):
+        # daemon, so a pool doesn't keep its process alive for a whole interval.
+        timer = Timer(interval, function)
+        timer.daemon = True
+        timer.start()
+
+    def is_tcp_state_ok(self, connection) -> bool:
+        """
+        Whether the kernel still reports the connection's socket as established. Used by the keep alive prober after a probe.
+        """
+        s = connection.socket
+        return self.get_socket_state(s) == ConnectionPool.TCP_SOCKET_STATE_CONNECTED
 
     @staticmethod
     def get_socket_state(s):
@@ -213,5 +308,4 @@ class ConnectionPool:
         return struct.unpack(fmt, s.getsockopt(socket.IPPROTO_TCP, socket.TCP_INFO, 92))[0]
 
     def __len__(self):
-        return reduce(lambda x, asn_dict: x + reduce(lambda y, con_list: y + len(con_list), asn_dict.values(), 0),
-                      self.available_connections.values(), 0)
+        return len(self.available_connections)
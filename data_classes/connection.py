@@ -9,6 +9,7 @@ class Connection:
     country_code: str
     asn: str
     device_id: str
+    mux_version: int = 0
 
     def __eq__(self, other):
         try:
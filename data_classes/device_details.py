@@ -12,15 +12,17 @@ class DeviceDetails:
     IP = 'ip'
     LAST_CONNECT_TIMESTAMP = 'last_connect_timestamp'
     APP_VERSION = 'app_version'
+    MUX_VERSION = 'mux_version'
 
     def __init__(self, imei: str = None, fcm_id: str = None, asn: str = None, country_code: str = None, ip: str = None,
-                 app_version: str = None, last_connect_timestamp: float = None, _id: str = None) -> None:
+                 app_version: str = None, last_connect_timestamp: float = None, _id: str = None, mux_version: int = 0) -> None:
         self.imei = imei
         self.fcm_id = fcm_id
         self.asn = asn
         self.country_code = country_code
         self.ip = ip
         self.app_version = app_version
+        self.mux_version = mux_version
         if last_connect_timestamp is None:
             self.last_connect_timestamp = time.time()
         else:
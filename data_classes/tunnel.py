@@ -0,0 +1,98 @@
+from socket import socket
+from typing import Dict, Optional
+
+from dataclasses import dataclass, field
+
+from bandwidth_shaper import DeviceBandwidth
+from dataplan_tracker import Collection
+from super_proxy_plugin import TunnelPlugins
+from utils.peer_scores import TunnelSetupTimer
+from utils.splice_relay import SpliceRelay
+from utils.timer_wheel import Timer
+
+DEFAULT_HIGH_WATERMARK = 256 * 1024
+DEFAULT_LOW_WATERMARK = 64 * 1024
+MIN_READ_SIZE = 1024
+MAX_READ_SIZE = 256 * 1024
+SMALL_READS_BEFORE_SHRINK = 4
+
+
+@dataclass
+class Tunnel:
+    """
+    Both sides of a proxied connection. Every socket has its own bounded outgoing buffer.
+    Once the buffer of one side passes high_watermark, the other side is not read until the buffer drains below low_watermark.
+    Every side is read with its own read size, which doubles after a read that filled it and halves after
+    SMALL_READS_BEFORE_SHRINK reads in a row that used less than a quarter of it.
+    last_activity_tick is the timer wheel tick of the last read, so the idle timer is only rescheduled when it fires.
+    A side whose bandwidth bucket ran dry is not read until its throttle timer fires.
+    setup times the first round trip through the device for the pool's peer scores.
+    Once closed, the peer side stays open until what was buffered for it and the closing packet went out or drain_timer fired.
+    """
+    yogurt_socket: socket
+    peer_socket: socket
+    device_id: str
+    country_code: str
+    high_watermark: int = DEFAULT_HIGH_WATERMARK
+    low_watermark: int = DEFAULT_LOW_WATERMARK
+    plugins: Optional[TunnelPlugins] = None
+    relay: Optional[SpliceRelay] = None
+    outgoing: Dict[socket, bytearray] = field(default_factory=dict)
+    reading: Dict[socket, bool] = field(default_factory=dict)
+    registered_events: Dict[socket, int] = field(default_factory=dict)
+    read_size: Dict[socket, int] = field(default_factory=dict)
+    small_reads: Dict[socket, int] = field(default_factory=dict)
+    backpressure_events: int = 0
+    last_activity_tick: int = 0
+    handshake_timer: Optional[Timer] = None
+    idle_timer: Optional[Timer] = None
+    bandwidth: Optional[DeviceBandwidth] = None
+    directions: Dict[socket, str] = field(default_factory=dict)
+    throttle_timers: Dict[socket, Optional[Timer]] = field(default_factory=dict)
+    setup: Optional[TunnelSetupTimer] = None
+    closed: bool = False
+    closing_packet_queued: bool = False
+    drain_timer: Optional[Timer] = None
+
+    def __post_init__(self):
+        for side in (self.yogurt_socket, self.peer_socket):
+            self.outgoing[side] = bytearray()
+            self.reading[side] = True
+            self.registered_events[side] = 0
+            self.read_size[side] = MIN_READ_SIZE
+            self.small_reads[side] = 0
+            self.throttle_timers[side] = None
+        # Same directions as DataplanTracker.
+        self.directions[self.yogurt_socket] = Collection.DIRECTION_DOWNLOAD
+        self.directions[self.peer_socket] = Collection.DIRECTION_UPLOAD
+
+    def other_side(self, conn: socket) -> socket:
+        return self.peer_socket if conn == self.yogurt_socket else self.yogurt_socket
+
+    def adapt_read_size(self, source: socket, received: int):
+        read_size = self.read_size[source]
+        if received >= read_size:
+            self.read_size[source] = min(read_size * 2, MAX_READ_SIZE)
+            self.small_reads[source] = 0
+        elif received < read_size // 4:
+            self.small_reads[source] += 1
+            if self.small_reads[source] >= SMALL_READS_BEFORE_SHRINK:
+                self.read_size[source] = max(read_size // 2, MIN_READ_SIZE)
+                self.small_reads[source] = 0
+        else:
+            self.small_reads[source] = 0
+
+    def pending(self, target: socket) -> int:
+        return len(self.outgoing[target]) + (self.relay.pending[target] if self.relay is not None else 0)
+
+    def is_over_high_watermark(self, target: socket) -> bool:
+        # A spliced pipe that still holds data can't take more without blocking, so it counts as full.
+        spliced_pending = self.relay is not None and self.relay.pending[target] > 0
+        return spliced_pending or len(self.outgoing[target]) >= self.high_watermark
+
+    def is_under_low_watermark(self, target: socket) -> bool:
+        spliced_pending = self.relay is not None and self.relay.pending[target] > 0
+        return not spliced_pending and len(self.outgoing[target]) <= self.low_watermark
+
+    def __repr__(self) -> str:
+        return f'Tunnel [{self.yogurt_socket!r} -> {self.peer_socket!r}] for {self.device_id}, {self.country_code}'
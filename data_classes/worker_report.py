@@ -0,0 +1,19 @@
+from typing import Dict, List
+
+from dataclasses import dataclass
+
+from utils.metrics import Samples
+
+
+@dataclass
+class WorkerReport:
+    pid: int
+    connections_by_country: Dict[str, int]
+    connections_by_country_and_asn: Dict[str, Dict[str, int]]
+    active_tunnels_by_country: Dict[str, int]
+    device_ids: List[str]
+    buffer_pool_stats: Dict[str, int]
+    accept_stats: Dict[str, Dict[str, int]]
+    device_bandwidth: Dict[str, Dict[str, Dict[str, float]]]
+    rtt_distribution: Dict[str, Dict]
+    metrics: Samples
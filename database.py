@@ -1,6 +1,9 @@
 from infrastructure.wrappers.mongo import Mongo
 
 from data_classes.device_details import DeviceDetails
+from utils.metrics import REGISTRY
+
+WRITE_SECONDS = REGISTRY.histogram('db_write_seconds', 'Latency of database writes', ['collection', 'operation'])
 
 
 class Database(Mongo):
@@ -8,3 +11,19 @@ class Database(Mongo):
         super().__init__(host, db)
         self.create_index(DeviceDetails.COLLECTION_NAME, DeviceDetails.COUNTRY_CODE)
         self.create_index(DeviceDetails.COLLECTION_NAME, DeviceDetails.IMEI)
+
+    def insert_one(self, collection, *args, **kwargs):
+        with WRITE_SECONDS.labels(collection, 'insert_one').time():
+            return super().insert_one(collection, *args, **kwargs)
+
+    def insert_many(self, collection, *args, **kwargs):
+        with WRITE_SECONDS.labels(collection, 'insert_many').time():
+            return super().insert_many(collection, *args, **kwargs)
+
+    def update_one(self, collection, *args, **kwargs):
+        with WRITE_SECONDS.labels(collection, 'update_one').time():
+            return super().update_one(collection, *args, **kwargs)
+
+    def delete_many(self, collection, *args, **kwargs):
+        with WRITE_SECONDS.labels(collection, 'delete_many').time():
+            return super().delete_many(collection, *args, **kwargs)
@@ -5,10 +5,13 @@ from dataclasses import dataclass
 from infrastructure.wrappers.infra_logger import Logger
 
 from database import Database
-from super_proxy_plugin import SuperProxyPlugin
+from super_proxy_plugin import SuperProxyPlugin, BYTE_COUNTS_ONLY
+from utils.metrics import REGISTRY
 
 LOGGER_NAME = 'Dataplan_tracker'
 
+DATAPLAN_BYTES = REGISTRY.counter('dataplan_bytes_total', 'Bytes written to the dataplanTracker collection', ['direction'])
+
 
 class Collection:
     COLLECTION_NAME = "dataplanTracker"
@@ -48,6 +51,8 @@ class DataplanTracker(SuperProxyPlugin):
     ])
 
     """
+    packet_window = BYTE_COUNTS_ONLY
+
     def __init__(self, db: Database):
         self.db: Database = db
         self.socket_to_device: Dict[socket, Device] = {}
@@ -69,15 +74,24 @@ class DataplanTracker(SuperProxyPlugin):
                                                         Collection.FIELD_AMOUNT: device.download_count})
         self.db.insert_one(Collection.COLLECTION_NAME, {Collection.FIELD_DEVICE_ID: device.device_id, Collection.FIELD_DIRECTION: Collection.DIRECTION_UPLOAD,
                                                         Collection.FIELD_AMOUNT: device.upload_count})
+        DATAPLAN_BYTES.labels(Collection.DIRECTION_DOWNLOAD).inc(device.download_count)
+        DATAPLAN_BYTES.labels(Collection.DIRECTION_UPLOAD).inc(device.upload_count)
         try:
             del self.socket_to_device[device.download_socket]
             del self.socket_to_device[device.upload_socket]
         except KeyError:
             self.logger.error("unregister:: socket was not in socket_to_device dict")
 
-    def packet_transmitted(self, source: socket, _, data: bytes):
+    def packet_transmitted(self, source: socket, _, data: memoryview):
         device: Device = self.socket_to_device.get(source)
         if not device:
             self.logger.error("packet_transmitted:: device was not found in socket_to_device dict")
             return
         device.aggregate_packet_size(source, len(data))
+
+    def bytes_transmitted(self, source: socket, _, amount: int):
+        device: Device = self.socket_to_device.get(source)
+        if not device:
+            self.logger.error("bytes_transmitted:: device was not found in socket_to_device dict")
+            return
+        device.aggregate_packet_size(source, amount)
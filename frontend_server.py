@@ -1,19 +1,25 @@
 import json
 from collections import Counter
-from socket import socket
-from typing import List, Dict, Tuple
+from socket import socket, SOL_SOCKET, SO_REUSEADDR, SO_REUSEPORT
+from typing import List, Dict, Optional, Tuple
 
 from flask import Flask, request
 from waitress import serve
+from capacity_gossip import CapacityDirectory
 from connection_pool import ConnectionPool
 from offline_device_handler import OfflineDeviceHandler
 from super_proxy import SuperProxy
-from utils.utils import merge_dicts
+from utils.accept_stats import read_listen_overflows
+from utils.metrics import REGISTRY, CONTENT_TYPE
+from utils.utils import merge_dicts, reuse_port
 
 
 class FrontendServer:
-    def __init__(self, port, pool: ConnectionPool, device_handler: OfflineDeviceHandler, super_proxy: SuperProxy, country_to_port) -> None:
+    def __init__(self, port, pool: ConnectionPool, device_handler: OfflineDeviceHandler, super_proxy: SuperProxy, country_to_port,
+                 peer_server=None, capacity_directory: Optional[CapacityDirectory] = None) -> None:
         self.pool = pool
+        self.capacity_directory = capacity_directory
+        self.peer_server = peer_server
         self.device_handler = device_handler
         self.super_proxy = super_proxy
         self.port = port
@@ -29,9 +35,23 @@ class FrontendServer:
         self.app.add_url_rule('/active_connections', 'active_connections', self.get_active_connections, methods=['GET'])
         self.app.add_url_rule('/available_asns_per_country', 'available_asns_per_country', self.get_available_asns_per_country, methods=['GET'])
         self.app.add_url_rule('/country_to_port', 'country_to_port', self.get_country_port_conf, methods=['GET'])
+        self.app.add_url_rule('/buffer_pool_stats', 'buffer_pool_stats', self.get_buffer_pool_stats, methods=['GET'])
+        self.app.add_url_rule('/accept_stats', 'accept_stats', self.get_accept_stats, methods=['GET'])
+        self.app.add_url_rule('/device_bandwidth', 'device_bandwidth', self.get_device_bandwidth, methods=['GET'])
+        self.app.add_url_rule('/peer_rtt', 'peer_rtt', self.get_peer_rtt, methods=['GET'])
+        self.app.add_url_rule('/capacity', 'capacity', self.get_capacity, methods=['GET'])
+        self.app.add_url_rule('/metrics', 'metrics', self.get_metrics, methods=['GET'])
 
     def start(self):
-        serve(self.app, port=self.port)
+        if not reuse_port():
+            serve(self.app, port=self.port)
+            return
+        # the next process serves the port too while this one drains, see graceful_restart.
+        frontend_socket = socket()
+        frontend_socket.setsockopt(SOL_SOCKET, SO_REUSEADDR, 1)
+        frontend_socket.setsockopt(SOL_SOCKET, SO_REUSEPORT, 1)
+        frontend_socket.bind(('0.0.0.0', self.port))
+        serve(self.app, sockets=[frontend_socket])
 
     def get_map_data(self):
         all_devices = self.device_handler.count_available_devices_by_country()
@@ -75,6 +95,41 @@ class FrontendServer:
         json_string = json.dumps(self.country_to_port)
         return json_string, 200
 
+    def get_buffer_pool_stats(self):
+        json_string = json.dumps(self.super_proxy.get_buffer_pool_stats())
+        return json_string, 200
+
+    def get_accept_stats(self):
+        stats = dict(self.super_proxy.get_accept_stats())
+        if self.peer_server:
+            stats.update(self.peer_server.get_accept_stats())
+        stats['system'] = read_listen_overflows()
+        return json.dumps(stats), 200
+
+    def get_device_bandwidth(self):
+        json_string = json.dumps(self.super_proxy.get_device_bandwidth())
+        return json_string, 200
+
+    def get_peer_rtt(self):
+        json_string = json.dumps(self.pool.get_rtt_distribution())
+        return json_string, 200
+
+    def get_capacity(self):
+        """
+        Idle connections of every node of the cluster by country. With cc, and optionally asn, the other nodes
+        that have connections there, with the address and port clients reach them on, the most first.
+        """
+        if self.capacity_directory is None:
+            return json.dumps({}), 200
+        country_code = request.args.get('cc')
+        if country_code:
+            return json.dumps(self.capacity_directory.nodes_with_capacity(country_code, request.args.get('asn'))), 200
+        return json.dumps(self.capacity_directory.as_dict()), 200
+
+    @staticmethod
+    def get_metrics():
+        return REGISTRY.render(), 200, {'Content-Type': CONTENT_TYPE}
+
     @staticmethod
     def _convert_port_mapping_list_to_country_count_dict(port_mappings: List[Tuple[socket, str]]) -> Dict[str, int]:
-        return Counter(map(lambda k, v: v, port_mappings))
+        return Counter(country for _, country in port_mappings)
@@ -0,0 +1,130 @@
+import json
+import os
+import socket
+import threading
+import time
+from typing import Callable, List
+
+from infrastructure.wrappers.infra_logger import Logger
+
+from data_classes.connection import Connection
+from utils.metrics import REGISTRY
+
+HANDED_OVER = REGISTRY.counter('pool_handed_over_connections_total', 'Idle connections passed between processes on a graceful restart',
+                               ['direction'])
+
+# SCM_MAX_FD is 253 on Linux.
+MAX_FDS_PER_MESSAGE = 250
+# a message holds the metadata of MAX_FDS_PER_MESSAGE connections.
+MAX_MESSAGE_SIZE = 256 * 1024
+DRAIN_POLL_SECONDS = 1
+
+
+def send_connections(channel: socket.socket, connections: List[Connection]) -> int:
+    """
+    Pass connections to the process on the other side of channel, a connected SOCK_SEQPACKET Unix socket.
+    Every message carries up to MAX_FDS_PER_MESSAGE sockets as SCM_RIGHTS and their metadata as json. An empty message ends the list.
+    The sockets are closed on this side once sent, the connections stay open in the other process.
+    :return: number of connections sent.
+    """
+    for start in range(0, len(connections), MAX_FDS_PER_MESSAGE):
+        batch = connections[start:start + MAX_FDS_PER_MESSAGE]
+        metadata = [[c.country_code, c.asn, c.device_id, c.mux_version] for c in batch]
+        socket.send_fds(channel, [json.dumps(metadata).encode()], [c.socket.fileno() for c in batch])
+        for connection in batch:
+            connection.socket.close()
+    channel.send(json.dumps([]).encode())
+    return len(connections)
+
+
+def receive_connections(channel: socket.socket) -> List[Connection]:
+    """
+    Receive the connections sent by send_connections.
+    """
+    connections = []
+    while True:
+        data, fds, _, _ = socket.recv_fds(channel, MAX_MESSAGE_SIZE, MAX_FDS_PER_MESSAGE)
+        if not data:
+            raise ConnectionError(f'handover ended after {len(connections)} connections')
+        metadata = json.loads(data)
+        if not metadata:
+            return connections
+        for (country_code, asn, device_id, mux_version), fd in zip(metadata, fds):
+            connections.append(Connection(socket.socket(fileno=fd), country_code, asn, device_id, mux_version))
+
+
+def take_over(path: str, pool) -> int:
+    """
+    Ask the process listening on path to hand over its idle connections, and insert them into pool.
+    :return: number of connections taken over, 0 if no process is listening.
+    """
+    logger = Logger('GracefulRestart')
+    channel = socket.socket(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+    try:
+        channel.connect(path)
+    except (FileNotFoundError, ConnectionRefusedError):
+        logger.info(f'No running process to take over at {path}')
+        return 0
+    started = time.monotonic()
+    with channel:
+        connections = receive_connections(channel)
+    for connection in connections:
+        pool.insert(connection)
+    HANDED_OVER.labels('received').inc(len(connections))
+    logger.info(f'Took over {len(connections)} connections in {time.monotonic() - started:.3f}s')
+    return len(connections)
+
+
+class GracefulRestart:
+    """
+    Waits on a Unix socket for a new process to take this one over, see take_over.
+    A new process binds the listening ports next to this one, all of them have SO_REUSEPORT, and then connects. This process then
+    stops accepting devices and clients, hands the idle pooled connections with their metadata to the new process, so its pool
+    starts warm, and serves its open tunnels for up to drain_seconds before it exits. Devices only reconnect if their connection was
+    in a tunnel that didn't close in time.
+    """
+
+    def __init__(self, path: str, pool, peer_server, super_proxy, drain_seconds: float, on_drained: Callable[[], None]) -> None:
+        """
+        :param on_drained: ends the process once it is drained.
+        """
+        self.path = path
+        self.pool = pool
+        self.peer_server = peer_server
+        self.super_proxy = super_proxy
+        self.drain_seconds = drain_seconds
+        self.on_drained = on_drained
+        self.logger = Logger('GracefulRestart')
+        self.listening_socket = socket.socket(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+        self.thread = threading.Thread(target=self._run, name='GracefulRestart', daemon=True)
+
+    def start(self) -> None:
+        # the socket of the process this one took over is unlinked, it is only closed when that process exits.
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        self.listening_socket.bind(self.path)
+        self.listening_socket.listen(1)
+        self.thread.start()
+
+    def _run(self):
+        channel, _ = self.listening_socket.accept()
+        self.listening_socket.close()
+        self.logger.info('A new process is taking over')
+        started = time.monotonic()
+        self.peer_server.stop(wait=True)
+        self.super_proxy.shutdown()
+        try:
+            with channel:
+                sent = send_connections(channel, self.pool.hand_over_connections())
+            HANDED_OVER.labels('sent').inc(sent)
+            self.logger.info(f'Handed over {sent} connections in {time.monotonic() - started:.3f}s')
+        except OSError as e:
+            self.logger.error('Failed to hand over connections', exc_info=e)
+        self._drain(started + self.drain_seconds)
+        self.on_drained()
+
+    def _drain(self, deadline: float):
+        while self.super_proxy.get_active_sockets() and time.monotonic() < deadline:
+            time.sleep(DRAIN_POLL_SECONDS)
+        self.logger.info(f'Exiting with {len(self.super_proxy.get_active_sockets())} tunnels open')
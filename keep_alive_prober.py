@@ -0,0 +1,201 @@
+import heapq
+import itertools
+import selectors
+import socket
+import threading
+import time
+from collections import deque
+from typing import Deque, List, Tuple
+
+from infrastructure.wrappers.infra_logger import Logger
+
+from data_classes.connection import Connection
+from utils.metrics import REGISTRY
+from utils.peer_scores import PROBE
+
+PROBES = REGISTRY.counter('pool_keep_alive_probes_total', 'Keep alive probes of pooled connections, by outcome', ['result'])
+PROBES_IN_FLIGHT = REGISTRY.gauge('pool_keep_alive_probes_in_flight', 'Pooled connections waiting for a keep alive response')
+
+
+class Probe:
+    __slots__ = ('connection', 'idle_since', 'attempts', 'received', 'deadline', 'awaiting_response', 'sent_at')
+
+    def __init__(self, connection: Connection, idle_since: float) -> None:
+        self.connection = connection
+        self.idle_since = idle_since
+        self.attempts = 0
+        self.received = b''
+        self.deadline = 0.0
+        self.awaiting_response = False
+        self.sent_at = 0.0
+
+
+class KeepAliveProber:
+    """
+    Probes the pool's idle connections from a single thread. Every keep_alive_interval of the pool, which is
+    FULL_KEEP_ALIVE_INTERVAL unless passive liveness is on, the pool is snapshotted and the snapshot is probed at an even pace
+    over the interval, so probes never come in bursts.
+    A probe takes the connection out of the pool, sends KEEP_ALIVE_PACKET_DATA without blocking and waits for the echo in a
+    selector. Deadlines live in a heap: a probe that gets no echo within SOCKET_TIMEOUT_SECONDS is resent after
+    SLEEP_TIME_BETWEEN_KEEP_ALIVE_PACKETS, up to KEEP_ALIVE_ATTEMPTS times. Connections that answer go back to the pool
+    with their original idle time, the rest are closed. Timing constants are read from the pool, so they are configured in one place.
+    The round trip of every echo and every unanswered attempt go to the pool's peer scores.
+    """
+    MAX_PROBES_IN_FLIGHT = 4096
+    MAX_WAIT_SECONDS = 1
+
+    def __init__(self, pool) -> None:
+        self.pool = pool
+        self.logger = Logger('KeepAliveProber')
+        self.selector = selectors.DefaultSelector()
+        self.keep_alive = pool.KEEP_ALIVE_PACKET_DATA.encode()
+        self.wifi_warn = pool.WIFI_WARN_PACKET_DATA.encode()[:len(self.keep_alive)]
+        self.debugger_warn = pool.DEBUGGER_WARN_PACKET_DATA.encode()[:len(self.keep_alive)]
+        # (deadline, sequence, probe). Entries whose deadline no longer matches their probe's are stale and skipped.
+        self.deadlines: List[Tuple[float, int, Probe]] = []
+        self.sequence = itertools.count()
+        self.pending: Deque[Connection] = deque()
+        self.in_flight = 0
+        self.cycle_end = 0.0
+        self.spacing = 0.0
+        self.next_send = 0.0
+        self.should_stop = False
+        self.thread = threading.Thread(target=self._run, name='KeepAliveProber', daemon=True)
+
+    def start(self) -> None:
+        self.thread.start()
+
+    def stop(self, wait: bool = False) -> None:
+        """
+        :param wait: until the prober thread exited, so it no longer takes connections out of the pool.
+        """
+        self.should_stop = True
+        if wait and self.thread.is_alive():
+            self.thread.join()
+
+    def _run(self):
+        self.cycle_end = time.monotonic() + self.pool.keep_alive_interval
+        while not self.should_stop:
+            try:
+                now = time.monotonic()
+                if now >= self.cycle_end:
+                    self._start_cycle(now)
+                self._send_due_probes(now)
+                for key, _ in self.selector.select(self._wait_seconds(now)):
+                    self._on_readable(key.data)
+                self._expire_deadlines(time.monotonic())
+            except Exception as e:
+                self.logger.error('keep alive prober iteration failed', exc_info=e)
+        # connections with a probe in flight are out of the pool, their devices reconnect.
+        for key in list(self.selector.get_map().values()):
+            key.data.connection.socket.close()
+
+    def _start_cycle(self, now: float):
+        if self.pending:
+            self.logger.warning(f'{len(self.pending)} connections were not probed in the last keep alive cycle')
+        self.pending = deque(self.pool.available_connections)
+        self.cycle_end = now + self.pool.keep_alive_interval
+        # leave the last timeout of the cycle room to finish before the next snapshot.
+        self.spacing = max(self.pool.keep_alive_interval - self.pool.SOCKET_TIMEOUT_SECONDS, 0) / max(len(self.pending), 1)
+        self.next_send = now
+        self.logger.info(f'Starting keep alive cycle of {len(self.pending)} connections, one every {self.spacing:.3f}s')
+
+    def _send_due_probes(self, now: float):
+        while self.pending and self.next_send <= now and self.in_flight < KeepAliveProber.MAX_PROBES_IN_FLIGHT:
+            connection = self.pending.popleft()
+            self.next_send += self.spacing
+            # connections handed out since the snapshot belong to their tunnel now.
+            idle_since = self.pool.take_for_probe(connection)
+            if idle_since is None:
+                continue
+            probe = Probe(connection, idle_since)
+            try:
+                self.selector.register(connection.socket, selectors.EVENT_READ, probe)
+            except (ValueError, OSError):
+                self._finish(probe, False)
+                continue
+            self.in_flight += 1
+            PROBES_IN_FLIGHT.inc()
+            self._send(probe, now)
+
+    def _send(self, probe: Probe, now: float):
+        probe.attempts += 1
+        probe.awaiting_response = True
+        probe.sent_at = now
+        self._set_deadline(probe, now + self.pool.SOCKET_TIMEOUT_SECONDS)
+        try:
+            if probe.connection.socket.send(self.keep_alive, socket.MSG_DONTWAIT) != len(self.keep_alive):
+                self._finish(probe, False)
+        except BlockingIOError:
+            # the send buffer is full, the attempt times out like a lost packet.
+            pass
+        except OSError:
+            self._finish(probe, False)
+
+    def _on_readable(self, probe: Probe):
+        try:
+            data = probe.connection.socket.recv(len(self.keep_alive) - len(probe.received), socket.MSG_DONTWAIT)
+        except BlockingIOError:
+            return
+        except OSError:
+            self._finish(probe, False)
+            return
+        if not data:
+            self._finish(probe, False)
+            return
+        probe.received += data
+        if len(probe.received) < len(self.keep_alive):
+            return
+        if probe.received == self.keep_alive:
+            self.pool.peer_scores.record_rtt(probe.connection.device_id, time.monotonic() - probe.sent_at, PROBE)
+            self._finish(probe, self.pool.is_tcp_state_ok(probe.connection))
+            return
+        if probe.received == self.wifi_warn:
+            self.logger.error("Wifi connection has been detected")
+        elif probe.received == self.debugger_warn:
+            self.logger.error("Debugger connection has been detected")
+        else:
+            self.logger.error("Protocol Anomalies alert: receive unexpected response: {0}".format(probe.received.hex()))
+        self._finish(probe, False)
+
+    def _expire_deadlines(self, now: float):
+        while self.deadlines and self.deadlines[0][0] <= now:
+            deadline, _, probe = heapq.heappop(self.deadlines)
+            if deadline != probe.deadline:
+                continue
+            if not probe.awaiting_response:
+                self._send(probe, now)
+            elif probe.attempts < self.pool.KEEP_ALIVE_ATTEMPTS:
+                # a late echo still counts while waiting to resend.
+                probe.awaiting_response = False
+                self.pool.peer_scores.record_failure(probe.connection.device_id, PROBE)
+                self._set_deadline(probe, now + self.pool.SLEEP_TIME_BETWEEN_KEEP_ALIVE_PACKETS)
+            else:
+                self._finish(probe, False)
+
+    def _set_deadline(self, probe: Probe, deadline: float):
+        probe.deadline = deadline
+        heapq.heappush(self.deadlines, (deadline, next(self.sequence), probe))
+
+    def _finish(self, probe: Probe, alive: bool):
+        if probe.deadline == -1:
+            return
+        probe.deadline = -1
+        try:
+            self.selector.unregister(probe.connection.socket)
+            self.in_flight -= 1
+            PROBES_IN_FLIGHT.dec()
+        except (KeyError, ValueError):
+            pass
+        PROBES.labels('alive' if alive else 'dead').inc()
+        if not alive:
+            self.pool.peer_scores.record_failure(probe.connection.device_id, PROBE)
+        self.pool.probe_finished(probe.connection, probe.idle_since, alive)
+
+    def _wait_seconds(self, now: float) -> float:
+        wake_up = min(now + KeepAliveProber.MAX_WAIT_SECONDS, self.cycle_end)
+        if self.pending and self.in_flight < KeepAliveProber.MAX_PROBES_IN_FLIGHT:
+            wake_up = min(wake_up, self.next_send)
+        if self.deadlines:
+            wake_up = min(wake_up, self.deadlines[0][0])
+        return max(wake_up - now, 0)
@@ -1,36 +1,149 @@
 import os
+import socket
+import sys
+import threading
+import time
+from collections import Counter
+from typing import Optional
 
 from infrastructure.wrappers.fcm import Fcm
 from infrastructure.wrappers.infra_logger import Logger
 
+from capacity_gossip import CapacityDirectory, CapacityGossip, EXPIRY_INTERVALS, follow_directory
 from connection_pool import ConnectionPool
+from data_classes.worker_report import WorkerReport
 from database import Database
 from config import config
 from frontend_server import FrontendServer
+from graceful_restart import GracefulRestart, take_over
 from offline_device_handler import OfflineDeviceHandler
 from peer_server import PeerServer
 from periodic_tasks import PeriodicTasks
 from super_proxy import SuperProxy
+from async_super_proxy import AsyncSuperProxy
+from utils import utils
+from utils.metrics import REGISTRY
+from worker_supervisor import WorkerSupervisor
 
+PROXY_ENGINES = {'selectors': SuperProxy, 'asyncio': AsyncSuperProxy}
 
-def run(conf):
+
+def run(conf, takeover: bool = False):
+    """
+    :param takeover: take the idle connections of the running process over, see graceful_restart.
+    """
     logger = Logger("Main")
     logger.info(f'Running backend in {os.getcwd()}')
+    check_engine(conf)
+    if not takeover:
+        check_ports_free(conf)
+    if conf.get('worker_processes', 1) > 1:
+        run_supervisor(conf)
+        return
     db: Database = Database(conf['db_host'], conf['db_name'])
     connection_pool: ConnectionPool = ConnectionPool()
     fcm_wrapper: Fcm = Fcm(conf['fcm_api_key'])
     offline_device_handler: OfflineDeviceHandler = OfflineDeviceHandler(db, fcm_wrapper)
     peer_server: PeerServer = PeerServer(db, conf['peer_server_port'], connection_pool)
     peer_server.start()
-    super_proxy: SuperProxy = SuperProxy(conf['country_to_port'], connection_pool, db)
+    capacity_directory = start_capacity_gossip(conf, connection_pool)
+    super_proxy: SuperProxy = PROXY_ENGINES[conf.get('proxy_engine', 'selectors')](conf['country_to_port'], connection_pool, db,
+                                                                                   capacity_directory=capacity_directory)
+    if conf.get('graceful_restart_enabled', False):
+        if takeover:
+            take_over(conf['graceful_restart_socket_path'], connection_pool)
+        GracefulRestart(conf['graceful_restart_socket_path'], connection_pool, peer_server, super_proxy,
+                        conf['graceful_restart_drain_seconds'], lambda: os._exit(0)).start()
     tasks: PeriodicTasks = PeriodicTasks(db)
     tasks.start()
-    frontend: FrontendServer = FrontendServer(conf['frontend_port'], connection_pool, offline_device_handler, super_proxy, conf['country_to_port'])
+    frontend: FrontendServer = FrontendServer(conf['frontend_port'], connection_pool, offline_device_handler, super_proxy, conf['country_to_port'],
+                                              peer_server, capacity_directory)
     frontend.start()
     peer_server.stop()
     super_proxy.shutdown()
     connection_pool.close_all_connections()
 
 
+def check_engine(conf):
+    """
+    Only the selectors engine speaks the mux protocol. The asyncio engine would relay the frames of a mux device as raw bytes.
+    """
+    if conf.get('proxy_engine', 'selectors') == 'asyncio' and conf.get('mux_enabled'):
+        print("proxy_engine 'asyncio' doesn't support mux_enabled, disable one of them. Exiting")
+        sys.exit(1)
+
+
+def check_ports_free(conf):
+    """
+    With SO_REUSEPORT a second process binds the ports of a running one without an error, and the kernel splits the devices
+    and clients between them. Only a process started with --takeover may share the ports.
+    """
+    if not utils.reuse_port():
+        return
+    busy = utils.ports_in_use([conf['peer_server_port'], conf['frontend_port'], *conf['country_to_port'].values()])
+    if busy:
+        print(f'ports {busy} are already in use, start with --takeover to replace the running process. Exiting')
+        sys.exit(1)
+
+
+def run_supervisor(conf):
+    """
+    Start conf['worker_processes'] workers that share the country ports and the peer port with SO_REUSEPORT.
+    Periodic tasks and the frontend run only in the supervisor, which aggregates the workers' reports.
+    """
+    supervisor: WorkerSupervisor = WorkerSupervisor(run_worker, conf, conf['worker_processes'])
+    capacity_directory = start_capacity_gossip(conf, supervisor)
+    supervisor.start(capacity_directory)
+    db: Database = Database(conf['db_host'], conf['db_name'])
+    offline_device_handler: OfflineDeviceHandler = OfflineDeviceHandler(db, Fcm(conf['fcm_api_key']))
+    tasks: PeriodicTasks = PeriodicTasks(db)
+    tasks.start()
+    # The supervisor answers the pool and proxy queries FrontendServer makes, summed over all workers.
+    frontend: FrontendServer = FrontendServer(conf['frontend_port'], supervisor, offline_device_handler, supervisor, conf['country_to_port'],
+                                              capacity_directory=capacity_directory)
+    frontend.start()
+    supervisor.stop()
+
+
+def start_capacity_gossip(conf, pool) -> Optional[CapacityDirectory]:
+    """
+    Share the capacity of pool with the nodes in conf['cluster_neighbours'].
+    :return: the capacity of the cluster, None if there are no neighbours.
+    """
+    if not conf.get('cluster_neighbours'):
+        return None
+    neighbours = [(host, int(port)) for host, port in (neighbour.rsplit(':', 1) for neighbour in conf['cluster_neighbours'])]
+    gossip = CapacityGossip(pool, conf.get('cluster_node_address') or socket.gethostname(), conf['cluster_gossip_port'], neighbours,
+                            conf['country_to_port'], conf['cluster_gossip_interval_seconds'], conf['cluster_gossip_secret'])
+    gossip.start()
+    return gossip.directory
+
+
+def run_worker(conf, report_queue, capacity_queue):
+    """
+    Gossip runs in the supervisor only, the worker's SuperProxy reads a copy of its directory kept up to date from capacity_queue.
+    """
+    logger = Logger("Worker")
+    logger.info(f'Worker {os.getpid()} is starting')
+    db: Database = Database(conf['db_host'], conf['db_name'])
+    connection_pool: ConnectionPool = ConnectionPool()
+    peer_server: PeerServer = PeerServer(db, conf['peer_server_port'], connection_pool)
+    peer_server.start()
+    capacity_directory = None
+    if conf.get('cluster_neighbours'):
+        capacity_directory = CapacityDirectory(f'worker-{os.getpid()}', conf['cluster_gossip_interval_seconds'] * EXPIRY_INTERVALS)
+        threading.Thread(target=follow_directory, args=(capacity_directory, capacity_queue), name='CapacityDirectory', daemon=True).start()
+    super_proxy: SuperProxy = PROXY_ENGINES[conf.get('proxy_engine', 'selectors')](conf['country_to_port'], connection_pool, db,
+                                                                                   capacity_directory=capacity_directory)
+    while True:
+        active_tunnels = Counter(country for _, country in super_proxy.get_active_sockets())
+        report_queue.put(WorkerReport(os.getpid(), dict(connection_pool.count_connections_by_country()),
+                                      connection_pool.count_connections_by_country_and_asn(),
+                                      dict(active_tunnels), connection_pool.get_all_device_ids(), super_proxy.get_buffer_pool_stats(),
+                                      {**super_proxy.get_accept_stats(), **peer_server.get_accept_stats()},
+                                      super_proxy.get_device_bandwidth(), connection_pool.get_rtt_distribution(), REGISTRY.samples()))
+        time.sleep(WorkerSupervisor.REPORT_INTERVAL_SECONDS)
+
+
 if __name__ == '__main__':
-    run(config)
+    run(config, '--takeover' in sys.argv)
@@ -0,0 +1,397 @@
+import selectors
+import struct
+from socket import socket
+from typing import Callable, Dict, List, Optional
+
+from infrastructure.wrappers.infra_logger import Logger
+
+from bandwidth_shaper import DeviceBandwidth
+from config import config
+from dataplan_tracker import Collection
+from super_proxy_plugin import SuperProxyPlugin, TunnelPlugins, ConnectionInvalid
+from utils.timer_wheel import Timer, TimerWheel
+
+MUX_PROTOCOL_VERSION = 1
+# version, frame type, stream id, payload length
+FRAME_HEADER = struct.Struct('!BBII')
+FRAME_HELLO = 0
+FRAME_OPEN = 1
+FRAME_DATA = 2
+FRAME_CLOSE = 3
+FRAME_WINDOW = 4
+HELLO_PAYLOAD = struct.Struct('!H')
+WINDOW_PAYLOAD = struct.Struct('!I')
+INITIAL_STREAM_WINDOW = 256 * 1024
+MAX_FRAME_PAYLOAD = 64 * 1024
+# Frames whose payload has a fixed size, anything else from the device is a protocol error.
+FIXED_PAYLOAD_SIZES = {FRAME_OPEN: 0, FRAME_CLOSE: 0, FRAME_WINDOW: WINDOW_PAYLOAD.size}
+SESSION_READ_SIZE = 256 * 1024
+DEFAULT_MAX_STREAMS_PER_DEVICE = 8
+
+
+def encode_frame(frame_type: int, stream_id: int, payload=b'', version: int = MUX_PROTOCOL_VERSION) -> bytes:
+    return FRAME_HEADER.pack(version, frame_type, stream_id, len(payload)) + bytes(payload)
+
+
+def encode_hello(version: int, max_streams: int) -> bytes:
+    return encode_frame(FRAME_HELLO, 0, HELLO_PAYLOAD.pack(max_streams), version)
+
+
+class MuxProtocolError(Exception):
+    pass
+
+
+class MuxStream:
+    """
+    A single client tunnel carried over a MuxSession. Plugins see the stream as the tunnel's peer side.
+    send_window is how many bytes the device still accepts on this stream.
+    consumed counts bytes delivered to the client that were not yet granted back to the device with a WINDOW frame.
+    last_activity_tick is the timer wheel tick of the last payload either way, the timers are SuperProxy's, like a Tunnel's.
+    """
+
+    def __init__(self, session: 'MuxSession', stream_id: int, yogurt_socket: socket, plugins: List[SuperProxyPlugin]):
+        self.session = session
+        self.stream_id = stream_id
+        self.yogurt_socket = yogurt_socket
+        # Plugins key tunnels by their sockets, so the stream stands in for the shared peer socket.
+        self.plugins = TunnelPlugins(plugins, yogurt_socket, self)
+        self.outgoing = bytearray()
+        self.send_window = INITIAL_STREAM_WINDOW
+        self.consumed = 0
+        self.registered_events = 0
+        self.closed = False
+        self.last_activity_tick = 0
+        self.handshake_timer: Optional[Timer] = None
+        self.idle_timer: Optional[Timer] = None
+        self.throttle_timer: Optional[Timer] = None
+
+    def __repr__(self) -> str:
+        return f'MuxStream {self.stream_id} of {self.session.device_id}'
+
+
+class MuxSession:
+    """
+    Carries many client tunnels over one long-lived device socket using framed messages:
+    OPEN and CLOSE start and end a stream, DATA carries payload and WINDOW grants the sender more credit on a stream.
+    Every stream may have INITIAL_STREAM_WINDOW bytes in flight per direction, so one slow client or stream
+    can't hog the device socket or grow buffers without bound.
+    idle_timer is set by SuperProxy while the session carries no streams.
+    Reads from clients and from the device take tokens from the device's bandwidth buckets, like a Tunnel's reads.
+    A client stream, or the whole device socket, whose bucket ran dry is not read until its throttle timer fires.
+    """
+
+    def __init__(self, peer_socket: socket, device_id: str, country_code: str, version: int, max_streams: int,
+                 selector: selectors.BaseSelector, plugins: List[SuperProxyPlugin], on_stream_closed: Callable[[MuxStream], None],
+                 on_session_closed: Callable[['MuxSession'], None], timer_wheel: Optional[TimerWheel] = None,
+                 bandwidth: Optional[DeviceBandwidth] = None):
+        """
+        :param timer_wheel: whose current tick stamps the activity of streams, and which runs the throttle timers.
+        :param bandwidth: of the device, unlimited if None. Requires timer_wheel.
+        """
+        self.logger = Logger('MuxSession', level=config['log_level'])
+        self.peer_socket = peer_socket
+        self.device_id = device_id
+        self.country_code = country_code
+        self.version = version
+        self.max_streams = max_streams
+        self.selector = selector
+        self.plugins = plugins
+        self.on_stream_closed = on_stream_closed
+        self.on_session_closed = on_session_closed
+        self.timer_wheel = timer_wheel
+        self.bandwidth = bandwidth
+        self.idle_timer: Optional[Timer] = None
+        self.throttle_timer: Optional[Timer] = None
+        self.streams: Dict[int, MuxStream] = {}
+        self.next_stream_id = 1
+        self.incoming = bytearray()
+        self.outgoing = bytearray()
+        self.high_watermark: int = config.get('tunnel_buffer_high_watermark', INITIAL_STREAM_WINDOW)
+        self.registered_events = 0
+        self.closed = False
+        self.peer_socket.setblocking(False)
+        self._update_peer_interest()
+
+    def has_capacity(self) -> bool:
+        return not self.closed and len(self.streams) < self.max_streams
+
+    def open_stream(self, yogurt_socket: socket) -> MuxStream:
+        stream_id = self.next_stream_id
+        self.next_stream_id += 1
+        yogurt_socket.setblocking(False)
+        stream = MuxStream(self, stream_id, yogurt_socket, self.plugins)
+        self._touch(stream)
+        for plugin in self.plugins:
+            plugin.register(yogurt_socket, stream, self.device_id)
+        self.streams[stream_id] = stream
+        self._send_frame(FRAME_OPEN, stream_id)
+        self._update_stream_interest(stream)
+        self.logger.debug(f'Opened {stream!r}')
+        return stream
+
+    def close_stream(self, stream: MuxStream, notify_device=True):
+        if stream.closed:
+            return
+        stream.closed = True
+        if notify_device and not self.closed:
+            self._send_frame(FRAME_CLOSE, stream.stream_id)
+        if self.timer_wheel is not None:
+            self.timer_wheel.cancel(stream.throttle_timer)
+        if stream.registered_events:
+            self.selector.unregister(stream.yogurt_socket)
+        try:
+            stream.yogurt_socket.close()
+        except OSError:
+            self.logger.error(f'Failed to close client socket of {stream!r}')
+        stream.plugins.report_byte_counts()
+        for plugin in self.plugins:
+            plugin.unregister(stream.yogurt_socket)
+        del self.streams[stream.stream_id]
+        self.on_stream_closed(stream)
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        for stream in list(self.streams.values()):
+            self.close_stream(stream, notify_device=False)
+        if self.timer_wheel is not None:
+            self.timer_wheel.cancel(self.throttle_timer)
+        if self.registered_events:
+            self.selector.unregister(self.peer_socket)
+        self.peer_socket.close()
+        self.on_session_closed(self)
+        self.logger.info(f'Closed mux session of {self.device_id}')
+
+    def _send_frame(self, frame_type: int, stream_id: int, payload=b''):
+        was_over_watermark = len(self.outgoing) >= self.high_watermark
+        self.outgoing += FRAME_HEADER.pack(self.version, frame_type, stream_id, len(payload))
+        self.outgoing += payload
+        if not was_over_watermark and len(self.outgoing) >= self.high_watermark:
+            self._update_all_stream_interests()
+        self._update_peer_interest()
+
+    def _on_peer_event(self, _, mask: int):
+        if mask & selectors.EVENT_WRITE:
+            self._flush_peer()
+        if mask & selectors.EVENT_READ and not self.closed:
+            self._read_peer()
+        if not self.closed:
+            self._update_peer_interest()
+
+    def _flush_peer(self):
+        was_over_watermark = len(self.outgoing) >= self.high_watermark
+        try:
+            while self.outgoing:
+                sent = self.peer_socket.send(self.outgoing)
+                del self.outgoing[:sent]
+        except BlockingIOError:
+            pass
+        except OSError as e:
+            self.logger.error(f'failed writing to device {self.device_id}. {e!r}')
+            self.close()
+            return
+        if was_over_watermark and len(self.outgoing) < self.high_watermark:
+            self._update_all_stream_interests()
+
+    def _read_peer(self):
+        read_size = self._allowed_read_size(Collection.DIRECTION_UPLOAD, SESSION_READ_SIZE)
+        if not read_size:
+            self.throttle_timer = self._throttle(Collection.DIRECTION_UPLOAD, self.throttle_timer, self._on_peer_throttle_timeout)
+            return
+        try:
+            data = self.peer_socket.recv(read_size)
+        except BlockingIOError:
+            return
+        except OSError as e:
+            self.logger.error(f'failed reading from device {self.device_id}. {e!r}')
+            data = b''
+        if not data:
+            self.close()
+            return
+        self._consume(Collection.DIRECTION_UPLOAD, len(data))
+        self.incoming += data
+        try:
+            self._dispatch_frames()
+        except MuxProtocolError as e:
+            self.logger.error(f'Protocol Anomalies alert: invalid mux frame from {self.device_id}. {e}')
+            self.close()
+
+    def _dispatch_frames(self):
+        offset = 0
+        view = memoryview(self.incoming)
+        try:
+            while len(view) - offset >= FRAME_HEADER.size:
+                version, frame_type, stream_id, length = FRAME_HEADER.unpack_from(view, offset)
+                if version != self.version or length > MAX_FRAME_PAYLOAD or FIXED_PAYLOAD_SIZES.get(frame_type, length) != length:
+                    raise MuxProtocolError(f'version {version}, type {frame_type}, length {length}')
+                if len(view) - offset < FRAME_HEADER.size + length:
+                    break
+                payload = view[offset + FRAME_HEADER.size:offset + FRAME_HEADER.size + length]
+                offset += FRAME_HEADER.size + length
+                try:
+                    self._handle_frame(frame_type, stream_id, payload)
+                finally:
+                    payload.release()
+                if self.closed:
+                    return
+        finally:
+            view.release()
+        del self.incoming[:offset]
+
+    def _handle_frame(self, frame_type: int, stream_id: int, payload: memoryview):
+        stream = self.streams.get(stream_id)
+        if stream is None:
+            # Frames of a stream we already closed may still be in flight.
+            return
+        if frame_type == FRAME_DATA:
+            self._deliver(stream, payload)
+        elif frame_type == FRAME_WINDOW:
+            stream.send_window += WINDOW_PAYLOAD.unpack(payload)[0]
+            self._update_stream_interest(stream)
+        elif frame_type == FRAME_CLOSE:
+            self.close_stream(stream, notify_device=False)
+        else:
+            raise MuxProtocolError(f'unexpected frame type {frame_type}')
+
+    def _deliver(self, stream: MuxStream, payload: memoryview):
+        if len(stream.outgoing) + len(payload) > INITIAL_STREAM_WINDOW:
+            raise MuxProtocolError(f'{stream!r} exceeded its window')
+        if not self._inspect(stream, stream, stream.yogurt_socket, payload):
+            return
+        self._touch(stream)
+        stream.outgoing += payload
+        self._flush_stream(stream)
+        if not stream.closed:
+            self._update_stream_interest(stream)
+
+    def _inspect(self, stream: MuxStream, source, target, data: memoryview) -> bool:
+        try:
+            stream.plugins.packet_transmitted(source, target, data)
+            return True
+        except ConnectionInvalid as e:
+            self.logger.error("Socks socket is in invalid state. {0}".format(e))
+            self.close_stream(stream)
+            return False
+
+    def _on_stream_event(self, stream: MuxStream, mask: int):
+        if mask & selectors.EVENT_WRITE:
+            self._flush_stream(stream)
+        if mask & selectors.EVENT_READ and not stream.closed:
+            self._read_stream(stream)
+        if not stream.closed:
+            self._update_stream_interest(stream)
+
+    def _flush_stream(self, stream: MuxStream):
+        delivered = 0
+        try:
+            while stream.outgoing:
+                sent = stream.yogurt_socket.send(stream.outgoing)
+                del stream.outgoing[:sent]
+                delivered += sent
+        except BlockingIOError:
+            pass
+        except OSError as e:
+            self.logger.error(f'failed writing to client of {stream!r}. {e!r}')
+            self.close_stream(stream)
+            return
+        stream.consumed += delivered
+        if stream.consumed >= INITIAL_STREAM_WINDOW // 2:
+            self._send_frame(FRAME_WINDOW, stream.stream_id, WINDOW_PAYLOAD.pack(stream.consumed))
+            stream.consumed = 0
+
+    def _read_stream(self, stream: MuxStream):
+        read_size = self._allowed_read_size(Collection.DIRECTION_DOWNLOAD, min(stream.send_window, MAX_FRAME_PAYLOAD))
+        if not read_size:
+            stream.throttle_timer = self._throttle(Collection.DIRECTION_DOWNLOAD, stream.throttle_timer,
+                                                   lambda: self._on_stream_throttle_timeout(stream))
+            return
+        try:
+            data = stream.yogurt_socket.recv(read_size)
+        except BlockingIOError:
+            return
+        except OSError as e:
+            self.logger.error(f'failed reading from client of {stream!r}. {e!r}')
+            data = b''
+        if not data:
+            self.close_stream(stream)
+            return
+        self._consume(Collection.DIRECTION_DOWNLOAD, len(data))
+        if not self._inspect(stream, stream.yogurt_socket, stream, memoryview(data)):
+            return
+        self._touch(stream)
+        stream.send_window -= len(data)
+        self._send_frame(FRAME_DATA, stream.stream_id, data)
+
+    def _allowed_read_size(self, direction: str, read_size: int) -> int:
+        """
+        :return: read_size capped by the tokens left in the device's bucket for direction, 0 if it ran dry.
+        """
+        bucket = self.bandwidth.buckets[direction] if self.bandwidth is not None else None
+        if bucket is None:
+            return read_size
+        return max(min(read_size, bucket.available(self.timer_wheel.time())), 0)
+
+    def _consume(self, direction: str, amount: int):
+        if self.bandwidth is None:
+            return
+        now = self.timer_wheel.time()
+        bucket = self.bandwidth.buckets[direction]
+        if bucket is not None:
+            bucket.consume(amount)
+        self.bandwidth.record(direction, amount, now)
+
+    def _throttle(self, direction: str, timer: Optional[Timer], callback: Callable[[], None]) -> Timer:
+        """
+        :return: the timer that resumes reading once the bucket refilled, timer if it is already set.
+        """
+        if timer is not None:
+            return timer
+        return self.timer_wheel.schedule(self.bandwidth.buckets[direction].delay(self.timer_wheel.time()), callback)
+
+    def _on_peer_throttle_timeout(self):
+        self.throttle_timer = None
+        if not self.closed:
+            self._update_peer_interest()
+
+    def _on_stream_throttle_timeout(self, stream: MuxStream):
+        stream.throttle_timer = None
+        self._update_stream_interest(stream)
+
+    def _touch(self, stream: MuxStream):
+        if self.timer_wheel is not None:
+            stream.last_activity_tick = self.timer_wheel.current_tick
+
+    def _update_all_stream_interests(self):
+        for stream in list(self.streams.values()):
+            self._update_stream_interest(stream)
+
+    def _update_stream_interest(self, stream: MuxStream):
+        if stream.closed:
+            return
+        readable = stream.send_window > 0 and len(self.outgoing) < self.high_watermark and stream.throttle_timer is None
+        events = (selectors.EVENT_READ if readable else 0) | (selectors.EVENT_WRITE if stream.outgoing else 0)
+        stream.registered_events = self._apply_interest(stream.yogurt_socket, stream.registered_events, events,
+                                                        lambda _, mask: self._on_stream_event(stream, mask))
+
+    def _update_peer_interest(self):
+        events = (selectors.EVENT_READ if self.throttle_timer is None else 0) | (selectors.EVENT_WRITE if self.outgoing else 0)
+        self.registered_events = self._apply_interest(self.peer_socket, self.registered_events, events, self._on_peer_event)
+
+    def _apply_interest(self, sock: socket, registered: int, events: int, callback) -> int:
+        if events == registered:
+            return registered
+        if not events:
+            self.selector.unregister(sock)
+        elif not registered:
+            self.selector.register(sock, events, callback)
+        else:
+            self.selector.modify(sock, events, callback)
+        return events
+
+
+def find_session_with_capacity(sessions: List[MuxSession]) -> Optional[MuxSession]:
+    for session in sessions:
+        if session.has_capacity():
+            return session
+    return None
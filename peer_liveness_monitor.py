@@ -0,0 +1,105 @@
+import select
+import socket
+import threading
+from typing import Dict
+
+from infrastructure.wrappers.infra_logger import Logger
+
+from data_classes.connection import Connection
+from utils.metrics import REGISTRY
+
+HANGUPS = REGISTRY.counter('pool_peer_hangups_total', 'Idle pooled connections the kernel reported closed or dead', ['country'])
+
+DEFAULT_TCP_KEEPALIVE = {'idle_seconds': 60, 'interval_seconds': 15, 'count': 4, 'user_timeout_seconds': 120}
+
+
+def configure_tcp_keepalive(sock: socket.socket, idle_seconds: int, interval_seconds: int, count: int, user_timeout_seconds: int):
+    """
+    Let the kernel find dead peers: keepalive probes start after idle_seconds of silence and are sent every interval_seconds,
+    and the connection is reset after count unanswered probes, or after user_timeout_seconds of unacknowledged data.
+    """
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, idle_seconds)
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, interval_seconds)
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPCNT, count)
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_USER_TIMEOUT, user_timeout_seconds * 1000)
+
+
+class PeerLivenessMonitor:
+    """
+    Watches idle pooled connections for hang ups without sending anything to the devices.
+    Every watched socket gets tuned kernel TCP keepalive and is registered in an epoll set for EPOLLRDHUP, EPOLLHUP and EPOLLERR
+    only, so it wakes the monitor just when the device closed the connection or the kernel gave up on it.
+    The pool is told right away and drops the connection, so clients are no longer handed dead peers between keep alive rounds.
+    Sockets must be unwatched before they leave the pool, the pool does so on pop and while probing.
+    Linux only, is_supported() tells whether it can run.
+    """
+    EVENTS = select.EPOLLRDHUP | select.EPOLLHUP | select.EPOLLERR if hasattr(select, 'epoll') else 0
+    MAX_EVENTS = 1024
+
+    def __init__(self, pool, tcp_keepalive: Dict[str, int] = None) -> None:
+        self.pool = pool
+        self.tcp_keepalive = {**DEFAULT_TCP_KEEPALIVE, **(tcp_keepalive or {})}
+        self.logger = Logger('PeerLivenessMonitor')
+        self.epoll = select.epoll()
+        self.watched: Dict[int, Connection] = {}
+        self.lock = threading.Lock()
+        self.should_stop = False
+        self.thread = threading.Thread(target=self._run, name='PeerLivenessMonitor', daemon=True)
+
+    @staticmethod
+    def is_supported() -> bool:
+        return hasattr(select, 'epoll') and hasattr(socket, 'TCP_USER_TIMEOUT')
+
+    def start(self) -> None:
+        self.thread.start()
+
+    def stop(self) -> None:
+        self.should_stop = True
+
+    def watch(self, connection: Connection) -> None:
+        sock = connection.socket
+        try:
+            configure_tcp_keepalive(sock, **self.tcp_keepalive)
+        except OSError:
+            # not a TCP socket, hang ups are still reported.
+            pass
+        try:
+            fd = sock.fileno()
+            with self.lock:
+                self.epoll.register(fd, PeerLivenessMonitor.EVENTS)
+                self.watched[fd] = connection
+        except (OSError, ValueError):
+            self.logger.error(f'Failed to watch {connection!r}')
+
+    def unwatch(self, connection: Connection) -> None:
+        fd = connection.socket.fileno()
+        with self.lock:
+            if self.watched.get(fd) is not connection:
+                return
+            del self.watched[fd]
+            try:
+                self.epoll.unregister(fd)
+            except (OSError, ValueError):
+                pass
+
+    def __len__(self) -> int:
+        return len(self.watched)
+
+    def _run(self):
+        while not self.should_stop:
+            try:
+                events = self.epoll.poll(1, PeerLivenessMonitor.MAX_EVENTS)
+            except InterruptedError:
+                continue
+            for fd, _ in events:
+                with self.lock:
+                    connection = self.watched.pop(fd, None)
+                    if connection is None:
+                        continue
+                    try:
+                        self.epoll.unregister(fd)
+                    except (OSError, ValueError):
+                        pass
+                if self.pool.peer_hung_up(connection):
+                    HANGUPS.labels(connection.country_code).inc()
@@ -1,18 +1,66 @@
 import os
+import selectors
 import subprocess
+import time
 import traceback
 from concurrent.futures.thread import ThreadPoolExecutor
-from socket import socket, SOL_SOCKET, SO_REUSEADDR
-from typing import Tuple
+from socket import socket, SOL_SOCKET, SO_REUSEADDR, SO_REUSEPORT
+from typing import Dict, Optional, Set, Tuple
 from utils import utils
+from utils.accept_stats import AcceptStats
+from utils.geoip_lookup import GeoIpLookup
+from utils.metrics import REGISTRY
+from utils.timer_wheel import Timer, TimerWheel
+from config import config
 
-import geoip2.database
 from infrastructure.wrappers.infra_logger import Logger
 from infrastructure.wrappers.mongo import Mongo
 
 from data_classes.connection import Connection
 from connection_pool import ConnectionPool
 from data_classes.device_details import DeviceDetails
+from mux_session import MUX_PROTOCOL_VERSION, DEFAULT_MAX_STREAMS_PER_DEVICE, encode_hello
+
+
+ACCEPTS = REGISTRY.counter('peer_accepts_total', 'Device connections accepted on the peer port, by handshake result', ['result'])
+DEVICES_CONNECTED = REGISTRY.counter('peer_devices_connected_total', 'Devices that completed the handshake', ['country'])
+HANDSHAKE_STAGE_SECONDS = REGISTRY.histogram('peer_handshake_stage_seconds', 'Time devices spend in every stage of the handshake pipeline',
+                                             ['stage'])
+PENDING_HANDSHAKES = REGISTRY.gauge('peer_pending_handshakes', 'Devices that connected and have not sent their handshake yet')
+DB_WRITES = REGISTRY.counter('peer_db_writes_total', 'Device details written to the DB in the background, by result', ['result'])
+
+
+class PendingHandshake:
+    """
+    A device that connected to the peer port and hasn't sent its whole handshake yet.
+    timer fires at the handshake deadline, settle_timer once no more of the handshake arrived for HANDSHAKE_SETTLE_SECONDS.
+    """
+    __slots__ = ('peer_socket', 'remote_address', 'accepted_at', 'packet', 'timer', 'settle_timer')
+
+    def __init__(self, peer_socket: socket, remote_address, accepted_at: float) -> None:
+        self.peer_socket = peer_socket
+        self.remote_address = remote_address
+        self.accepted_at = accepted_at
+        self.packet = bytearray()
+        self.timer: Optional[Timer] = None
+        self.settle_timer: Optional[Timer] = None
+
+
+class PendingHello:
+    """
+    A device that sent its handshake and agreed on a mux version, waiting for the socket to take the rest of its HELLO.
+    """
+    __slots__ = ('peer_socket', 'remote_address', 'data', 'device_details', 'mux_version', 'enriched_at', 'timer')
+
+    def __init__(self, peer_socket: socket, remote_address, data: bytes, device_details: DeviceDetails, mux_version: int,
+                 enriched_at: float) -> None:
+        self.peer_socket = peer_socket
+        self.remote_address = remote_address
+        self.data = bytearray(data)
+        self.device_details = device_details
+        self.mux_version = mux_version
+        self.enriched_at = enriched_at
+        self.timer: Optional[Timer] = None
 
 
 class PeerServer:
@@ -21,11 +69,26 @@ class PeerServer:
     The server create sockets and bind them to configuration port and listen for new connection.
     Once we have new connection the server extract ASN and country code from it remote address.
     Handle and manage the exfilitrate data from the device and save the connection at Connection Pool and at the DB.
+    Devices go through a pipeline that never blocks the listening thread: accepted sockets are non blocking and wait in the
+    selector for their handshake, up to peer_handshake_timeout_seconds, which may arrive in several segments. The handshake is enriched with the device's country and
+    ASN, a device that agreed on a mux version gets its HELLO through the selector too, the connection is inserted into the pool, and the device details are written to the DB by a background writer,
+    one at a time so the writes of a device keep their order. A silent device or a slow DB only delays itself.
+    The time spent in every stage is reported by peer_handshake_stage_seconds:
+    read - accept to handshake received. enrich - GeoIP lookups and parsing. pool - sending the HELLO and pool insert.
+    db_queue - waiting for the DB writer. db - the DB write.
     """
     FCM_ID_LENGTH = 250
     IMEI_LENGTH = 32
     APP_VERSION = 4
-    MAX_BACKLOG_CONNECTIONS = 1
+    MUX_VERSION = 2
+    MAX_BACKLOG_CONNECTIONS = 1024
+    MAX_ACCEPTS_PER_WAKEUP = 256
+    ACCEPT_POLL_SECONDS = 1
+    HANDSHAKE_TICK_SECONDS = 0.1
+    DEFAULT_HANDSHAKE_TIMEOUT_SECONDS = 10
+    # the handshake has no terminator, one without the mux version field is complete once no more of it arrived for this long.
+    HANDSHAKE_SETTLE_SECONDS = 0.2
+    HANDSHAKE_FIELDS = 4
     LISTENING_PORTS_LEN = 100
     GEO_IP_DIR = os.getcwd() + '/geoip/' if 'test' not in os.getcwd() else \
         os.path.join(os.path.abspath(os.path.join(os.getcwd(), '..')), 'geoip/')
@@ -34,22 +97,43 @@ class PeerServer:
     COUNTRY_DB_PATH = GEO_IP_DIR + 'GeoLite2-Country.mmdb'
     NOT_AVAILABLE = "N/A"
     MAX_WORKERS = 1
+    DB_WORKERS = 1
+    HANDSHAKE_PACKET_SIZE = IMEI_LENGTH + FCM_ID_LENGTH + APP_VERSION + MUX_VERSION + 3
 
     def __init__(self, db: Mongo, listening_port: int, connection_pool: ConnectionPool) -> None:
         self.should_stop: bool = False
         self.listening_port: int = listening_port
         self.thread_pool = ThreadPoolExecutor(max_workers=PeerServer.MAX_WORKERS)
+        self.db_writer = ThreadPoolExecutor(max_workers=PeerServer.DB_WORKERS, thread_name_prefix='PeerServerDB')
         self.connection_pool: ConnectionPool = connection_pool
         self.db = db
         self.logger = Logger("PeerServer")
+        self.accept_stats = AcceptStats()
+        self.handshake_timeout: float = config.get('peer_handshake_timeout_seconds', PeerServer.DEFAULT_HANDSHAKE_TIMEOUT_SECONDS)
+        self.timer_wheel = TimerWheel(PeerServer.HANDSHAKE_TICK_SECONDS, time.monotonic())
+        self.selector = selectors.DefaultSelector()
+        self.pending_handshakes: Set[PendingHandshake] = set()
+        self.pending_hellos: Set[PendingHello] = set()
+        PENDING_HANDSHAKES.set_function(lambda: len(self.pending_handshakes))
         self._check_geoip_db([PeerServer.ASN_DB_PATH, PeerServer.CITY_DB_PATH, PeerServer.COUNTRY_DB_PATH])
+        self.geoip = GeoIpLookup(PeerServer.ASN_DB_PATH, PeerServer.CITY_DB_PATH, **config.get('geoip_lookup', {}))
 
     def start(self) -> None:
+        self.geoip.start()
         self.thread_pool.submit(self._listen, self.listening_port)
 
-    def stop(self):
+    def stop(self, wait: bool = False):
+        """
+        :param wait: until the listening socket is closed, the devices that sent their handshake are in the pool and their
+        details are written to the DB. Devices still expected to send their handshake are disconnected.
+        """
         self.should_stop = True
-        self.thread_pool.shutdown(False)
+        self.geoip.stop()
+        self.thread_pool.shutdown(wait)
+        self.db_writer.shutdown(wait)
+
+    def get_accept_stats(self) -> Dict[str, Dict[str, int]]:
+        return {'peer_port': self.accept_stats.as_dict()}
 
     def _check_connection(self, ip) -> bool:
         """
@@ -67,29 +151,133 @@ class PeerServer:
         """
         server_socket = socket()
         server_socket.setsockopt(SOL_SOCKET, SO_REUSEADDR, 1)
+        if utils.reuse_port():
+            server_socket.setsockopt(SOL_SOCKET, SO_REUSEPORT, 1)
         server_socket.bind(('0.0.0.0', port))
-        server_socket.listen(PeerServer.MAX_BACKLOG_CONNECTIONS)
+        server_socket.listen(config.get('peer_server_backlog', PeerServer.MAX_BACKLOG_CONNECTIONS))
+        server_socket.setblocking(False)
+        self.selector.register(server_socket, selectors.EVENT_READ)
+        self.logger.debug(f'listening for peers on port {port}')
         while not self.should_stop:
-            self.logger.debug(f'listening for peers on port {port}')
-            peer_socket, remote_address = server_socket.accept()
+            pending = self.pending_handshakes or self.pending_hellos
+            timeout = PeerServer.HANDSHAKE_TICK_SECONDS if pending else PeerServer.ACCEPT_POLL_SECONDS
+            for key, _ in self.selector.select(timeout):
+                if key.data is None:
+                    self._accept_pending_peers(server_socket)
+                else:
+                    key.data()
+            self.timer_wheel.advance(time.monotonic())
+        for handshake in list(self.pending_handshakes):
+            self._end_handshake(handshake)
+            handshake.peer_socket.close()
+        for hello in list(self.pending_hellos):
+            self._end_hello(hello)
+            hello.peer_socket.close()
+        self.selector.close()
+        server_socket.close()
+
+    def _accept_pending_peers(self, server_socket: socket) -> None:
+        """
+        Accept every pending device, up to MAX_ACCEPTS_PER_WAKEUP, so a reconnect storm drains the accept queue quickly.
+        Accepted devices wait in the selector for their handshake.
+        :param server_socket: non blocking listening socket.
+        :return: None
+        """
+        self.accept_stats.record_queue(server_socket)
+        accepted = 0
+        while accepted < PeerServer.MAX_ACCEPTS_PER_WAKEUP:
+            try:
+                peer_socket, remote_address = server_socket.accept()
+            except BlockingIOError:
+                break
+            accepted += 1
+            peer_socket.setblocking(False)
             if self._check_connection(remote_address):
                 self.logger.info(f'Received new connection from {remote_address}')
-                try:
-                    self._handle_new_connection(peer_socket, remote_address)
-                except Exception as e:
-                    self.logger.error("exception raised while parsing or saving new connection: ", exc_info=e)
-                    peer_socket.close()
+                self._await_handshake(peer_socket, remote_address)
             else:
                 self.logger.error(f'Invalid connection from {remote_address}')
+                peer_socket.close()
+                ACCEPTS.labels('rejected').inc()
+        self.accept_stats.record_batch(accepted)
+
+    def _await_handshake(self, peer_socket: socket, remote_address) -> None:
+        handshake = PendingHandshake(peer_socket, remote_address, time.monotonic())
+        handshake.timer = self.timer_wheel.schedule(self.handshake_timeout, lambda: self._on_handshake_timeout(handshake))
+        self.selector.register(peer_socket, selectors.EVENT_READ, lambda: self._receive_handshake(handshake))
+        self.pending_handshakes.add(handshake)
+
+    def _end_handshake(self, handshake: PendingHandshake) -> None:
+        self.timer_wheel.cancel(handshake.timer)
+        self.timer_wheel.cancel(handshake.settle_timer)
+        self.selector.unregister(handshake.peer_socket)
+        self.pending_handshakes.discard(handshake)
+
+    def _on_handshake_timeout(self, handshake: PendingHandshake) -> None:
+        # both timers of a handshake may fire on the same tick.
+        if handshake not in self.pending_handshakes:
+            return
+        if handshake.packet:
+            self._complete_handshake(handshake)
+            return
+        self._end_handshake(handshake)
+        handshake.peer_socket.close()
+        self.logger.info(f'{handshake.remote_address} did not send its handshake within {self.handshake_timeout} seconds')
+        ACCEPTS.labels('timeout').inc()
+
+    def _receive_handshake(self, handshake: PendingHandshake) -> None:
+        """
+        Collect the handshake until its last field, the mux version, or HANDSHAKE_PACKET_SIZE bytes arrived. Devices that
+        don't send the mux version are done once no more arrived for HANDSHAKE_SETTLE_SECONDS, or the handshake deadline passed.
+        :param handshake: device whose socket is readable.
+        :return: None
+        """
+        try:
+            chunk: bytes = handshake.peer_socket.recv(PeerServer.HANDSHAKE_PACKET_SIZE - len(handshake.packet))
+        except BlockingIOError:
+            return
+        except OSError as e:
+            chunk = b''
+            self.logger.debug(f'{handshake.remote_address} failed before its handshake. {e!r}')
+        if not chunk:
+            self._end_handshake(handshake)
+            self.logger.info(f'{handshake.remote_address} disconnected before its handshake')
+            handshake.peer_socket.close()
+            ACCEPTS.labels('failed').inc()
+            return
+        handshake.packet += chunk
+        fields = handshake.packet.split(b',', PeerServer.HANDSHAKE_FIELDS - 1)
+        if len(handshake.packet) >= PeerServer.HANDSHAKE_PACKET_SIZE or (len(fields) == PeerServer.HANDSHAKE_FIELDS and fields[-1]):
+            self._complete_handshake(handshake)
+            return
+        self.timer_wheel.cancel(handshake.settle_timer)
+        handshake.settle_timer = self.timer_wheel.schedule(PeerServer.HANDSHAKE_SETTLE_SECONDS, lambda: self._on_handshake_settled(handshake))
+
+    def _on_handshake_settled(self, handshake: PendingHandshake) -> None:
+        if handshake in self.pending_handshakes:
+            self._complete_handshake(handshake)
 
-    def _handle_new_connection(self, peer_socket, remote_address):
+    def _complete_handshake(self, handshake: PendingHandshake) -> None:
+        self._end_handshake(handshake)
+        HANDSHAKE_STAGE_SECONDS.labels('read').observe(time.monotonic() - handshake.accepted_at)
+        try:
+            self._handle_new_connection(handshake.peer_socket, handshake.remote_address, bytes(handshake.packet))
+        except Exception as e:
+            self.logger.error("exception raised while parsing or saving new connection: ", exc_info=e)
+            handshake.peer_socket.close()
+            ACCEPTS.labels('failed').inc()
+
+    def _handle_new_connection(self, peer_socket, remote_address, packet: bytes):
         """
         Handle and mange new connection to backend.
-        Extract country and asn from remote address and save the connection at ConnectionPool and at the DB.
+        Extract country and asn from remote address, send the HELLO if the device multiplexes, save the connection at
+        ConnectionPool and queue the DB write.
         :param peer_socket: output socket.
         :param remote_address: source ip.
+        :param packet: handshake the device sent.
         :return:
         """
+        started = time.monotonic()
         try:
             country, asn = self._ip_to_cc_asn(remote_address[0])
         except Exception as e:
@@ -97,42 +285,132 @@ class PeerServer:
             country = PeerServer.NOT_AVAILABLE
             asn = PeerServer.NOT_AVAILABLE
         try:
-            device_details: DeviceDetails = self._create_device_details(peer_socket, country, asn, remote_address)
+            device_details: DeviceDetails = self._create_device_details(packet, country, asn, remote_address)
         except ValueError as e:
             self.logger.error('First packet should be in the form of IMEI, FCM_ID, APP_VERSION', exc_info=e)
             raise e
-        self._save_connection_in_pool(peer_socket, country, asn, device_details.imei)
-        if not self._update_db(device_details):
-            error_msg = "Failed to update data with device_details"
-            self.logger.error(error_msg)
-            raise Exception(error_msg)
+        enriched = time.monotonic()
+        HANDSHAKE_STAGE_SECONDS.labels('enrich').observe(enriched - started)
+        mux_version = self._negotiate_mux(device_details.mux_version)
+        if not mux_version:
+            self._pool_connection(peer_socket, device_details, mux_version, enriched)
+            return
+        hello = encode_hello(mux_version, config.get('mux_max_streams_per_device', DEFAULT_MAX_STREAMS_PER_DEVICE))
+        self._send_hello(PendingHello(peer_socket, remote_address, hello, device_details, mux_version, enriched))
+
+    def _send_hello(self, hello: PendingHello) -> None:
+        """
+        Write as much of the HELLO as the non blocking socket takes, the rest once the selector finds it writable.
+        The connection is pooled once the whole HELLO went out.
+        :raise OSError: if the device can't be written to.
+        """
+        try:
+            while hello.data:
+                sent = hello.peer_socket.send(hello.data)
+                del hello.data[:sent]
+        except BlockingIOError:
+            self._await_hello(hello)
+            return
+        except OSError:
+            self._end_hello(hello)
+            raise
+        self._end_hello(hello)
+        self._pool_connection(hello.peer_socket, hello.device_details, hello.mux_version, hello.enriched_at)
+
+    def _await_hello(self, hello: PendingHello) -> None:
+        if hello in self.pending_hellos:
+            return
+        hello.timer = self.timer_wheel.schedule(self.handshake_timeout, lambda: self._on_hello_timeout(hello))
+        self.selector.register(hello.peer_socket, selectors.EVENT_WRITE, lambda: self._on_hello_writable(hello))
+        self.pending_hellos.add(hello)
+
+    def _end_hello(self, hello: PendingHello) -> None:
+        if hello not in self.pending_hellos:
+            return
+        self.timer_wheel.cancel(hello.timer)
+        self.selector.unregister(hello.peer_socket)
+        self.pending_hellos.discard(hello)
+
+    def _on_hello_writable(self, hello: PendingHello) -> None:
+        try:
+            self._send_hello(hello)
+        except Exception as e:
+            self.logger.error("exception raised while saving new connection: ", exc_info=e)
+            hello.peer_socket.close()
+            ACCEPTS.labels('failed').inc()
+
+    def _on_hello_timeout(self, hello: PendingHello) -> None:
+        self._end_hello(hello)
+        hello.peer_socket.close()
+        self.logger.info(f'{hello.remote_address} did not take its HELLO within {self.handshake_timeout} seconds')
+        ACCEPTS.labels('timeout').inc()
 
-    def _save_connection_in_pool(self, peer_socket: socket, country, asn, device_id):
+    def _pool_connection(self, peer_socket: socket, device_details: DeviceDetails, mux_version: int, enriched: float) -> None:
+        # the pool and its keep alive prober use connections in blocking mode, with temporary timeouts.
+        peer_socket.setblocking(True)
+        self._save_connection_in_pool(peer_socket, device_details.country_code, device_details.asn, device_details.imei, mux_version)
+        queued = time.monotonic()
+        HANDSHAKE_STAGE_SECONDS.labels('pool').observe(queued - enriched)
+        self.db_writer.submit(self._write_device_details, device_details, queued)
+        ACCEPTS.labels('ok').inc()
+
+    def _write_device_details(self, device_details: DeviceDetails, queued: float) -> None:
+        """
+        Runs on the DB writer. A failed write is logged, the device stays in the pool.
+        :param queued: time the write was queued at.
+        """
+        started = time.monotonic()
+        HANDSHAKE_STAGE_SECONDS.labels('db_queue').observe(started - queued)
+        try:
+            written = self._update_db(device_details)
+            if not written:
+                self.logger.error("Failed to update data with device_details")
+        except Exception as e:
+            self.logger.error(f'Failed to update data with device_details of {device_details.imei}', exc_info=e)
+            written = False
+        HANDSHAKE_STAGE_SECONDS.labels('db').observe(time.monotonic() - started)
+        DB_WRITES.labels('ok' if written else 'failed').inc()
+
+    @staticmethod
+    def _negotiate_mux(device_mux_version: int) -> int:
+        """
+        Devices that support multiplexing advertise their highest framing protocol version in the handshake.
+        If multiplexing is enabled, they are answered with a HELLO frame holding the agreed version and the maximum
+        number of concurrent streams. Until the first OPEN frame the device keeps answering keep alive packets as before.
+        :param device_mux_version: highest version the device supports, 0 if it doesn't.
+        :return: agreed version, 0 if the connection carries a single tunnel.
+        """
+        if not config.get('mux_enabled') or not device_mux_version:
+            return 0
+        return min(device_mux_version, MUX_PROTOCOL_VERSION)
+
+    def _save_connection_in_pool(self, peer_socket: socket, country, asn, device_id, mux_version=0):
         """
         Save new connection at ConnectionPool.
         :param peer_socket: output socket.
         :param country: country.
         :param asn: Provider.
         :param device_id: device_id.
+        :param mux_version: agreed framing protocol version, 0 if not multiplexed.
         :return:
         """
-        connection = Connection(peer_socket, country, asn, device_id)
+        connection = Connection(peer_socket, country, asn, device_id, mux_version)
         self.connection_pool.insert(connection)
+        DEVICES_CONNECTED.labels(country).inc()
 
-    def _create_device_details(self, peer_socket: socket, country_code: str, asn: str, remote_address):
-        packet_size = PeerServer.IMEI_LENGTH + PeerServer.FCM_ID_LENGTH + PeerServer.APP_VERSION + 1
+    def _create_device_details(self, packet: bytes, country_code: str, asn: str, remote_address):
         delimiter = ','
-        packet: bytes = peer_socket.recv(packet_size)
         data = packet.decode("utf-8")
         imei, *fcm_id = data.split(delimiter)
         app_version = fcm_id[1] if len(fcm_id) > 1 else "0"
+        mux_version = int(fcm_id[2]) if len(fcm_id) > 2 and fcm_id[2].isdigit() else 0
         fcm_id = fcm_id[0]
         if not utils.regex_check("all", [imei, fcm_id]):
             self.logger.error("Protocol Anomalies alert: receive unexpected Device Details:"
                               " IMEI: {0}.  FCM_ID: {1}".format(imei, fcm_id))
             raise ValueError
         return DeviceDetails(imei=imei, fcm_id=fcm_id, asn=asn, country_code=country_code,
-                             ip=remote_address, app_version=app_version)
+                             ip=remote_address, app_version=app_version, mux_version=mux_version)
 
     def _update_db(self, device_details) -> bool:
         device = self.db.find_one(DeviceDetails.COLLECTION_NAME, {DeviceDetails.IMEI: device_details.imei})
@@ -150,15 +428,8 @@ class PeerServer:
                     raise Exception("Couldn't install geoip2 data")
         return True
 
-    @staticmethod
-    def _ip_to_cc_asn(ip) -> Tuple[str, str]:
-        with geoip2.database.Reader(PeerServer.ASN_DB_PATH) as reader:
-            response = reader.asn(ip)
-            asn = response.autonomous_system_number
-        with geoip2.database.Reader(PeerServer.CITY_DB_PATH) as reader:
-            response = reader.city(ip)
-            country = response.country.iso_code
-        return country, str(asn)
+    def _ip_to_cc_asn(self, ip) -> Tuple[str, str]:
+        return self.geoip.lookup(ip)
 
     @staticmethod
     def _blacklist(ip) -> bool:
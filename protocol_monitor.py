@@ -9,6 +9,7 @@ from config import config
 from database import Database
 from super_proxy_plugin import SuperProxyPlugin, ConnectionInvalid
 from utils.dns_resolver import DnsResolver
+from utils.metrics import REGISTRY
 
 WHITELIST_DNS_RESOLUTION_INTERVAL_SECONDS = 15
 
@@ -26,6 +27,9 @@ LOGGER_NAME = "SocksMonitor"
 
 STANDARD_PORTS = [80, 443]
 
+ALERTS = REGISTRY.counter('protocol_alerts_total', 'Protocol anomalies and whitelist violations, by nagios alert', ['alert'])
+TARGETS = REGISTRY.counter('protocol_targets_total', 'Tunnels that completed SOCKS negotiation to a target')
+
 
 class SocksErrors:
     """
@@ -126,13 +130,17 @@ class ProtocolMonitor(SuperProxyPlugin):
         except KeyError:
             pass
 
-    def packet_transmitted(self, source: socket, target: socket, data: bytes):
+    def packet_transmitted(self, source: socket, target: socket, data: memoryview):
         connection = self.socket_to_connection[source]
         if not self._is_packet_expected_from_this_socket(connection, source):
             self._state_invalid(SocksErrors.ERROR_PACKET_NOT_EXPECTED, connection)
         self._verify_data_is_valid_for_current_state(connection, data, source)
         self._transition_to_next_step(connection)
 
+    def needs_packet_inspection(self, any_socket: socket) -> bool:
+        connection = self.socket_to_connection.get(any_socket)
+        return connection is None or connection.state != ConnectionState.CONNECTION_COMPLETE
+
     def _transition_to_next_step(self, connection):
         new_state = self.state_transitions.get(connection.state.value)
         if new_state is None:
@@ -212,13 +220,17 @@ class ProtocolMonitor(SuperProxyPlugin):
         port = int.from_bytes(data[-2:], ProtocolMonitor.BIG_ENDIAN_BYTE_ORDER)
         self._process_new_target(connection, ip, port)
 
+    @staticmethod
+    def _as_text(data) -> str:
+        return bytes(data).decode('latin-1')
+
     @staticmethod
     def _https_validate_connect(data, *_):
-        if not str(data).startswith(HTTPS_CONNECT_METHOD):
+        if not ProtocolMonitor._as_text(data).startswith(HTTPS_CONNECT_METHOD):
             return SocksErrors.NOT_CONNECT
 
     def _https_validate_target(self, data, connection, *_):
-        connect_string = str(data)
+        connect_string = self._as_text(data)
         matches = re.search(r"(\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3}):(\d+)", connect_string)
         ip = matches[1]
         port = matches[2]
@@ -227,6 +239,7 @@ class ProtocolMonitor(SuperProxyPlugin):
     def _process_new_target(self, connection, ip, port):
         connection.target_ip = ip
         self.connected_services.add(ip)
+        TARGETS.inc()
         self.logger.info(f'Socks connection to a new IP. {connection} --> {ip}')
         self._validate_ip_is_in_whitelist(ip, connection)
         self.db.insert_one(CloudConnectionsCollection.COLLECTION_NAME, {CloudConnectionsCollection.FIELD_TARGET_IP: ip,
@@ -234,6 +247,7 @@ class ProtocolMonitor(SuperProxyPlugin):
                                                                         CloudConnectionsCollection.FIELD_DEVICE_ID: connection.peer_id})
 
     def _state_invalid(self, state_msg: str, connection: Connection, alert_type=NAGIOS_ALERT_PROTOCOL_ANOMALY):
+        ALERTS.labels(alert_type).inc()
         error_msg = alert_type + f" - invalid state occurred on {connection!r}"
         self.logger.error(error_msg + " " + state_msg)
         raise ConnectionInvalid(error_msg)
@@ -245,4 +259,5 @@ class ProtocolMonitor(SuperProxyPlugin):
         if not config.get(CONFIG_WHITELIST_FEATURE_FLAG) or not config.get(CONFIG_SERVICE_WHITELIST):
             return
         if not self.dns_resolver.check_ips_subnet_exists(ip):
+            ALERTS.labels(NAGIOS_ALERT_IP_NOT_IN_WHITELIST).inc()
             self._state_warn(SocksErrors.IP_NOT_IN_WHITELIST, connection, NAGIOS_ALERT_IP_NOT_IN_WHITELIST)
@@ -1,39 +1,103 @@
 import selectors
 import sys, errno
+import time
+from collections import defaultdict
 from concurrent.futures.thread import ThreadPoolExecutor
-from socket import socket, SOL_SOCKET, SO_REUSEADDR
+from socket import socket, SOL_SOCKET, SO_REUSEADDR, SO_REUSEPORT
 from threading import Lock
-from typing import Dict, List, Tuple
+from typing import Callable, Dict, List, Optional, Tuple, Union
 from config import config
 
 from infrastructure.wrappers.infra_logger import Logger
 
+from bandwidth_shaper import BandwidthShaper, DIRECTIONS
+from capacity_gossip import CapacityDirectory
 from connection_pool import ConnectionPool
 from database import Database
 from dataplan_tracker import DataplanTracker
 from protocol_monitor import ProtocolMonitor
-from super_proxy_plugin import ConnectionInvalid
+from super_proxy_plugin import ConnectionInvalid, TunnelPlugins
 from utils.no_available_connection_exception import NoAvailableConnection
 from data_classes.connection import Connection
+from data_classes.tunnel import Tunnel, DEFAULT_HIGH_WATERMARK, DEFAULT_LOW_WATERMARK, MIN_READ_SIZE, MAX_READ_SIZE
+from utils.accept_stats import AcceptStats
+from utils.buffer_pool import BufferPool
+from mux_session import MuxSession, MuxStream, find_session_with_capacity, DEFAULT_MAX_STREAMS_PER_DEVICE
+from utils.splice_relay import SpliceRelay
+from utils.hot_path_logger import HotPathLogger
+from utils.loop_monitor import LoopMonitor
+from utils.metrics import REGISTRY
+from utils.peer_scores import TunnelSetupTimer
+from utils.timer_wheel import TimerWheel
+from utils.utils import reuse_port
 
-SOCKET_READ_SIZE = 1024
 CLOSING_PACKET = b'9TS0JUUL8HARDIP8JS9LFMH1UIRECWOQX109KF' \
                  b'1GZFUV6N4RH68QM5SFDL1I6ORGDZ071OA85460HGY' \
                  b'T8M2K134Y367XRAE5FDSU8YSUA09DQMO7KI61VIL6' \
                  b'45DYCXE3'
-MAX_BACKLOG_CONNECTIONS_PER_COUNTRY = 10
+MAX_BACKLOG_CONNECTIONS_PER_COUNTRY = 1024
+MAX_ACCEPTS_PER_WAKEUP = 256
+# Fine enough to pace throttled tunnels smoothly.
+TIMER_TICK_SECONDS = 0.1
+DEFAULT_HANDSHAKE_TIMEOUT_SECONDS = 30
+DEFAULT_IDLE_TIMEOUT_SECONDS = 600
+DEFAULT_CLOSE_DRAIN_SECONDS = 5
+DEFAULT_LOOP_LAG_SHED_SECONDS = 0.25
+DEFAULT_LOOP_LAG_RECOVER_SECONDS = 0.05
+DEFAULT_SLOW_CALLBACK_SECONDS = 0.05
+SLOW_CALLBACKS_REPORT_INTERVAL_SECONDS = 60
+
+ACCEPTS = REGISTRY.counter('superproxy_accepts_total', 'Clients accepted on country ports', ['country'])
+TUNNELS_OPENED = REGISTRY.counter('superproxy_tunnels_opened_total', 'Tunnels opened, including mux streams', ['country'])
+TUNNELS_CLOSED = REGISTRY.counter('superproxy_tunnels_closed_total', 'Tunnels closed, including mux streams', ['country'])
+TUNNEL_TIMEOUTS = REGISTRY.counter('superproxy_tunnel_timeouts_total', 'Tunnels closed by a timeout', ['timeout'])
+BYTES_RELAYED = REGISTRY.counter('superproxy_bytes_relayed_total', 'Bytes read from either side of a tunnel', ['direction'])
+BACKPRESSURE_EVENTS = REGISTRY.counter('superproxy_backpressure_events_total', 'Times a tunnel side stopped being read because of a full buffer')
+MISSES_WITH_REMOTE_CAPACITY = REGISTRY.counter('superproxy_misses_with_remote_capacity_total',
+                                               'Clients closed for lack of peers in a country another node had peers in', ['country'])
+ACTIVE_TUNNELS = REGISTRY.gauge('superproxy_active_tunnels', 'Tunnels currently open')
 
 
 class SuperProxy:
 
-    def __init__(self, country_to_port_configuration: Dict[str, int], pool: ConnectionPool, db: Database, thread_pool_workers=100):
+    def __init__(self, country_to_port_configuration: Dict[str, int], pool: ConnectionPool, db: Database, thread_pool_workers=100,
+                 capacity_directory: Optional[CapacityDirectory] = None):
+        """
+        :param capacity_directory: capacity of the other nodes, to report clients another node could have served.
+        """
         self.logger = Logger('SuperProxy', level=config['log_level'])
+        self.hot_logger = HotPathLogger('SuperProxy', config['log_level'])
         self.conn_pool = pool
+        self.capacity_directory = capacity_directory
         self.thread_pool = ThreadPoolExecutor(max_workers=thread_pool_workers)
         self.selector = selectors.DefaultSelector()
         self.mutex = Lock()
         self.used_peer_sockets: Dict[socket, str] = {}
         self.plugins = [ProtocolMonitor(db), DataplanTracker(db)]
+        self.splice_relay_enabled: bool = config.get('splice_relay_enabled', False) and SpliceRelay.is_supported()
+        self.high_watermark: int = config.get('tunnel_buffer_high_watermark', DEFAULT_HIGH_WATERMARK)
+        self.low_watermark: int = config.get('tunnel_buffer_low_watermark', DEFAULT_LOW_WATERMARK)
+        self.backpressure_events = 0
+        self.buffer_pool = BufferPool(MIN_READ_SIZE, MAX_READ_SIZE)
+        self.mux_sessions: Dict[str, List[MuxSession]] = defaultdict(list)
+        self.mux_max_streams: int = config.get('mux_max_streams_per_device', DEFAULT_MAX_STREAMS_PER_DEVICE)
+        self.accept_stats = AcceptStats()
+        self.timer_wheel = TimerWheel(TIMER_TICK_SECONDS, time.monotonic())
+        self.handshake_timeout: float = config.get('tunnel_handshake_timeout_seconds', DEFAULT_HANDSHAKE_TIMEOUT_SECONDS)
+        self.idle_timeout: float = config.get('tunnel_idle_timeout_seconds', DEFAULT_IDLE_TIMEOUT_SECONDS)
+        self.close_drain_timeout: float = config.get('tunnel_close_drain_seconds', DEFAULT_CLOSE_DRAIN_SECONDS)
+        self.handshake_timeouts = 0
+        self.idle_timeouts = 0
+        self.bandwidth_shaper = BandwidthShaper()
+        self.bytes_relayed = {direction: BYTES_RELAYED.labels(direction) for direction in DIRECTIONS}
+        ACTIVE_TUNNELS.set_function(lambda: len(self.used_peer_sockets))
+        self.loop_monitor = LoopMonitor('superproxy', config.get('loop_lag_shed_seconds', DEFAULT_LOOP_LAG_SHED_SECONDS),
+                                        config.get('loop_lag_recover_seconds', DEFAULT_LOOP_LAG_RECOVER_SECONDS),
+                                        config.get('loop_slow_callback_seconds', DEFAULT_SLOW_CALLBACK_SECONDS),
+                                        SLOW_CALLBACKS_REPORT_INTERVAL_SECONDS, time.monotonic())
+        self.accepting = True
+        self.closing = False
+        self.port_callbacks: Dict[socket, Callable] = {}
         self.sockets = []
         for country, port in country_to_port_configuration.items():
             self.sockets.append(self._configure_port(country, port))
@@ -42,13 +106,25 @@ class SuperProxy:
     def get_active_sockets(self) -> List[Tuple[socket, str]]:
         return [(k, v) for (k, v) in self.used_peer_sockets.items()]
 
+    def get_buffer_pool_stats(self) -> Dict[str, int]:
+        return self.buffer_pool.stats()
+
+    def get_accept_stats(self) -> Dict[str, Dict[str, int]]:
+        return {'country_ports': self.accept_stats.as_dict()}
+
+    def get_device_bandwidth(self) -> Dict[str, Dict[str, Dict[str, float]]]:
+        return self.bandwidth_shaper.as_dict(self.timer_wheel.time())
+
     def shutdown(self):
-        for sock in self.sockets:
-            sock.close()
+        """
+        Stop accepting clients. The selector loop closes the country ports, open tunnels are served until they close.
+        """
+        self.closing = True
 
     def _configure_port(self, country_code, port):
         sock: socket = self._create_storm_socket(port)
-        self.selector.register(sock, selectors.EVENT_READ, lambda conn, _: self._accept(conn, country_code))
+        self.port_callbacks[sock] = lambda conn, _: self._accept(conn, country_code)
+        self.selector.register(sock, selectors.EVENT_READ, self.port_callbacks[sock])
         self.logger.info(f'Opened port {str(port)} for reaching devices in {country_code}')
         return sock
 
@@ -56,91 +132,469 @@ class SuperProxy:
         connection = self.conn_pool.pop_connection_by_country(country_code)
         if connection.socket is None:
             raise NoAvailableConnection(country_code)
-        with self.mutex:
-            self.used_peer_sockets[connection.socket] = country_code
         return connection
 
     @staticmethod
     def _create_storm_socket(port: int) -> socket:
         storm_socket = socket()
+        storm_socket.setsockopt(SOL_SOCKET, SO_REUSEADDR, 1)
+        if reuse_port():
+            storm_socket.setsockopt(SOL_SOCKET, SO_REUSEPORT, 1)
         try:
             storm_socket.bind(('0.0.0.0', port))
         except OSError as e:
             print(f'port {port} is already in use. Exception thrown: {e!r}. Exiting')
             sys.exit(1)
-        storm_socket.setsockopt(SOL_SOCKET, SO_REUSEADDR, 1)
-        storm_socket.listen(MAX_BACKLOG_CONNECTIONS_PER_COUNTRY)
+        storm_socket.listen(config.get('country_port_backlog', MAX_BACKLOG_CONNECTIONS_PER_COUNTRY))
+        storm_socket.setblocking(False)
         return storm_socket
 
     def _accept(self, country_socket: socket, country_code: str):
-        self.logger.info(f'received accept event on port: {country_socket.getsockname()[1]} which is configured to cc: {country_code}')
-        yogurt_socket, remote_address = country_socket.accept()
-        try:
-            connection = self._get_peer_socket_in_country(country_code)
-            peer_socket: socket = connection.socket
-        except NoAvailableConnection as e:
-            self.logger.error("NoAvailableConnection: {0}".format(e))
-            yogurt_socket.close()
+        """
+        Accept every pending client, up to MAX_ACCEPTS_PER_WAKEUP, so a burst doesn't cost a selector round per client.
+        """
+        self.hot_logger.info('accept', 'received accept event on %s which is configured to cc: %s', country_socket.getsockname, country_code)
+        self.accept_stats.record_queue(country_socket)
+        accepted = 0
+        while accepted < MAX_ACCEPTS_PER_WAKEUP:
+            try:
+                yogurt_socket, remote_address = country_socket.accept()
+            except BlockingIOError:
+                break
+            accepted += 1
+            self._open_tunnel(yogurt_socket, country_code)
+        self.accept_stats.record_batch(accepted)
+        ACCEPTS.labels(country_code).inc(accepted)
+
+    def _open_tunnel(self, yogurt_socket: socket, country_code: str):
+        session = find_session_with_capacity(self.mux_sessions[country_code])
+        if session is None:
+            try:
+                connection = self._get_peer_socket_in_country(country_code)
+                peer_socket: socket = connection.socket
+            except NoAvailableConnection as e:
+                self.logger.error("NoAvailableConnection: {0}".format(e))
+                report_remote_capacity(self.capacity_directory, country_code, self.hot_logger)
+                yogurt_socket.close()
+                return
+            if connection.mux_version:
+                session = self._start_mux_session(connection, country_code)
+        if session is not None:
+            self.timer_wheel.cancel(session.idle_timer)
+            session.idle_timer = None
+            stream = session.open_stream(yogurt_socket)
+            with self.mutex:
+                self.used_peer_sockets[stream] = country_code
+            self._schedule_timeouts(stream)
+            TUNNELS_OPENED.labels(country_code).inc()
             return
+        with self.mutex:
+            self.used_peer_sockets[peer_socket] = country_code
         yogurt_socket.setblocking(False)
         peer_socket.setblocking(False)
+        tunnel = Tunnel(yogurt_socket, peer_socket, connection.device_id, country_code, self.high_watermark, self.low_watermark,
+                        TunnelPlugins(self.plugins, yogurt_socket, peer_socket))
+        tunnel.setup = TunnelSetupTimer(self.conn_pool.peer_scores, connection.device_id)
+        tunnel.bandwidth = self.bandwidth_shaper.acquire(connection.device_id, country_code, connection.asn, self.timer_wheel.time())
         for plugin in self.plugins:
             plugin.register(yogurt_socket, peer_socket, connection.device_id)
-        self.selector.register(peer_socket, selectors.EVENT_READ, lambda conn, _: self._transmit(conn, yogurt_socket, peer_socket))
-        self.selector.register(yogurt_socket, selectors.EVENT_READ, lambda conn, _: self._transmit(conn, yogurt_socket, peer_socket))
+        self._schedule_timeouts(tunnel)
+        self._update_interest(tunnel)
+        TUNNELS_OPENED.labels(country_code).inc()
 
-    def _transmit(self, conn: socket, yogurt_socket: socket, peer_socket: socket):
-        self.logger.debug(f'received transmit event on port {conn.getsockname()[1]}')
-        conn.settimeout(2)
+    def _schedule_timeouts(self, tunnel: Union[Tunnel, MuxStream]):
+        tunnel.last_activity_tick = self.timer_wheel.current_tick
+        if self.handshake_timeout:
+            tunnel.handshake_timer = self.timer_wheel.schedule(self.handshake_timeout, lambda: self._on_handshake_timeout(tunnel))
+        if self.idle_timeout:
+            tunnel.idle_timer = self.timer_wheel.schedule(self.idle_timeout, lambda: self._on_idle_timeout(tunnel))
+
+    def _on_handshake_timeout(self, tunnel: Union[Tunnel, MuxStream]):
+        tunnel.handshake_timer = None
+        if tunnel.closed or not tunnel.plugins.is_negotiating():
+            return
+        self.logger.info(f'{tunnel!r} did not complete its handshake within {self.handshake_timeout} seconds')
+        self.handshake_timeouts += 1
+        TUNNEL_TIMEOUTS.labels('handshake').inc()
+        if isinstance(tunnel, MuxStream):
+            tunnel.session.close_stream(tunnel)
+            return
+        tunnel.setup.peer_failed()
+        self._close_sockets(tunnel.yogurt_socket, tunnel)
+
+    def _on_idle_timeout(self, tunnel: Union[Tunnel, MuxStream]):
+        """
+        Reads only move tunnel.last_activity_tick, so a busy tunnel reschedules its idle timer once per idle_timeout at most.
+        """
+        tunnel.idle_timer = None
+        if tunnel.closed:
+            return
+        idle_seconds = (self.timer_wheel.current_tick - tunnel.last_activity_tick) * self.timer_wheel.tick_seconds
+        if idle_seconds < self.idle_timeout:
+            tunnel.idle_timer = self.timer_wheel.schedule(self.idle_timeout - idle_seconds, lambda: self._on_idle_timeout(tunnel))
+            return
+        self.logger.info(f'{tunnel!r} was idle for {idle_seconds} seconds')
+        self.idle_timeouts += 1
+        TUNNEL_TIMEOUTS.labels('idle').inc()
+        if isinstance(tunnel, MuxStream):
+            tunnel.session.close_stream(tunnel)
+            return
+        self._close_sockets(tunnel.yogurt_socket, tunnel)
+
+    def _start_mux_session(self, connection: Connection, country_code: str) -> MuxSession:
+        bandwidth = self.bandwidth_shaper.acquire(connection.device_id, country_code, connection.asn, self.timer_wheel.time())
+        session = MuxSession(connection.socket, connection.device_id, country_code, connection.mux_version, self.mux_max_streams,
+                             self.selector, self.plugins, self._on_mux_stream_closed, self._on_mux_session_closed, self.timer_wheel,
+                             bandwidth)
+        self.mux_sessions[country_code].append(session)
+        self.logger.info(f'Started mux session with {connection.device_id} in {country_code}')
+        return session
+
+    def _on_mux_stream_closed(self, stream: MuxStream):
+        self.timer_wheel.cancel(stream.handshake_timer)
+        self.timer_wheel.cancel(stream.idle_timer)
+        with self.mutex:
+            del self.used_peer_sockets[stream]
+        TUNNELS_CLOSED.labels(stream.session.country_code).inc()
+        session = stream.session
+        if self.idle_timeout and not session.streams and not session.closed:
+            session.idle_timer = self.timer_wheel.schedule(self.idle_timeout, lambda: self._on_mux_session_idle(session))
+
+    def _on_mux_session_idle(self, session: MuxSession):
+        """
+        A session without streams holds its device out of the pool, where idle devices are probed, so it is closed.
+        """
+        session.idle_timer = None
+        if session.closed or session.streams:
+            return
+        self.logger.info(f'Mux session of {session.device_id} carried no streams for {self.idle_timeout} seconds')
+        TUNNEL_TIMEOUTS.labels('mux_session_idle').inc()
+        session.close()
+
+    def _on_mux_session_closed(self, session: MuxSession):
+        self.timer_wheel.cancel(session.idle_timer)
+        self.bandwidth_shaper.release(session.bandwidth)
+        self.mux_sessions[session.country_code].remove(session)
+        self.conn_pool.release(session.peer_socket)
+
+    def _on_tunnel_event(self, conn: socket, mask: int, tunnel: Tunnel):
+        if mask & selectors.EVENT_WRITE:
+            self._flush(conn, tunnel)
+        if mask & selectors.EVENT_READ and not tunnel.closed:
+            self._transmit(conn, tunnel)
+        if not tunnel.closed:
+            self._update_interest(tunnel)
+
+    def _transmit(self, conn: socket, tunnel: Tunnel):
+        self.hot_logger.debug('transmit', 'received transmit event on %s', conn.getsockname)
+        tunnel.last_activity_tick = self.timer_wheel.current_tick
+        if tunnel.relay is None and self._can_splice(conn, tunnel):
+            tunnel.relay = SpliceRelay(tunnel.yogurt_socket, tunnel.peer_socket)
+            self.logger.debug(f'{tunnel!r} switched to splice relay')
+        if tunnel.relay is not None:
+            self._splice(conn, tunnel)
+            return
+        now = self.timer_wheel.time()
+        direction = tunnel.directions[conn]
+        bucket = tunnel.bandwidth.buckets[direction]
+        read_size = tunnel.read_size[conn]
+        if bucket is not None:
+            allowed = bucket.available(now)
+            if allowed <= 0:
+                self._throttle(conn, tunnel, now)
+                return
+            read_size = min(read_size, allowed)
+        buffer = self.buffer_pool.acquire(read_size)
         try:
-            data = conn.recv(SOCKET_READ_SIZE)
-            if data:
-                self._send_packet_to_target_socket(conn, data, peer_socket, yogurt_socket)
+            received = conn.recv_into(buffer, read_size)
+            if received:
+                if bucket is not None:
+                    bucket.consume(received)
+                tunnel.bandwidth.record(direction, received, now)
+                self.bytes_relayed[direction].inc(received)
+                tunnel.adapt_read_size(conn, received)
+                self._track_setup(conn, tunnel)
+                self._send_packet_to_target_socket(conn, memoryview(buffer)[:received], tunnel)
                 return
+        except BlockingIOError:
+            return
         except ConnectionInvalid as e:
             self.logger.error("Socks socket is in invalid state. {0}".format(e))
-        self._close_sockets(conn, peer_socket, yogurt_socket)
+        except OSError as e:
+            self.logger.error(f'failed reading from {conn!r}. {e!r}')
+        finally:
+            self.buffer_pool.release(buffer)
+        self._close_sockets(conn, tunnel)
 
-    def _send_packet_to_target_socket(self, conn, data, peer_socket, yogurt_socket):
-        self.logger.debug(f'Received packet on port {conn.getsockname()[1]}:  {data!r}')
-        source_socket, target_socket = ((yogurt_socket, peer_socket) if conn == yogurt_socket else (peer_socket, yogurt_socket))
-        target_socket.sendall(data)
-        for plugin in self.plugins:
-            plugin.packet_transmitted(source_socket, target_socket, data)
+    def _can_splice(self, conn: socket, tunnel: Tunnel) -> bool:
+        # Bytes that were already buffered must reach their target before spliced bytes do.
+        buffers_empty = not tunnel.outgoing[tunnel.yogurt_socket] and not tunnel.outgoing[tunnel.peer_socket]
+        return self.splice_relay_enabled and buffers_empty and not tunnel.plugins.is_inspected() and not tunnel.bandwidth.is_limited()
 
-    def _close_sockets(self, conn, peer_socket, yogurt_socket):
-        self.logger.debug("Sending closing packet to port: {0}".format(conn.getsockname()[1]))
+    def _splice(self, conn: socket, tunnel: Tunnel):
+        target_socket = tunnel.other_side(conn)
         try:
-            peer_socket.sendall(CLOSING_PACKET)
-        except:
-            # sending a packet might not be possible as the socket might be already closed.
+            moved = tunnel.relay.relay(conn, target_socket)
+        except BlockingIOError:
+            return
+        except OSError as e:
+            self.logger.error(f'splice relay failed on {tunnel!r}. {e!r}')
+            moved = 0
+        if not moved:
+            self._close_sockets(conn, tunnel)
+            return
+        self._track_setup(conn, tunnel)
+        tunnel.plugins.bytes_transmitted(conn, moved)
+        tunnel.bandwidth.record(tunnel.directions[conn], moved, self.timer_wheel.time())
+        self.bytes_relayed[tunnel.directions[conn]].inc(moved)
+        self._apply_backpressure(conn, target_socket, tunnel)
+
+    def _send_packet_to_target_socket(self, conn, data: memoryview, tunnel: Tunnel):
+        self.hot_logger.debug('packet', 'Received packet of %d bytes on %s', len(data), conn.getsockname)
+        source_socket, target_socket = conn, tunnel.other_side(conn)
+        unsent = data
+        if not tunnel.outgoing[target_socket]:
+            # Nothing is queued before this packet, so try sending straight from the receive buffer.
+            try:
+                unsent = data[target_socket.send(data):]
+            except BlockingIOError:
+                pass
+            except OSError as e:
+                self.logger.error(f'failed writing to {target_socket!r}. {e!r}')
+                self._close_sockets(target_socket, tunnel)
+                return
+        tunnel.outgoing[target_socket] += unsent
+        self._flush(target_socket, tunnel)
+        if tunnel.closed:
+            return
+        tunnel.plugins.packet_transmitted(source_socket, target_socket, data)
+        self._apply_backpressure(source_socket, target_socket, tunnel)
+
+    @staticmethod
+    def _track_setup(conn: socket, tunnel: Tunnel):
+        if tunnel.setup.done:
+            return
+        if conn == tunnel.yogurt_socket:
+            tunnel.setup.client_sent(time.monotonic())
+        else:
+            tunnel.setup.peer_answered(time.monotonic())
+
+    def _throttle(self, conn: socket, tunnel: Tunnel, now: float):
+        """
+        Park conn until its bucket refills instead of polling it. Backpressure may resume reading earlier,
+        in which case the next read finds the bucket empty and parks conn again on the same timer.
+        """
+        tunnel.reading[conn] = False
+        if tunnel.throttle_timers[conn] is None:
+            delay = tunnel.bandwidth.buckets[tunnel.directions[conn]].delay(now)
+            tunnel.throttle_timers[conn] = self.timer_wheel.schedule(delay, lambda: self._on_throttle_timeout(conn, tunnel))
+
+    def _on_throttle_timeout(self, conn: socket, tunnel: Tunnel):
+        tunnel.throttle_timers[conn] = None
+        if tunnel.closed:
+            return
+        # A full buffer on the other side is resumed by _flush once it drains.
+        if not tunnel.is_over_high_watermark(tunnel.other_side(conn)):
+            tunnel.reading[conn] = True
+            self._update_interest(tunnel)
+
+    def _apply_backpressure(self, source_socket: socket, target_socket: socket, tunnel: Tunnel):
+        if tunnel.reading[source_socket] and tunnel.is_over_high_watermark(target_socket):
+            tunnel.reading[source_socket] = False
+            tunnel.backpressure_events += 1
+            self.backpressure_events += 1
+            BACKPRESSURE_EVENTS.inc()
+
+    def _flush(self, target_socket: socket, tunnel: Tunnel):
+        """
+        Write as much of target_socket's outgoing buffer as it takes without blocking,
+        and resume reading the other side once the buffer drained below the low watermark.
+        """
+        buffer = tunnel.outgoing[target_socket]
+        try:
+            while buffer:
+                sent = target_socket.send(buffer)
+                del buffer[:sent]
+            if tunnel.relay is not None:
+                tunnel.relay.flush(target_socket)
+        except BlockingIOError:
             pass
-        self.logger.debug(f"Closed connection on port: {conn.getsockname()[1]}")
+        except OSError as e:
+            self.logger.error(f'failed writing to {target_socket!r}. {e!r}')
+            self._close_sockets(target_socket, tunnel)
+            return
+        source_socket = tunnel.other_side(target_socket)
+        if not tunnel.reading[source_socket] and tunnel.is_under_low_watermark(target_socket):
+            tunnel.reading[source_socket] = True
+
+    def _update_interest(self, tunnel: Tunnel):
+        for conn in (tunnel.yogurt_socket, tunnel.peer_socket):
+            events = (selectors.EVENT_READ if tunnel.reading[conn] else 0) | (selectors.EVENT_WRITE if tunnel.pending(conn) else 0)
+            registered = tunnel.registered_events[conn]
+            if events == registered:
+                continue
+            if not events:
+                self.selector.unregister(conn)
+            elif not registered:
+                self.selector.register(conn, events, lambda sock, mask: self._on_tunnel_event(sock, mask, tunnel))
+            else:
+                self.selector.modify(conn, events, lambda sock, mask: self._on_tunnel_event(sock, mask, tunnel))
+            tunnel.registered_events[conn] = events
+
+    def _close_sockets(self, conn, tunnel: Tunnel):
+        """
+        Close the client side right away. The device side is closed by _drain_peer once it took the closing packet.
+        """
+        if tunnel.closed:
+            return
+        tunnel.closed = True
+        peer_socket, yogurt_socket = tunnel.peer_socket, tunnel.yogurt_socket
+        if conn == peer_socket:
+            # the device hung up, possibly before answering the client.
+            tunnel.setup.peer_failed()
+        self.hot_logger.debug('close', 'Closed connection on %s', conn.getsockname)
         try:
-            self.selector.unregister(peer_socket)
-            self.selector.unregister(yogurt_socket)
+            if tunnel.registered_events[yogurt_socket]:
+                self.selector.unregister(yogurt_socket)
+                tunnel.registered_events[yogurt_socket] = 0
         except:
             self.logger.error("Failed to unregister sockets from selector")
         try:
             yogurt_socket.close()
-            peer_socket.close()
         except:
             self.logger.error("Failed to close sockets in _close_sockets()")
+        self.timer_wheel.cancel(tunnel.handshake_timer)
+        self.timer_wheel.cancel(tunnel.idle_timer)
+        for timer in tunnel.throttle_timers.values():
+            self.timer_wheel.cancel(timer)
+        self.bandwidth_shaper.release(tunnel.bandwidth)
+        tunnel.plugins.report_byte_counts()
         for plugin in self.plugins:
             plugin.unregister(conn)
+        TUNNELS_CLOSED.labels(tunnel.country_code).inc()
+        self.hot_logger.debug('close', 'Sending closing packet to %s', peer_socket.getsockname)
+        self._drain_peer(tunnel)
+
+    def _drain_peer(self, tunnel: Tunnel):
+        """
+        Write what is still buffered or spliced for the device, then the closing packet, as far as the socket takes it without
+        blocking. The rest is written when the socket turns writable again, or dropped when the drain timer fires.
+        """
+        peer_socket = tunnel.peer_socket
+        buffer = tunnel.outgoing[peer_socket]
+        try:
+            while True:
+                while buffer:
+                    sent = peer_socket.send(buffer)
+                    del buffer[:sent]
+                if tunnel.relay is not None and tunnel.relay.flush(peer_socket):
+                    raise BlockingIOError()
+                if tunnel.closing_packet_queued:
+                    break
+                buffer += CLOSING_PACKET
+                tunnel.closing_packet_queued = True
+        except BlockingIOError:
+            self._await_peer_drain(tunnel)
+            return
+        except OSError as e:
+            # the device might have hung up already.
+            self.hot_logger.debug('close', 'Could not send the closing packet to %s. %r', peer_socket, e)
+        self._close_peer(tunnel)
+
+    def _await_peer_drain(self, tunnel: Tunnel):
+        if tunnel.drain_timer is not None:
+            # already waiting for the socket to turn writable.
+            return
+        peer_socket = tunnel.peer_socket
+        callback = lambda sock, mask: self._drain_peer(tunnel)
+        if tunnel.registered_events[peer_socket]:
+            self.selector.modify(peer_socket, selectors.EVENT_WRITE, callback)
+        else:
+            self.selector.register(peer_socket, selectors.EVENT_WRITE, callback)
+        tunnel.registered_events[peer_socket] = selectors.EVENT_WRITE
+        tunnel.drain_timer = self.timer_wheel.schedule(self.close_drain_timeout, lambda: self._on_drain_timeout(tunnel))
+
+    def _on_drain_timeout(self, tunnel: Tunnel):
+        self.logger.info(f'{tunnel!r} did not take its closing packet within {self.close_drain_timeout} seconds')
+        tunnel.drain_timer = None
+        self._close_peer(tunnel)
+
+    def _close_peer(self, tunnel: Tunnel):
+        peer_socket = tunnel.peer_socket
+        self.timer_wheel.cancel(tunnel.drain_timer)
+        tunnel.drain_timer = None
+        try:
+            if tunnel.registered_events[peer_socket]:
+                self.selector.unregister(peer_socket)
+                tunnel.registered_events[peer_socket] = 0
+        except:
+            self.logger.error("Failed to unregister sockets from selector")
+        try:
+            peer_socket.close()
+        except:
+            self.logger.error("Failed to close sockets in _close_peer()")
+        if tunnel.relay is not None:
+            tunnel.relay.close()
         with self.mutex:
             del self.used_peer_sockets[peer_socket]
+        self.conn_pool.release(peer_socket)
+
+    def _set_accepting(self, accepting: bool):
+        """
+        While the loop lags, country ports are taken out of the selector. Clients wait in the listen backlog
+        instead of adding tunnels to a loop that can't serve the ones it has.
+        """
+        self.accepting = accepting
+        for sock, callback in self.port_callbacks.items():
+            if accepting:
+                self.selector.register(sock, selectors.EVENT_READ, callback)
+            else:
+                self.selector.unregister(sock)
+
+    def _close_ports(self):
+        if self.accepting:
+            self._set_accepting(False)
+        for sock in self.sockets:
+            sock.close()
+        self.sockets.clear()
+        self.port_callbacks.clear()
 
     def _loop_selector(self):
         while True:
             try:
-                events = self.selector.select()
+                events = self.selector.select(self.timer_wheel.tick_seconds)
+                started = time.perf_counter()
                 for key, mask in events:
                     callback = key.data
+                    callback_started = time.perf_counter()
                     callback(key.fileobj, mask)
+                    self.loop_monitor.callback_finished(_callback_name(callback), time.perf_counter() - callback_started)
+                self.timer_wheel.advance(time.monotonic())
+                shedding = self.loop_monitor.iteration_finished(time.perf_counter() - started, time.monotonic())
+                if self.closing:
+                    self._close_ports()
+                elif shedding == self.accepting:
+                    self._set_accepting(not shedding)
             except IOError as e:
                 if e.errno == errno.EPIPE:
                     self.logger.debug("Broken pipe in _loop_selector")
                     self.logger.error(str(e.__dict__))
             except Exception as e:
                 self.logger.error("exception in loop_selectors", exc_info=e)
+
+
+def report_remote_capacity(capacity_directory: Optional[CapacityDirectory], country_code: str, hot_logger: HotPathLogger):
+    """
+    Country ports speak the devices' protocol, so a client can't be redirected there. The frontend's /capacity tells clients where to go.
+    """
+    if capacity_directory is None:
+        return
+    nodes = capacity_directory.nodes_with_capacity(country_code)
+    if nodes:
+        MISSES_WITH_REMOTE_CAPACITY.labels(country_code).inc()
+        hot_logger.info('miss', 'no peers in %s, %s has %d', country_code, nodes[0]['node'], nodes[0]['connections'])
+
+
+def _callback_name(callback) -> str:
+    # Tunnel and port callbacks are lambdas, named after the method that registered them.
+    return getattr(callback, '__qualname__', type(callback).__name__).replace('.<locals>.<lambda>', '')
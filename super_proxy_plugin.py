@@ -1,8 +1,23 @@
 import socket
 from abc import abstractmethod
+from collections import defaultdict
+from typing import Dict, List, Optional, Tuple
+
+ALL_PACKETS = None
+BYTE_COUNTS_ONLY = 0
 
 
 class SuperProxyPlugin:
+    """
+    packet_window declares how much of each tunnel the plugin has to see:
+    ALL_PACKETS - packet_transmitted is called for every packet, as long as needs_packet_inspection is True.
+    BYTE_COUNTS_ONLY - packet_transmitted is never called. The plugin only gets bytes_transmitted.
+    N - packet_transmitted is called for the first N packets of every tunnel.
+    Bytes that were not handed to packet_transmitted are reported with bytes_transmitted before unregister.
+    Once no plugin inspects a tunnel anymore, SuperProxy relays it without calling plugins per packet.
+    """
+    packet_window: Optional[int] = ALL_PACKETS
+
     @abstractmethod
     def register(self, yogurt_socket: socket, peer_socket: socket, peer_id: str):
         pass
@@ -12,9 +27,74 @@ class SuperProxyPlugin:
         pass
 
     @abstractmethod
-    def packet_transmitted(self, source: socket, target: socket, data: bytes):
+    def packet_transmitted(self, source: socket, target: socket, data: memoryview):
+        """
+        data is a view over a reused receive buffer and is only valid during the call. Copy it to keep it.
+        """
         pass
 
+    def needs_packet_inspection(self, any_socket: socket) -> bool:
+        """
+        Whether the plugin still has to see the content of every packet of the tunnel owning any_socket.
+        Once it returns False the plugin won't get packet_transmitted for this tunnel again.
+        """
+        return True
+
+    def bytes_transmitted(self, source: socket, target: socket, amount: int):
+        """
+        Called with the amount of bytes sent from source to target that were not handed to packet_transmitted.
+        """
+        pass
+
+
+class TunnelPlugins:
+    """
+    Dispatches the packets of a single tunnel to the plugins that are still interested in them,
+    and aggregates byte counts for everything else.
+    """
+
+    def __init__(self, plugins: List[SuperProxyPlugin], yogurt_socket: socket, peer_socket: socket):
+        self.plugins = plugins
+        self.yogurt_socket = yogurt_socket
+        self.peer_socket = peer_socket
+        self.inspecting: List[SuperProxyPlugin] = [plugin for plugin in plugins if plugin.packet_window != BYTE_COUNTS_ONLY]
+        self.packets_seen = 0
+        self.bytes_relayed: Dict[socket, int] = {yogurt_socket: 0, peer_socket: 0}
+        self.bytes_inspected: Dict[Tuple[SuperProxyPlugin, socket], int] = defaultdict(int)
+
+    def is_inspected(self) -> bool:
+        return bool(self.inspecting)
+
+    def is_negotiating(self) -> bool:
+        """
+        Whether a plugin that sees every packet still inspects the tunnel, e.g. ProtocolMonitor before the SOCKS handshake completed.
+        """
+        return any(plugin.packet_window is ALL_PACKETS and plugin.needs_packet_inspection(self.yogurt_socket)
+                   for plugin in self.inspecting)
+
+    def packet_transmitted(self, source: socket, target: socket, data: memoryview):
+        self.bytes_relayed[source] += len(data)
+        if not self.inspecting:
+            return
+        self.packets_seen += 1
+        for plugin in list(self.inspecting):
+            window = plugin.packet_window
+            if (window is not ALL_PACKETS and self.packets_seen > window) or not plugin.needs_packet_inspection(source):
+                self.inspecting.remove(plugin)
+                continue
+            self.bytes_inspected[(plugin, source)] += len(data)
+            plugin.packet_transmitted(source, target, data)
+
+    def bytes_transmitted(self, source: socket, amount: int):
+        self.bytes_relayed[source] += amount
+
+    def report_byte_counts(self):
+        for plugin in self.plugins:
+            for source, target in ((self.yogurt_socket, self.peer_socket), (self.peer_socket, self.yogurt_socket)):
+                amount = self.bytes_relayed[source] - self.bytes_inspected[(plugin, source)]
+                if amount:
+                    plugin.bytes_transmitted(source, target, amount)
+
 
 class ConnectionInvalid(Exception):
     pass
@@ -0,0 +1,56 @@
+import socket
+import unittest
+
+from utils.accept_stats import AcceptStats, accept_queue, read_listen_overflows
+
+
+class AcceptStatsTests(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.server = socket.socket()
+        self.server.bind(('127.0.0.1', 0))
+        self.server.listen(8)
+        self.clients = []
+
+    def tearDown(self) -> None:
+        for client in self.clients:
+            client.close()
+        self.server.close()
+
+    def test_accept_queue_reports_pending_connections(self):
+        for _ in range(3):
+            self.clients.append(socket.create_connection(self.server.getsockname()))
+        queue_length, backlog = accept_queue(self.server)
+        self.assertEqual(queue_length, 3)
+        self.assertEqual(backlog, 8)
+
+    def test_batches_are_bucketed(self):
+        stats = AcceptStats()
+        for accepted in (1, 3, 300):
+            stats.record_batch(accepted)
+        result = stats.as_dict()
+        self.assertEqual(result['wakeups'], 3)
+        self.assertEqual(result['accepted'], 304)
+        self.assertEqual(result['max_batch'], 300)
+        self.assertEqual(result['batches_up_to_1'], 1)
+        self.assertEqual(result['batches_up_to_4'], 1)
+        self.assertEqual(result['batches_up_to_256'], 1)
+
+    def test_full_queue_is_counted(self):
+        stats = AcceptStats()
+        server = socket.socket()
+        server.bind(('127.0.0.1', 0))
+        server.listen(1)
+        try:
+            self.clients.append(socket.create_connection(server.getsockname()))
+            stats.record_queue(server)
+        finally:
+            server.close()
+        self.assertEqual(stats.as_dict()['queue_full_events'], 1)
+
+    def test_listen_overflows_are_read(self):
+        self.assertTrue(set(read_listen_overflows()) <= {'ListenOverflows', 'ListenDrops'})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,78 @@
+import socket
+import time
+import unittest
+from unittest import mock
+
+from async_super_proxy import AsyncSuperProxy
+from connection_pool import ConnectionPool
+from data_classes.connection import Connection
+from database import Database
+from super_proxy import CLOSING_PACKET
+
+
+class AsyncSuperProxyTests(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.port = 8556
+        self.host = '127.0.0.1'
+        self.mongo = Database("localhost", "test1")
+        self.pool = ConnectionPool()
+        self.super_proxy = AsyncSuperProxy({'GB': self.port}, self.pool, db=self.mongo)
+        self.listening_socket = socket.socket()
+        self.listening_socket.bind((self.host, 0))
+        self.listening_socket.listen(1)
+        self.device_socket = socket.create_connection(self.listening_socket.getsockname())
+        peer_socket, _ = self.listening_socket.accept()
+        self.pool.insert(Connection(peer_socket, 'GB', '1234', '1234'))
+        time.sleep(0.2)
+
+    def tearDown(self) -> None:
+        self.super_proxy.shutdown()
+        self.device_socket.close()
+        self.listening_socket.close()
+
+    def test_communication_in_both_directions(self):
+        client_socket = socket.socket()
+        client_socket.connect((self.host, self.port))
+        client_socket.settimeout(2)
+        self.device_socket.settimeout(2)
+        string_to_send = b'\x05\x01\x00'
+        client_socket.sendall(string_to_send)
+        self.assertEqual(self.device_socket.recv(len(string_to_send)), string_to_send)
+        self.assertEqual(len(self.super_proxy.get_active_sockets()), 1)
+        self.assertEqual(self.pool.count_used_connections(), 1)
+
+        string_to_send = b'\x05\x00'
+        self.device_socket.sendall(string_to_send)
+        self.assertEqual(client_socket.recv(len(string_to_send)), string_to_send)
+
+        client_socket.close()
+        self.assertEqual(self.device_socket.recv(len(CLOSING_PACKET)), CLOSING_PACKET)
+        time.sleep(0.1)
+        self.assertEqual(len(self.super_proxy.get_active_sockets()), 0)
+        self.assertEqual(self.pool.count_used_connections(), 0)
+
+    def test_connection_is_released_when_its_stream_fails_to_open(self):
+        with mock.patch('async_super_proxy.asyncio.open_connection', side_effect=OSError('bad socket')):
+            client_socket = socket.socket()
+            client_socket.connect((self.host, self.port))
+            client_socket.settimeout(2)
+            self.assertEqual(client_socket.recv(1), b'')
+        self.assertEqual(self.pool.count_used_connections(), 0)
+        self.assertEqual(len(self.super_proxy.get_active_sockets()), 0)
+
+    def test_tunnel_closes_when_a_plugin_fails(self):
+        with mock.patch('async_super_proxy.TunnelPlugins.packet_transmitted', side_effect=RuntimeError('plugin bug')), \
+                mock.patch('async_super_proxy.TunnelSetupTimer.peer_failed') as peer_failed:
+            client_socket = socket.socket()
+            client_socket.connect((self.host, self.port))
+            client_socket.settimeout(2)
+            self.device_socket.settimeout(2)
+            time.sleep(0.1)
+            self.device_socket.sendall(b'\x05\x00')
+            self.assertEqual(self.device_socket.recv(len(CLOSING_PACKET)), CLOSING_PACKET)
+            self.assertEqual(client_socket.recv(1), b'')
+            peer_failed.assert_called_once_with()
+        time.sleep(0.1)
+        self.assertEqual(self.pool.count_used_connections(), 0)
+        self.assertEqual(len(self.super_proxy.get_active_sockets()), 0)
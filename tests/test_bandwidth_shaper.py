@@ -0,0 +1,51 @@
+import unittest
+
+from bandwidth_shaper import BandwidthShaper
+from utils.token_bucket import TokenBucket
+
+
+class TokenBucketTests(unittest.TestCase):
+
+    def test_bucket_refills_up_to_burst(self):
+        bucket = TokenBucket(rate=100, burst=50, now=0)
+        self.assertEqual(bucket.available(0), 50)
+        bucket.consume(50)
+        self.assertEqual(bucket.available(0), 0)
+        self.assertAlmostEqual(bucket.delay(0, 20), 0.2)
+        self.assertEqual(bucket.available(0.1), 10)
+        self.assertEqual(bucket.available(10), 50)
+
+
+class BandwidthShaperTests(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.shaper = BandwidthShaper({'default': {'upload': 10, 'download': 20},
+                                       'countries': {'DE': {'upload': 30}},
+                                       'asns': {'3320': {'upload': 0}}}, burst_seconds=1)
+
+    def test_asn_overrides_country_overrides_default(self):
+        self.assertEqual(self.shaper.limits_for('BE', '1'), {'upload': 10, 'download': 20})
+        self.assertEqual(self.shaper.limits_for('DE', '1'), {'upload': 30, 'download': 20})
+        self.assertEqual(self.shaper.limits_for('DE', 3320), {'upload': 0, 'download': 20})
+
+    def test_devices_are_shared_between_tunnels(self):
+        first = self.shaper.acquire('dev1', 'DE', '3320', 0)
+        second = self.shaper.acquire('dev1', 'DE', '3320', 0)
+        self.assertIs(first, second)
+        self.assertIsNone(first.buckets['upload'])
+        self.assertTrue(first.is_limited())
+        self.shaper.release(first)
+        self.assertIn('dev1', self.shaper.as_dict(0))
+        self.shaper.release(second)
+        self.assertEqual(self.shaper.as_dict(0), {})
+
+    def test_measured_rates(self):
+        device = self.shaper.acquire('dev1', 'BE', '1', 0)
+        device.record('download', 300, 0.5)
+        device.record('download', 100, 2)
+        self.assertEqual(self.shaper.as_dict(2.5)['dev1']['download'], {'bytes_per_second': 150.0, 'limit': 20})
+        self.assertEqual(self.shaper.as_dict(4)['dev1']['download']['bytes_per_second'], 0.0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,39 @@
+import socket
+import unittest
+
+from data_classes.tunnel import Tunnel, MIN_READ_SIZE, MAX_READ_SIZE, SMALL_READS_BEFORE_SHRINK
+from utils.buffer_pool import BufferPool
+
+
+class BufferPoolTests(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.pool = BufferPool(MIN_READ_SIZE, MAX_READ_SIZE)
+        self.s1 = socket.socket()
+        self.s2 = socket.socket()
+
+    def tearDown(self) -> None:
+        self.s1.close()
+        self.s2.close()
+
+    def test_buffers_are_reused(self):
+        buffer = self.pool.acquire(3000)
+        self.assertEqual(len(buffer), 4096)
+        self.pool.release(buffer)
+        self.assertIs(self.pool.acquire(4000), buffer)
+        self.assertEqual(self.pool.stats()['hits'], 1)
+        self.assertEqual(self.pool.stats()['misses'], 1)
+
+    def test_sizes_are_clamped(self):
+        self.assertEqual(len(self.pool.acquire(1)), MIN_READ_SIZE)
+        self.assertEqual(len(self.pool.acquire(MAX_READ_SIZE * 4)), MAX_READ_SIZE)
+
+    def test_tunnel_read_size_adapts(self):
+        tunnel = Tunnel(self.s1, self.s2, 'device', 'us')
+        tunnel.adapt_read_size(self.s1, MIN_READ_SIZE)
+        tunnel.adapt_read_size(self.s1, MIN_READ_SIZE * 2)
+        self.assertEqual(tunnel.read_size[self.s1], MIN_READ_SIZE * 4)
+        self.assertEqual(tunnel.read_size[self.s2], MIN_READ_SIZE)
+        for _ in range(SMALL_READS_BEFORE_SHRINK):
+            tunnel.adapt_read_size(self.s1, 10)
+        self.assertEqual(tunnel.read_size[self.s1], MIN_READ_SIZE * 2)
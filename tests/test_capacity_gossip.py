@@ -0,0 +1,107 @@
+import json
+import time
+import unittest
+
+from capacity_gossip import CapacityDirectory, CapacityGossip, EXPIRY_INTERVALS, MAX_DATAGRAM_BYTES
+
+INTERVAL_SECONDS = 0.05
+
+
+class CountingPool:
+
+    def __init__(self, counts) -> None:
+        self.counts = counts
+
+    def count_connections_by_country_and_asn(self):
+        return self.counts
+
+
+class CapacityGossipTests(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.nodes = []
+
+    def tearDown(self) -> None:
+        for node in self.nodes:
+            node.stop()
+
+    def _node(self, counts, secret='secret') -> CapacityGossip:
+        node = CapacityGossip(CountingPool(counts), '127.0.0.1', 0, [], {'us': 1000 + len(self.nodes)}, INTERVAL_SECONDS, secret,
+                              bind_host='127.0.0.1')
+        self.nodes.append(node)
+        return node
+
+    @staticmethod
+    def _connect(*nodes: CapacityGossip):
+        for node, neighbour in zip(nodes, nodes[1:]):
+            node.neighbours.append(('127.0.0.1', neighbour.socket.getsockname()[1]))
+            neighbour.neighbours.append(('127.0.0.1', node.socket.getsockname()[1]))
+
+    @staticmethod
+    def _wait_for(condition, seconds=2.0):
+        deadline = time.monotonic() + seconds
+        while not condition() and time.monotonic() < deadline:
+            time.sleep(INTERVAL_SECONDS)
+        return condition()
+
+    def test_capacity_spreads_through_neighbours(self):
+        a = self._node({'us': {'1': 5, '2': 1}})
+        b = self._node({'us': {'1': 7}})
+        c = self._node({})
+        # c only gossips with b, so it learns of a through b.
+        self._connect(a, b, c)
+        for node in self.nodes:
+            node.start()
+        self.assertTrue(self._wait_for(lambda: len(c.directory.others()) == 2))
+        self.assertEqual(c.directory.nodes_with_capacity('us'), [
+            {'node': b.node_id, 'address': '127.0.0.1', 'port': 1001, 'connections': 7},
+            {'node': a.node_id, 'address': '127.0.0.1', 'port': 1000, 'connections': 6},
+        ])
+        self.assertEqual([node['node'] for node in c.directory.nodes_with_capacity('us', '2')], [a.node_id])
+        self.assertEqual(c.directory.nodes_with_capacity('uk'), [])
+        a.pool.counts = {'us': {'1': 50}}
+        self.assertTrue(self._wait_for(lambda: c.directory.nodes_with_capacity('us')[0]['node'] == a.node_id))
+        a.stop()
+        self.assertTrue(self._wait_for(lambda: len(c.directory.others()) == 1, EXPIRY_INTERVALS * INTERVAL_SECONDS * 4))
+
+    def test_gossip_with_another_secret_is_dropped(self):
+        a = self._node({'us': {'1': 5}}, secret='other')
+        b = self._node({})
+        self._connect(a, b)
+        a.start()
+        b.start()
+        self.assertFalse(self._wait_for(lambda: b.directory.others(), INTERVAL_SECONDS * 5))
+
+    def test_big_directories_are_split_between_datagrams(self):
+        node = self._node({})
+        entries = [{'node': str(i), 'address': '127.0.0.1', 'ports': {}, 'version': 1, 'countries': {'us': {str(asn): 1 for asn in range(500)}}}
+                   for i in range(20)]
+        datagrams = node._datagrams(entries)
+        self.assertGreater(len(datagrams), 1)
+        self.assertTrue(all(len(datagram) <= MAX_DATAGRAM_BYTES for datagram in datagrams))
+        directory = CapacityDirectory('me', 1)
+        for datagram in datagrams:
+            for entry in json.loads(datagram):
+                directory.merge(entry, 0)
+        self.assertEqual(len(directory.others()), 20)
+
+    def test_directory_keeps_newest_version(self):
+        directory = CapacityDirectory('me', 1)
+        entry = {'node': 'a', 'address': 'a', 'ports': {}, 'countries': {'us': {'1': 1}}, 'version': 2}
+        self.assertTrue(directory.merge(entry, 0))
+        self.assertFalse(directory.merge({**entry, 'countries': {}, 'version': 1}, 0.5))
+        self.assertEqual(directory.as_dict(), {'a': {'us': 1}})
+        directory.expire(1.5)
+        self.assertEqual(directory.as_dict(), {})
+
+
+    def test_replaced_directory_holds_only_the_new_entries(self):
+        directory = CapacityDirectory('me', 1)
+        entry = {'node': 'a', 'address': 'a', 'ports': {}, 'countries': {'us': {'1': 1}}, 'version': 2}
+        directory.merge(entry, 0)
+        directory.replace([{**entry, 'node': 'b', 'version': 1}], 0)
+        self.assertEqual(directory.as_dict(), {'b': {'us': 1}})
+        self.assertEqual(directory.nodes_with_capacity('us'), [{'node': 'b', 'address': 'a', 'port': None, 'connections': 1}])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,19 +1,18 @@
 import socket
-import time
 import unittest
-from threading import Thread
 
+from benchmarks.pool_stress import PoolStress
 from connection_pool import ConnectionPool
 from data_classes.connection import Connection
 from utils.no_available_connection_exception import NoAvailableConnection
-from utils.unstable_echo_server import UnstableEchoServer
 
 
 class ConnPoolTests(unittest.TestCase):
 
     def setUp(self) -> None:
         super().setUpClass()
-        self.pool = ConnectionPool()
+        # the sockets are never connected, which epoll reports as a hang up.
+        self.pool = ConnectionPool(passive_liveness=False)
         self.s1 = socket.socket()
         self.s2 = socket.socket()
         self.s3 = socket.socket()
@@ -47,48 +46,62 @@ class ConnPoolTests(unittest.TestCase):
         self.assertRaises(NoAvailableConnection, self.pool.pop_connection_by_country_and_asn, 'us', '1234')
         self.assertEqual(2, len(self.pool.used_connections))
 
-    def test_send_keep_alive_packet(self):
-        host = '127.0.0.1'
-        port = 2000
-        # socket should fail sending before its open
-        alive = self.pool._send_keep_alive_packet_and_check_response(self.s1)
-        self.assertFalse(alive)
-        run_echo_server(host, port)
-        self.s1.connect((host, port))
-        self.s1.settimeout(1)
-        # first packet should not be sent, therefore no keep alive is sent back
-        alive = self.pool._send_keep_alive_packet_and_check_response(self.s1)
-        self.assertFalse(alive)
-        # second packet should be sent
-        alive = self.pool._send_keep_alive_packet_and_check_response(self.s1)
-        self.assertTrue(alive)
+    def test_released_connections_are_no_longer_used(self):
+        self.pool.insert(self.con1)
+        self.pool.insert(self.con3)
+        self.pool.pop_connection_by_country('us')
+        self.pool.pop_connection_by_country('uk')
+        self.assertEqual(sorted(self.pool.get_all_device_ids()), ['1234', '345'])
+        self.pool.release(self.s1)
+        self.pool.release(self.s1)
+        self.assertEqual(self.pool.count_used_connections(), 1)
+        self.assertEqual(self.pool.get_all_device_ids(distinct=True), ['345'])
+
+    def test_clean_used_connections_drops_closed_sockets(self):
+        self.pool.insert(self.con1)
+        self.pool.insert(self.con3)
+        self.pool.pop_connection_by_country('us')
+        self.pool.pop_connection_by_country('uk')
+        self.s1.close()
+        # the never connected socket has no TCP state, the closed one has no descriptor.
+        self.pool._clean_used_connections()
+        self.assertEqual(self.pool.count_used_connections(), 0)
 
-    def test_is_connection_alive(self):
-        host = '127.0.0.1'
-        port = 3000
-        run_echo_server(host, port)
-        self.s1.connect((host, port))
-        self.s1.settimeout(1)
-        alive = self.pool._is_connection_alive(Connection(self.s1, '_', '_', '_'))
-        self.assertTrue(alive)
+    def test_reconnecting_device_replaces_its_idle_connection(self):
+        reconnected = Connection(self.s4, 'uk', '345', '1234')
+        self.pool.insert(self.con1)
+        self.pool.insert(self.con2)
+        self.pool.insert(reconnected)
+        self.assertEqual(self.s1.fileno(), -1)
+        self.assertEqual(sorted(self.pool.get_all_device_ids()), ['1234', '12345'])
+        self.assertRaises(NoAvailableConnection, self.pool.pop_connection_by_country_and_asn, 'us', '1234')
+        self.assertEqual(self.pool.pop_connection_by_device_id('1234'), reconnected)
+        self.assertRaises(NoAvailableConnection, self.pool.pop_connection_by_device_id, '1234')
+        self.assertEqual(self.pool.count_used_connections(), 1)
 
-    def test_no_lock_starvation(self):
-        host = '127.0.0.1'
-        ports = 4000, 5000, 6000, 7000
-        sockets = self.s1, self.s2, self.s3, self.s4
-        country_codes = 'uk', 'us', 'ge', 'fr'
-        asns = '1', '2', '3', '4'
-        for socket, port, cc, asn in zip(sockets, ports, country_codes, asns):
-            self.pool.insert(Connection(socket, cc, asn, asn))
-            run_echo_server(host, port)
-            socket.connect((host, port))
-        start_time = time.time()
-        Thread(target=self.pool._test_all_available_connections_are_alive).start()
-        for cc in reversed(country_codes):
-            self.pool.pop_connection_by_country(cc)
-        print(f'it took {time.time() - start_time} seconds to finish')
-        self.assertLess(time.time() - start_time,
-                        1 + ConnectionPool.SLEEP_TIME_BETWEEN_KEEP_ALIVE_PACKETS + ConnectionPool.SOCKET_TIMEOUT_SECONDS)
+    def test_probed_connection_is_closed_if_its_device_reconnected(self):
+        self.pool.insert(self.con1)
+        idle_since = self.pool.take_for_probe(self.con1)
+        reconnected = Connection(self.s4, 'us', '789', '1234')
+        self.pool.insert(reconnected)
+        self.pool.probe_finished(self.con1, idle_since, True)
+        self.assertEqual(self.s1.fileno(), -1)
+        self.assertEqual(list(self.pool.available_connections), [reconnected])
+
+    def test_lowest_rtt_pops_fastest_device(self):
+        pool = ConnectionPool('lowest_rtt', passive_liveness=False)
+        try:
+            for connection in (self.con1, self.con2):
+                pool.peer_scores.track(connection.device_id, connection.country_code, connection.asn)
+            pool.peer_scores.record_rtt('1234', 0.8, 'probe')
+            pool.peer_scores.record_rtt('12345', 0.05, 'probe')
+            pool.insert(self.con1)
+            pool.insert(self.con2)
+            pool.insert(self.con4)
+            self.assertEqual([pool.pop_connection_by_country('us') for _ in range(3)], [self.con2, self.con4, self.con1])
+            self.assertEqual(pool.get_rtt_distribution()['us']['rtt_ms']['50'], 1)
+        finally:
+            pool.close_all_connections()
 
     def test_country_mapping(self):
         self.pool.insert(self.con1)
@@ -98,11 +111,17 @@ class ConnPoolTests(unittest.TestCase):
         by_country = self.pool.count_connections_by_country()
         self.assertEqual(by_country['us'], 3)
         self.assertEqual(by_country['uk'], 1)
+        self.pool.pop_connection_by_country('uk')
+        self.assertEqual(self.pool.count_connections_by_country_and_asn(), {'us': {'1234': 1, '12345': 1, '789': 1}})
 
+    def test_concurrent_inserts_pops_and_sweeps_lose_nothing(self):
+        stress = PoolStress(inserters=3, poppers=4, connections=5000, countries=3, asns=4, dead_fraction=0.1,
+                            probe_seconds=0.0005, pop_interval_seconds=0.0002)
+        results = stress.run()
+        self.assertEqual(results['lost'], 0)
+        self.assertEqual(results['handed_out_twice'], 0)
+        self.assertEqual(results['popped_and_evicted'], 0)
+        self.assertEqual(results['evicted_twice'], 0)
+        self.assertEqual(results['left_in_pool'], 0)
+        self.assertGreater(results['probes'], 0)
 
-def run_echo_server(host: str, port: int):
-    server = UnstableEchoServer(host, port)
-    thread = Thread(target=server.run)
-    thread.start()
-    # let socket connect
-    time.sleep(0.2)
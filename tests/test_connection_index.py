@@ -0,0 +1,108 @@
+import unittest
+from collections import Counter
+
+from data_classes.connection import Connection
+from utils.connection_index import ConnectionIndex, ROUND_ROBIN, WEIGHTED_RANDOM, FIFO, LOWEST_RTT, HEAP_COMPACTION_SLACK
+
+
+def make_connection(country, asn, device_id):
+    # the index never touches the socket, any hashable placeholder will do.
+    return Connection(device_id, country, asn, device_id)
+
+
+class ConnectionIndexTests(unittest.TestCase):
+
+    def test_counts_follow_inserts_and_removals(self):
+        index = ConnectionIndex()
+        connections = [make_connection('us', asn, f'{asn}-{i}') for asn in ('1', '2') for i in range(3)]
+        for connection in connections:
+            index.add(connection)
+        index.add(make_connection('uk', '3', 'uk'))
+        self.assertEqual(len(index), 7)
+        self.assertEqual(index.count_by_country(), {'us': 6, 'uk': 1})
+        self.assertEqual(index.count_by_asn('us'), {'1': 3, '2': 3})
+        self.assertTrue(index.remove(connections[0]))
+        self.assertFalse(index.remove(connections[0]))
+        self.assertEqual(index.pop('uk').device_id, 'uk')
+        self.assertIsNone(index.pop('uk'))
+        self.assertIsNone(index.pop('fr'))
+        self.assertEqual(index.count_by_country(), {'us': 5, 'uk': 0})
+        self.assertEqual(len(index), 5)
+
+    def test_asn_pop_hands_out_longest_idle_first(self):
+        index = ConnectionIndex()
+        for i in range(3):
+            index.add(make_connection('us', '1', str(i)), now=i)
+        self.assertEqual([index.pop('us', '1').device_id for _ in range(3)], ['0', '1', '2'])
+        self.assertIsNone(index.pop('us', '1'))
+        self.assertEqual(index.count_by_asn('us'), {})
+
+    def test_round_robin_alternates_asns(self):
+        index = ConnectionIndex(ROUND_ROBIN)
+        for asn in ('1', '2', '3'):
+            for i in range(2):
+                index.add(make_connection('us', asn, f'{asn}-{i}'))
+        asns = [index.pop('us').asn for _ in range(6)]
+        self.assertEqual(asns, ['1', '2', '3', '1', '2', '3'])
+
+    def test_fifo_ignores_asn(self):
+        index = ConnectionIndex(FIFO)
+        index.add(make_connection('us', '1', 'a'), now=1)
+        index.add(make_connection('us', '2', 'b'), now=2)
+        index.add(make_connection('us', '1', 'c'), now=3)
+        self.assertEqual([index.pop('us').device_id for _ in range(3)], ['a', 'b', 'c'])
+
+    def test_weighted_random_follows_asn_sizes(self):
+        index = ConnectionIndex(WEIGHTED_RANDOM)
+        picks = Counter()
+        for _ in range(2000):
+            for i, asn in enumerate(('big', 'big', 'big', 'small')):
+                index.add(make_connection('us', asn, str(i)))
+            picks[index.pop('us').asn] += 1
+            for connection in list(index):
+                index.remove(connection)
+        self.assertGreater(picks['big'], 2 * picks['small'])
+        self.assertGreater(picks['small'], 0)
+
+
+    def test_device_has_one_idle_connection(self):
+        index = ConnectionIndex()
+        first = make_connection('us', '1', 'device')
+        self.assertIsNone(index.add(first))
+        self.assertIsNone(index.add(first))
+        second = Connection('other socket', 'uk', '2', 'device')
+        self.assertEqual(index.add(second), first)
+        self.assertNotIn(first, index)
+        self.assertEqual(index.count_by_country(), {'us': 0, 'uk': 1})
+        self.assertEqual(index.device_ids(), ['device'])
+        # removing the replaced connection again leaves the newer one indexed.
+        self.assertFalse(index.remove(first))
+        self.assertEqual(index.get_by_device_id('device'), second)
+        self.assertEqual(index.pop_by_device_id('device'), second)
+        self.assertIsNone(index.pop_by_device_id('device'))
+        self.assertEqual(index.device_ids(), [])
+
+    def test_lowest_rtt_pops_lowest_score(self):
+        scores = {'a': 0.5, 'b': 0.1, 'c': 0.3, 'd': 0.2}
+        index = ConnectionIndex(LOWEST_RTT, lambda connection: scores[connection.device_id])
+        for device_id, asn in (('a', '1'), ('b', '1'), ('c', '2'), ('d', '2')):
+            index.add(make_connection('us', asn, device_id))
+        self.assertEqual(index.pop('us', '2').device_id, 'd')
+        index.remove(index.get_by_device_id('b'))
+        self.assertEqual([index.pop('us').device_id for _ in range(2)], ['c', 'a'])
+        self.assertIsNone(index.pop('us'))
+        self.assertIsNone(index.pop('us', '1'))
+
+    def test_lowest_rtt_heaps_drop_removed_connections(self):
+        index = ConnectionIndex(LOWEST_RTT, lambda connection: -int(connection.device_id))
+        for i in range(1000):
+            index.add(make_connection('us', '1', str(i)))
+            index.remove(make_connection('us', '1', str(i)))
+        index.add(make_connection('us', '1', '5'))
+        country = index.countries['us']
+        self.assertLessEqual(len(country.heap), 2 + HEAP_COMPACTION_SLACK)
+        self.assertLessEqual(len(country.asn_heaps['1']), 2 + HEAP_COMPACTION_SLACK)
+        self.assertEqual(index.pop('us').device_id, '5')
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,126 @@
+import ipaddress
+import json
+import os
+import tempfile
+import unittest
+from types import SimpleNamespace
+
+from utils.geoip_lookup import GeoIpLookup
+
+
+class JsonReader:
+    """
+    Reads a database written as {network: [country, asn]}, answering like geoip2.database.Reader.
+    """
+
+    def __init__(self, path: str) -> None:
+        with open(path) as database:
+            self.networks = {ipaddress.ip_network(network): answer for network, answer in json.load(database).items()}
+        self.queries = 0
+        self.closed = False
+        self.on_query = None
+
+    def _find(self, ip: str):
+        assert not self.closed
+        self.queries += 1
+        if self.on_query is not None:
+            self.on_query()
+        address = ipaddress.ip_address(ip)
+        return next((network, answer) for network, answer in self.networks.items() if address in network)
+
+    def asn(self, ip: str):
+        network, (_, asn) = self._find(ip)
+        return SimpleNamespace(autonomous_system_number=asn, network=network)
+
+    def city(self, ip: str):
+        network, (country, _) = self._find(ip)
+        return SimpleNamespace(country=SimpleNamespace(iso_code=country), traits=SimpleNamespace(network=network))
+
+    def close(self):
+        self.closed = True
+
+
+class GeoIpLookupTests(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.directory = tempfile.TemporaryDirectory()
+        self.asn_path = os.path.join(self.directory.name, 'asn.json')
+        self.city_path = os.path.join(self.directory.name, 'city.json')
+        self.readers = []
+        self._write({'1.2.0.0/16': ['IL', 100], '5.6.7.0/25': ['US', 200], '5.6.7.128/25': ['US', 300]})
+        self.lookup = GeoIpLookup(self.asn_path, self.city_path, cache_size=2, reload_interval_seconds=0, open_reader=self._open)
+
+    def tearDown(self) -> None:
+        self.directory.cleanup()
+
+    def _open(self, path: str) -> JsonReader:
+        reader = JsonReader(path)
+        self.readers.append(reader)
+        return reader
+
+    def _write(self, networks):
+        for path in (self.asn_path, self.city_path):
+            with open(path + '.tmp', 'w') as database:
+                json.dump(networks, database)
+            # geoipupdate replaces the files the same way.
+            os.replace(path + '.tmp', path)
+
+    def test_prefix_is_looked_up_once(self):
+        self.assertEqual(self.lookup.lookup('1.2.3.4'), ('IL', '100'))
+        self.assertEqual(self.lookup.lookup('1.2.3.200'), ('IL', '100'))
+        self.assertEqual(self.lookup.lookup('1.2.4.1'), ('IL', '100'))
+        self.assertEqual(len(self.readers), 2)
+        self.assertEqual([reader.queries for reader in self.readers], [2, 2])
+
+    def test_networks_narrower_than_the_prefix_are_not_cached(self):
+        self.assertEqual(self.lookup.lookup('5.6.7.1'), ('US', '200'))
+        self.assertEqual(self.lookup.lookup('5.6.7.200'), ('US', '300'))
+        self.assertEqual(len(self.lookup.databases.cache), 0)
+
+    def test_least_recently_used_prefix_is_evicted(self):
+        self._write({'0.0.0.0/0': ['IL', 100]})
+        for ip in ['1.1.1.1', '2.2.2.2', '1.1.1.2', '3.3.3.3']:
+            self.lookup.lookup(ip)
+        self.assertEqual(list(self.lookup.databases.cache), ['1.1.1', '3.3.3'])
+
+    def test_replaced_files_are_swapped_in(self):
+        self.lookup.lookup('1.2.3.4')
+        old = self.lookup.databases
+        self.assertFalse(self.lookup.reload_if_changed())
+        self._write({'1.2.0.0/16': ['FR', 400]})
+        self.assertTrue(self.lookup.reload_if_changed())
+        self.assertIsNot(self.lookup.databases, old)
+        self.assertEqual(self.lookup.lookup('1.2.3.4'), ('FR', '400'))
+        self.assertFalse(self.lookup.reload_if_changed())
+
+    def test_replaced_readers_are_closed(self):
+        self.lookup.lookup('1.2.3.4')
+        self._write({'1.2.0.0/16': ['FR', 400]})
+        self.assertTrue(self.lookup.reload_if_changed())
+        self.assertEqual([reader.closed for reader in self.readers], [True, True, False, False])
+
+    def test_readers_are_closed_after_the_lookups_reading_them(self):
+        self.lookup.lookup('1.2.3.4')
+        asn_reader = self.readers[0]
+
+        def reload():
+            asn_reader.on_query = None
+            self._write({'1.2.0.0/16': ['FR', 400]})
+            self.assertTrue(self.lookup.reload_if_changed())
+            self.assertFalse(asn_reader.closed)
+
+        asn_reader.on_query = reload
+        self.assertEqual(self.lookup.lookup('5.6.7.1'), ('US', '200'))
+        self.assertEqual([reader.closed for reader in self.readers], [True, True, False, False])
+        self.assertEqual(self.lookup.lookup('1.2.3.4'), ('FR', '400'))
+
+    def test_unreadable_files_keep_the_current_databases(self):
+        self.lookup.lookup('1.2.3.4')
+        with open(self.asn_path, 'w') as database:
+            database.write('not a database')
+        self.assertFalse(self.lookup.reload_if_changed())
+        self.assertEqual(self.lookup.lookup('1.2.3.4'), ('IL', '100'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,97 @@
+import os
+import socket
+import tempfile
+import threading
+import unittest
+
+from connection_pool import ConnectionPool
+from data_classes.connection import Connection
+from graceful_restart import GracefulRestart, MAX_FDS_PER_MESSAGE, receive_connections, send_connections, take_over
+
+
+class DrainingServer:
+    """
+    Stands in for the PeerServer and the SuperProxy of the process being taken over.
+    """
+
+    def __init__(self) -> None:
+        self.stopped = False
+        self.active_sockets = ['tunnel']
+
+    def stop(self, wait=False):
+        self.stopped = wait
+
+    def shutdown(self):
+        self.stopped = True
+
+    def get_active_sockets(self):
+        # the last tunnel closes after the first drain poll.
+        active_sockets = list(self.active_sockets)
+        self.active_sockets.clear()
+        return active_sockets
+
+
+class GracefulRestartTests(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.device_sockets = []
+
+    def tearDown(self) -> None:
+        for sock in self.device_sockets:
+            sock.close()
+
+    def _connections(self, count: int):
+        connections = []
+        for i in range(count):
+            pool_side, device_side = socket.socketpair()
+            self.device_sockets.append(device_side)
+            connections.append(Connection(pool_side, 'us', str(i % 3), str(i), i % 2))
+        return connections
+
+    def _assert_usable(self, connections):
+        for connection in connections:
+            device = self.device_sockets[int(connection.device_id)]
+            device.sendall(b'ping')
+            self.assertEqual(connection.socket.recv(4), b'ping')
+
+    def test_connections_keep_metadata_and_stay_open(self):
+        connections = self._connections(MAX_FDS_PER_MESSAGE + 10)
+        sender, receiver = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+        with sender, receiver:
+            thread = threading.Thread(target=send_connections, args=(sender, connections))
+            thread.start()
+            received = receive_connections(receiver)
+            thread.join()
+        self.assertEqual([(c.country_code, c.asn, c.device_id, c.mux_version) for c in received],
+                         [(c.country_code, c.asn, c.device_id, c.mux_version) for c in connections])
+        self.assertTrue(all(connection.socket.fileno() == -1 for connection in connections))
+        self._assert_usable(received)
+        for connection in received:
+            connection.socket.close()
+
+    def test_new_process_takes_idle_connections_over(self):
+        path = os.path.join(tempfile.mkdtemp(), 'handover.sock')
+        self.assertEqual(take_over(path, None), 0)
+        old_pool = ConnectionPool(passive_liveness=False)
+        new_pool = ConnectionPool(passive_liveness=False)
+        try:
+            connections = self._connections(5)
+            for connection in connections:
+                old_pool.insert(connection)
+            used = old_pool.pop_connection_by_country('us')
+            server = DrainingServer()
+            drained = threading.Event()
+            GracefulRestart(path, old_pool, server, server, 5, drained.set).start()
+            self.assertEqual(take_over(path, new_pool), 4)
+            self.assertTrue(drained.wait(5))
+            self.assertTrue(server.stopped)
+            self.assertEqual(len(old_pool), 0)
+            self.assertEqual(sorted(new_pool.get_all_device_ids()), sorted(c.device_id for c in connections if c != used))
+            self._assert_usable(new_pool.available_connections)
+        finally:
+            old_pool.close_all_connections()
+            new_pool.close_all_connections()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,60 @@
+import logging
+import unittest
+
+from config import config
+from utils.hot_path_logger import HotPathLogger, LogSite, get_writer
+
+
+class RecordingLogger:
+    def __init__(self):
+        self.records = []
+
+    def debug(self, text):
+        self.records.append(('debug', text))
+
+    def info(self, text):
+        self.records.append(('info', text))
+
+
+class HotPathLoggerTests(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.original_sampling = config.get('log_sampling')
+        config['log_sampling'] = {'Test.sampled': {'sample_every': 3}, 'Test.limited': {'max_per_second': 2}}
+
+    def tearDown(self) -> None:
+        config['log_sampling'] = self.original_sampling
+
+    def _logger(self, level):
+        logger = HotPathLogger('Test', level)
+        logger.logger = RecordingLogger()
+        return logger
+
+    def test_disabled_levels_do_not_evaluate_arguments(self):
+        logger = self._logger(logging.INFO)
+        logger.debug('packet', 'received %s', lambda: self.fail('argument evaluated'))
+        get_writer().flush()
+        self.assertEqual(logger.logger.records, [])
+
+    def test_records_are_formatted_by_the_writer(self):
+        logger = self._logger(logging.DEBUG)
+        logger.debug('packet', 'received %d bytes on %s', 10, lambda: ('127.0.0.1', 2000))
+        get_writer().flush()
+        self.assertEqual(logger.logger.records, [('debug', "received 10 bytes on ('127.0.0.1', 2000)")])
+
+    def test_sampling_mentions_suppressed_records(self):
+        logger = self._logger(logging.DEBUG)
+        for i in range(7):
+            logger.info('sampled', 'record %d', i)
+        get_writer().flush()
+        self.assertEqual(logger.logger.records, [('info', 'record 2 (2 similar records suppressed)'),
+                                                 ('info', 'record 5 (2 similar records suppressed)')])
+
+    def test_rate_limit(self):
+        site = LogSite(max_per_second=2)
+        self.assertEqual([site.allow() for _ in range(4)], [True, True, False, False])
+        self.assertEqual(site.take_suppressed(), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,112 @@
+import socket
+import time
+import unittest
+from threading import Thread
+
+from connection_pool import ConnectionPool
+from data_classes.connection import Connection
+
+
+class FastProbingPool(ConnectionPool):
+    FULL_KEEP_ALIVE_INTERVAL = 0.5
+    SOCKET_TIMEOUT_SECONDS = 0.2
+    SLEEP_TIME_BETWEEN_KEEP_ALIVE_PACKETS = 0.05
+
+    def is_tcp_state_ok(self, connection):
+        # socketpairs are unix sockets, which have no TCP_INFO.
+        return True
+
+
+def echo(sock: socket.socket):
+    while True:
+        data = sock.recv(1024)
+        if not data:
+            return
+        sock.sendall(data)
+
+
+class KeepAliveProberTests(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.pool = FastProbingPool(passive_liveness=False)
+        self.device_sockets = []
+
+    def tearDown(self) -> None:
+        self.pool.close_all_connections()
+        for sock in self.device_sockets:
+            sock.close()
+
+    def _insert(self, device_id: str, asn: str = '1') -> (Connection, socket.socket):
+        pool_side, device_side = socket.socketpair()
+        self.device_sockets.append(device_side)
+        connection = Connection(pool_side, 'us', asn, device_id)
+        self.pool.insert(connection)
+        return connection, device_side
+
+    def _wait_for_cycles(self, cycles: int):
+        # the first cycle starts one interval after the pool is created.
+        time.sleep((cycles + 1) * FastProbingPool.FULL_KEEP_ALIVE_INTERVAL + FastProbingPool.SOCKET_TIMEOUT_SECONDS)
+
+    def test_alive_connections_stay_and_dead_ones_are_removed(self):
+        alive, alive_device = self._insert('alive')
+        Thread(target=echo, args=(alive_device,), daemon=True).start()
+        closed, closed_device = self._insert('closed')
+        closed_device.close()
+        silent, _ = self._insert('silent')
+        garbage, garbage_device = self._insert('garbage')
+        garbage_device.sendall(b'XXXX')
+        # the silent device needs KEEP_ALIVE_ATTEMPTS timeouts to be given up on.
+        self._wait_for_cycles(3)
+        self.assertIn(alive, self.pool.available_connections)
+        for connection in (closed, silent, garbage):
+            self.assertNotIn(connection, self.pool.available_connections)
+            self.assertEqual(connection.socket.fileno(), -1)
+        self.assertEqual(len(self.pool), 1)
+        self.assertLess(self.pool.peer_scores.score('alive'), self.pool.peer_scores.unmeasured_rtt_seconds)
+        self.assertGreater(self.pool.peer_scores.score('silent'), self.pool.peer_scores.unmeasured_rtt_seconds)
+
+    def test_unanswered_attempt_is_retried(self):
+        connection, device = self._insert('unstable')
+        Thread(target=self._echo_every_other_packet, args=(device,), daemon=True).start()
+        self._wait_for_cycles(2)
+        # a later cycle may have the connection out for probing, but it is never closed.
+        self.assertNotEqual(connection.socket.fileno(), -1)
+
+    @staticmethod
+    def _echo_every_other_packet(device: socket.socket):
+        send_back = False
+        while True:
+            data = device.recv(4)
+            if not data:
+                return
+            if send_back:
+                device.sendall(data)
+            send_back = not send_back
+
+    def test_popped_connections_are_not_probed(self):
+        connection, device = self._insert('popped')
+        self.assertEqual(self.pool.pop_connection_by_country('us'), connection)
+        device.settimeout(FastProbingPool.FULL_KEEP_ALIVE_INTERVAL * 2)
+        with self.assertRaises(socket.timeout):
+            device.recv(4)
+
+    def test_probes_are_spread_over_the_interval(self):
+        sent_at = []
+        for i in range(4):
+            _, device = self._insert(str(i), asn=str(i))
+            Thread(target=self._record_probe, args=(device, sent_at), daemon=True).start()
+        self._wait_for_cycles(1)
+        self.assertEqual(len(sent_at), 4)
+        sent_at.sort()
+        gaps = [later - earlier for earlier, later in zip(sent_at, sent_at[1:])]
+        self.assertGreater(min(gaps), 0.04)
+
+    @staticmethod
+    def _record_probe(device: socket.socket, sent_at: list):
+        data = device.recv(4)
+        sent_at.append(time.monotonic())
+        device.sendall(data)
+
+
+if __name__ == '__main__':
+    unittest.main()
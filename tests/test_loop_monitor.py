@@ -0,0 +1,35 @@
+import unittest
+
+from utils.loop_monitor import LoopMonitor
+
+
+class LoopMonitorTests(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.monitor = LoopMonitor('test', shed_seconds=0.2, recover_seconds=0.05, slow_callback_seconds=0.1,
+                                   report_interval_seconds=60, now=0)
+
+    def test_fast_iterations_do_not_shed(self):
+        for _ in range(10):
+            self.assertFalse(self.monitor.iteration_finished(0.19, 1))
+
+    def test_slow_iteration_sheds_until_the_loop_catches_up(self):
+        self.assertTrue(self.monitor.iteration_finished(0.5, 1))
+        self.assertTrue(self.monitor.iteration_finished(0.001, 1))
+        fast_iterations = 1
+        while self.monitor.iteration_finished(0.001, 1):
+            fast_iterations += 1
+        self.assertGreater(fast_iterations, 1)
+        self.assertLessEqual(self.monitor.lag, 0.05)
+
+    def test_slow_callbacks_are_summed_by_name_and_reset_on_report(self):
+        self.monitor.callback_finished('SuperProxy._update_interest', 0.3)
+        self.monitor.callback_finished('SuperProxy._update_interest', 0.2)
+        self.monitor.callback_finished('SuperProxy._configure_port', 0.01)
+        self.assertEqual(self.monitor.slow_callbacks, {'SuperProxy._update_interest': [2, 0.5, 0.3]})
+        self.monitor.iteration_finished(0, 61)
+        self.assertEqual(self.monitor.slow_callbacks, {})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,49 @@
+import unittest
+
+from utils.metrics import MetricsRegistry
+
+
+class MetricsRegistryTests(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.registry = MetricsRegistry()
+
+    def test_counters_and_gauges_are_rendered(self):
+        accepts = self.registry.counter('accepts_total', 'Accepted clients', ['country'])
+        accepts.labels('DE').inc()
+        accepts.labels('DE').inc(2)
+        accepts.labels('B"E').inc()
+        self.registry.gauge('open_tunnels', 'Open tunnels').set_function(lambda: 7)
+        self.assertEqual(self.registry.render(),
+                         '# HELP accepts_total Accepted clients\n'
+                         '# TYPE accepts_total counter\n'
+                         'accepts_total{country="B\\"E"} 1\n'
+                         'accepts_total{country="DE"} 3\n'
+                         '# HELP open_tunnels Open tunnels\n'
+                         '# TYPE open_tunnels gauge\n'
+                         'open_tunnels 7\n')
+
+    def test_histogram_buckets_are_cumulative(self):
+        latency = self.registry.histogram('write_seconds', 'Writes', buckets=(0.1, 1))
+        for value in (0.05, 0.5, 0.5, 3):
+            latency.observe(value)
+        samples = self.registry.samples()
+        self.assertEqual(samples[('write_seconds', '_bucket', (('le', '0.1'),))], 1)
+        self.assertEqual(samples[('write_seconds', '_bucket', (('le', '1'),))], 3)
+        self.assertEqual(samples[('write_seconds', '_bucket', (('le', '+Inf'),))], 4)
+        self.assertEqual(samples[('write_seconds', '_count', ())], 4)
+        self.assertEqual(samples[('write_seconds', '_sum', ())], 4.05)
+
+    def test_collectors_are_summed_with_local_samples(self):
+        self.registry.counter('pops_total', 'Pops').inc(2)
+        self.registry.add_collector(lambda: {('pops_total', '', ()): 5})
+        self.assertIn('pops_total 7\n', self.registry.render())
+
+    def test_labels_must_match(self):
+        counter = self.registry.counter('misses_total', 'Misses', ['country', 'asn'])
+        with self.assertRaises(ValueError):
+            counter.labels('DE')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,120 @@
+import selectors
+import socket
+import unittest
+
+from bandwidth_shaper import DeviceBandwidth
+from mux_session import MuxSession, FRAME_HEADER, FRAME_OPEN, FRAME_DATA, FRAME_CLOSE, FRAME_WINDOW, INITIAL_STREAM_WINDOW, \
+    encode_frame
+from utils.timer_wheel import TimerWheel
+
+
+class MuxSessionTests(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.selector = selectors.DefaultSelector()
+        self.device_socket, peer_socket = socket.socketpair()
+        self.device_socket.settimeout(1)
+        self.closed_streams = []
+        self.session = MuxSession(peer_socket, 'device', 'us', 1, 2, self.selector, [],
+                                  self.closed_streams.append, lambda _: None)
+
+    def tearDown(self) -> None:
+        self.session.close()
+        self.device_socket.close()
+        self.selector.close()
+
+    def _run_selector(self, rounds=5):
+        for _ in range(rounds):
+            for key, mask in self.selector.select(timeout=0.05):
+                key.data(key.fileobj, mask)
+
+    def _recv_frame(self):
+        header = self.device_socket.recv(FRAME_HEADER.size)
+        _, frame_type, stream_id, length = FRAME_HEADER.unpack(header)
+        payload = self.device_socket.recv(length) if length else b''
+        return frame_type, stream_id, payload
+
+    def test_streams_share_the_device_socket(self):
+        client_one, yogurt_one = socket.socketpair()
+        client_two, yogurt_two = socket.socketpair()
+        stream_one = self.session.open_stream(yogurt_one)
+        stream_two = self.session.open_stream(yogurt_two)
+        self.assertFalse(self.session.has_capacity())
+        self._run_selector()
+        self.assertEqual(self._recv_frame(), (FRAME_OPEN, stream_one.stream_id, b''))
+        self.assertEqual(self._recv_frame(), (FRAME_OPEN, stream_two.stream_id, b''))
+
+        client_two.sendall(b'to device')
+        self._run_selector()
+        self.assertEqual(self._recv_frame(), (FRAME_DATA, stream_two.stream_id, b'to device'))
+        self.assertEqual(stream_two.send_window, INITIAL_STREAM_WINDOW - len(b'to device'))
+
+        self.device_socket.sendall(encode_frame(FRAME_DATA, stream_one.stream_id, b'to client'))
+        self._run_selector()
+        self.assertEqual(client_one.recv(100), b'to client')
+
+        self.device_socket.sendall(encode_frame(FRAME_CLOSE, stream_one.stream_id))
+        self._run_selector()
+        self.assertEqual(self.closed_streams, [stream_one])
+        self.assertTrue(self.session.has_capacity())
+        client_one.close()
+        client_two.close()
+
+    def test_malformed_window_frame_closes_the_session(self):
+        client, yogurt = socket.socketpair()
+        stream = self.session.open_stream(yogurt)
+        self._run_selector()
+        self._recv_frame()
+        self.device_socket.sendall(encode_frame(FRAME_WINDOW, stream.stream_id, b'\x01'))
+        self._run_selector()
+        self.assertTrue(self.session.closed)
+        self.assertEqual(self.closed_streams, [stream])
+        self.assertEqual(self.device_socket.recv(100), b'')
+        client.close()
+
+    def test_payload_stamps_stream_activity(self):
+        self.session.timer_wheel = TimerWheel(1, 0)
+        client, yogurt = socket.socketpair()
+        stream = self.session.open_stream(yogurt)
+        self._run_selector()
+        self._recv_frame()
+        self.session.timer_wheel.advance(5)
+        client.sendall(b'to device')
+        self._run_selector()
+        self.assertEqual(stream.last_activity_tick, 5)
+        self.session.timer_wheel.advance(9)
+        self.device_socket.sendall(encode_frame(FRAME_DATA, stream.stream_id, b'to client'))
+        self._run_selector()
+        self.assertEqual(stream.last_activity_tick, 9)
+        client.close()
+
+    def test_reads_are_shaped_by_the_device_bandwidth(self):
+        self.session.timer_wheel = TimerWheel(1, 0)
+        self.session.bandwidth = DeviceBandwidth('device', {'download': 4, 'upload': 3}, 1, 0)
+        client, yogurt = socket.socketpair()
+        stream = self.session.open_stream(yogurt)
+        self._run_selector()
+        self._recv_frame()
+
+        client.sendall(b'to device')
+        self._run_selector()
+        self.assertEqual(self._recv_frame(), (FRAME_DATA, stream.stream_id, b'to d'))
+        self.assertIsNotNone(stream.throttle_timer)
+        self.session.timer_wheel.advance(1)
+        self._run_selector()
+        self.assertEqual(self._recv_frame(), (FRAME_DATA, stream.stream_id, b'evic'))
+
+        self.device_socket.sendall(encode_frame(FRAME_DATA, stream.stream_id, b'to client'))
+        self._run_selector()
+        self.assertIsNotNone(self.session.throttle_timer)
+        self.assertEqual(self.session.bandwidth.window_bytes['upload'], 3)
+        for second in range(2, 10):
+            self.session.timer_wheel.advance(second)
+            self._run_selector()
+        self.assertEqual(client.recv(100), b'to client')
+        client.sendall(b'to device')
+        self._run_selector()
+        self.assertIsNotNone(stream.throttle_timer)
+        self.session.close()
+        self.assertEqual(len(self.session.timer_wheel), 0)
+        client.close()
@@ -0,0 +1,64 @@
+import socket
+import time
+import unittest
+
+from connection_pool import ConnectionPool
+from data_classes.connection import Connection
+from peer_liveness_monitor import PeerLivenessMonitor
+
+HANG_UP_WAIT_SECONDS = 0.2
+
+
+@unittest.skipUnless(PeerLivenessMonitor.is_supported(), 'needs epoll and TCP_USER_TIMEOUT')
+class PeerLivenessMonitorTests(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.pool = ConnectionPool(passive_liveness=True)
+        self.listener = socket.create_server(('127.0.0.1', 0))
+        self.sockets = [self.listener]
+
+    def tearDown(self) -> None:
+        self.pool.close_all_connections()
+        for sock in self.sockets:
+            sock.close()
+
+    def _insert(self, device_id: str) -> (Connection, socket.socket):
+        pool_side = socket.create_connection(self.listener.getsockname())
+        device_side, _ = self.listener.accept()
+        self.sockets += [pool_side, device_side]
+        connection = Connection(pool_side, 'us', '1', device_id)
+        self.pool.insert(connection)
+        return connection, device_side
+
+    def test_hung_up_peer_is_removed(self):
+        alive, _ = self._insert('alive')
+        dead, dead_device = self._insert('dead')
+        dead_device.close()
+        time.sleep(HANG_UP_WAIT_SECONDS)
+        self.assertIn(alive, self.pool.available_connections)
+        self.assertNotIn(dead, self.pool.available_connections)
+        self.assertEqual(dead.socket.fileno(), -1)
+        self.assertEqual(len(self.pool.liveness_monitor), 1)
+
+    def test_popped_peer_is_no_longer_watched(self):
+        connection, device = self._insert('popped')
+        self.assertEqual(self.pool.pop_connection_by_country('us'), connection)
+        self.assertEqual(len(self.pool.liveness_monitor), 0)
+        device.close()
+        time.sleep(HANG_UP_WAIT_SECONDS)
+        # the tunnel owns the socket and closes it itself.
+        self.assertNotEqual(connection.socket.fileno(), -1)
+
+    def test_kernel_keepalive_is_tuned(self):
+        connection, _ = self._insert('tuned')
+        sock = connection.socket
+        self.assertEqual(sock.getsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE), 1)
+        self.assertEqual(sock.getsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE), 60)
+        self.assertEqual(sock.getsockopt(socket.IPPROTO_TCP, socket.TCP_USER_TIMEOUT), 120 * 1000)
+
+    def test_deep_probes_are_rare(self):
+        self.assertGreater(self.pool.keep_alive_interval, ConnectionPool.FULL_KEEP_ALIVE_INTERVAL)
+
+
+if __name__ == '__main__':
+    unittest.main()
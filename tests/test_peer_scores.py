@@ -0,0 +1,70 @@
+import unittest
+
+from utils.peer_scores import PeerScores, TunnelSetupTimer, merge_distributions, PROBE
+
+
+class PeerScoresTests(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.scores = PeerScores(max_devices=3, smoothing=0.5, unmeasured_rtt_seconds=0.3, failure_penalty_seconds=2)
+        for device_id, asn in (('fast', '1'), ('slow', '1'), ('new', '2')):
+            self.scores.track(device_id, 'us', asn)
+
+    def test_score_follows_rtt_and_failures(self):
+        self.scores.record_rtt('fast', 0.05, PROBE)
+        self.scores.record_rtt('slow', 0.5, PROBE)
+        self.assertEqual(self.scores.score('fast'), 0.05)
+        self.assertEqual(self.scores.score('new'), 0.3)
+        self.assertEqual(self.scores.score('unknown'), 0.3)
+        self.scores.record_rtt('slow', 0.1, PROBE)
+        self.assertAlmostEqual(self.scores.score('slow'), 0.3)
+        self.scores.record_failure('fast', PROBE)
+        self.assertAlmostEqual(self.scores.score('fast'), 1.05)
+        self.scores.record_rtt('fast', 0.05, PROBE)
+        self.assertAlmostEqual(self.scores.score('fast'), 0.55)
+
+    def test_devices_seen_last_are_kept(self):
+        self.scores.track('fast', 'us', '1')
+        self.scores.track('newer', 'uk', '3')
+        self.assertEqual(len(self.scores), 3)
+        self.scores.record_rtt('slow', 0.01, PROBE)
+        self.assertEqual(self.scores.score('slow'), 0.3)
+
+    def test_distribution_by_country_and_asn(self):
+        self.scores.record_rtt('fast', 0.02, PROBE)
+        self.scores.record_rtt('slow', 0.5, PROBE)
+        self.scores.record_failure('new', PROBE)
+        distribution = self.scores.distribution()
+        us = distribution['us']
+        self.assertEqual(us['devices'], 3)
+        self.assertAlmostEqual(us['failure_rate'], 0.5 / 3)
+        self.assertEqual({label: count for label, count in us['rtt_ms'].items() if count}, {'25': 1, '800': 1})
+        self.assertEqual(us['asns']['2']['devices'], 1)
+        self.assertEqual(sum(us['asns']['2']['rtt_ms'].values()), 0)
+        other = PeerScores()
+        other.track('other', 'us', '2')
+        other.record_rtt('other', 0.02, PROBE)
+        merged = merge_distributions([distribution, other.distribution()])
+        self.assertEqual(merged['us']['devices'], 4)
+        self.assertAlmostEqual(merged['us']['failure_rate'], 0.5 / 4)
+        self.assertEqual(merged['us']['rtt_ms']['25'], 2)
+        self.assertEqual(merged['us']['asns']['2']['rtt_ms']['25'], 1)
+
+    def test_tunnel_setup_timer(self):
+        setup = TunnelSetupTimer(self.scores, 'fast')
+        setup.peer_failed()
+        setup.peer_answered(1)
+        self.assertEqual(self.scores.score('fast'), 0.3)
+        setup.client_sent(10)
+        setup.client_sent(11)
+        setup.peer_answered(10.2)
+        setup.peer_failed()
+        self.assertAlmostEqual(self.scores.score('fast'), 0.2)
+        setup = TunnelSetupTimer(self.scores, 'slow')
+        setup.client_sent(10)
+        setup.peer_failed()
+        self.assertAlmostEqual(self.scores.score('slow'), 1.3)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,7 +1,11 @@
 import socket
 import time
 import unittest
+from typing import Tuple
 
+from benchmarks.handshake_benchmark import HandshakeBenchmark
+from benchmarks.in_memory_database import InMemoryDatabase
+from config import config
 from connection_pool import ConnectionPool
 from database import Database
 from data_classes.device_details import DeviceDetails
@@ -55,3 +59,136 @@ class PeerServerTests(unittest.TestCase):
         self.assertEqual(sent, len(self.bytes_to_send))
         sent2 = self.s2.send(self.bytes_to_send)
         self.assertEqual(sent2, len(self.bytes_to_send))
+
+
+class StubGeoIpPeerServer(PeerServer):
+    def _check_geoip_db(self, geoip_db_list: list):
+        return True
+
+    @staticmethod
+    def _ip_to_cc_asn(ip) -> Tuple[str, str]:
+        return 'IL', '1'
+
+
+class FailingDatabase(InMemoryDatabase):
+    def find_one(self, collection: str, query: dict):
+        raise ConnectionError('db is down')
+
+
+class ChokedSocket:
+    """
+    Socket whose first send finds the send buffer full.
+    """
+
+    def __init__(self, sock: socket.socket) -> None:
+        self.sock = sock
+        self.choked = True
+
+    def send(self, data) -> int:
+        if self.choked:
+            self.choked = False
+            raise BlockingIOError()
+        return self.sock.send(data)
+
+    def __getattr__(self, name):
+        return getattr(self.sock, name)
+
+
+class HandshakePipelineTests(unittest.TestCase):
+    def setUp(self) -> None:
+        self.original_timeout = config.get('peer_handshake_timeout_seconds')
+        config['peer_handshake_timeout_seconds'] = 0.3
+        self.port = 8010
+        self.pool = ConnectionPool(passive_liveness=False)
+        self.pool.prober.stop()
+        self.db = InMemoryDatabase()
+        self.server = StubGeoIpPeerServer(self.db, self.port, self.pool)
+        self.sockets = []
+
+    def tearDown(self) -> None:
+        config['peer_handshake_timeout_seconds'] = self.original_timeout
+        self.server.stop(wait=True)
+        for sock in self.sockets:
+            sock.close()
+
+    def _connect(self) -> socket.socket:
+        sock = socket.create_connection(('127.0.0.1', self.port))
+        self.sockets.append(sock)
+        return sock
+
+    def _wait_for(self, condition):
+        deadline = time.monotonic() + 2
+        while not condition() and time.monotonic() < deadline:
+            time.sleep(0.01)
+        return condition()
+
+    def test_silent_device_does_not_block_others(self):
+        self.server.start()
+        time.sleep(0.2)
+        self._connect()
+        self._connect().sendall(b'353627071234564,sdjfhsdjkfhsdjkf,1')
+        self.assertTrue(self._wait_for(lambda: len(self.pool) == 1))
+        self.assertEqual(self.pool.get_all_device_ids(), ['353627071234564'])
+        self.assertTrue(self._wait_for(lambda: self.db.find_one(DeviceDetails.COLLECTION_NAME, {DeviceDetails.IMEI: '353627071234564'})))
+
+    def test_handshake_split_between_segments(self):
+        self.server.start()
+        time.sleep(0.2)
+        device = self._connect()
+        device.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        device.sendall(b'353627071234564,sdjf')
+        time.sleep(0.05)
+        device.sendall(b'hsdjkfhsdjkf,1')
+        self.assertTrue(self._wait_for(lambda: self.db.find_one(DeviceDetails.COLLECTION_NAME, {DeviceDetails.IMEI: '353627071234564'})))
+        device_details = self.db.find_one(DeviceDetails.COLLECTION_NAME, {DeviceDetails.IMEI: '353627071234564'})
+        self.assertEqual(device_details[DeviceDetails.FCM_ID], 'sdjfhsdjkfhsdjkf')
+        self.assertEqual(device_details[DeviceDetails.APP_VERSION], '1')
+
+    def test_handshake_with_mux_version_does_not_wait_to_settle(self):
+        self.server.start()
+        time.sleep(0.2)
+        device = self._connect()
+        device.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        device.sendall(b'353627071234564,sdjfhsdjkfhsdjkf,1')
+        time.sleep(0.05)
+        sent = time.monotonic()
+        device.sendall(b',0')
+        self.assertTrue(self._wait_for(lambda: len(self.pool) == 1))
+        self.assertLess(time.monotonic() - sent, PeerServer.HANDSHAKE_SETTLE_SECONDS)
+
+    def test_hello_waits_for_a_writable_socket(self):
+        self.addCleanup(config.__setitem__, 'mux_enabled', config.get('mux_enabled'))
+        config['mux_enabled'] = True
+        device, peer = socket.socketpair()
+        self.sockets += [device, peer]
+        peer.setblocking(False)
+        self.server._handle_new_connection(ChokedSocket(peer), ('127.0.0.1', 1), b'353627071234564,sdjfhsdjkfhsdjkf,1,1')
+        self.assertEqual(len(self.server.pending_hellos), 1)
+        self.assertEqual(len(self.pool), 0)
+        for key, _ in self.server.selector.select(1):
+            key.data()
+        self.assertEqual(len(self.server.pending_hellos), 0)
+        self.assertEqual(self.pool.get_all_device_ids(), ['353627071234564'])
+        device.settimeout(1)
+        self.assertTrue(device.recv(64))
+
+    def test_silent_device_is_disconnected_after_timeout(self):
+        self.server.start()
+        time.sleep(0.2)
+        silent = self._connect()
+        silent.settimeout(2)
+        self.assertEqual(silent.recv(1), b'')
+        self.assertEqual(len(self.server.pending_handshakes), 0)
+
+    def test_device_stays_in_pool_when_db_write_fails(self):
+        self.server = StubGeoIpPeerServer(FailingDatabase(), self.port, self.pool)
+        self.server.start()
+        time.sleep(0.2)
+        self._connect().sendall(b'353627071234564,sdjfhsdjkfhsdjkf,1')
+        self.assertTrue(self._wait_for(lambda: len(self.pool) == 1))
+
+    def test_silent_devices_and_slow_db_do_not_fail_handshakes(self):
+        results = HandshakeBenchmark(handshakes=200, concurrency=16, silent_devices=4, db_latency_seconds=0.005, timeout_seconds=2,
+                                     peer_port=8011).run()
+        self.assertEqual(results['failed'], 0)
+        self.assertEqual(results['handshakes'], 200)
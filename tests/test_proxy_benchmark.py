@@ -0,0 +1,47 @@
+import json
+import os
+import tempfile
+import unittest
+
+from benchmarks.in_memory_database import InMemoryDatabase
+from benchmarks.proxy_benchmark import main, percentile, compare
+
+
+class InMemoryDatabaseTests(unittest.TestCase):
+
+    def test_find_update_delete(self):
+        db = InMemoryDatabase()
+        db.insert_one('devices', {'imei': '1', 'country': 'IL'})
+        db.insert_many('devices', [{'imei': '2', 'country': 'IL'}, {'imei': '3', 'country': 'US'}])
+        device = db.find_one('devices', {'imei': '2'})
+        db.update_one('devices', device['_id'], {'country': 'US'})
+        self.assertEqual([d['imei'] for d in db.find('devices', {'country': 'US'})], ['2', '3'])
+        db.delete_many('devices', {'country': 'US'})
+        self.assertEqual(len(db.find('devices')), 1)
+
+
+class ProxyBenchmarkTests(unittest.TestCase):
+
+    def test_percentile(self):
+        values = list(range(1, 101))
+        self.assertEqual(percentile(values, 0.5), 51)
+        self.assertEqual(percentile(values, 0.99), 100)
+        self.assertEqual(percentile([], 0.5), 0)
+
+    def test_smoke_run_writes_comparable_results(self):
+        with tempfile.TemporaryDirectory() as directory:
+            output = os.path.join(directory, 'results.json')
+            main(['--devices', '2', '--clients', '4', '--bulk-mb', '2', '--rr-seconds', '0.2',
+                  '--country-port', '19180', '--peer-port', '19181', '--output', output])
+            with open(output) as results_file:
+                results = json.load(results_file)
+            self.assertEqual(results['engine'], 'selectors')
+            self.assertGreater(results['results']['bulk_download_mb_per_second'], 0)
+            self.assertGreater(results['results']['bulk_upload_mb_per_second'], 0)
+            self.assertGreater(results['results']['round_trips_per_second'], 0)
+            self.assertIn('p99', results['results']['tunnel_setup_ms'])
+            self.assertIn('bulk_upload_mb_per_second', compare([output, output]))
+
+
+if __name__ == '__main__':
+    unittest.main()
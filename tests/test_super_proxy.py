@@ -1,14 +1,26 @@
+import selectors
 import socket
 import time
 import unittest
+from threading import Thread
+from unittest import mock
 
 import requests
 from infrastructure.wrappers.mongo import Mongo
 
+from benchmarks.in_memory_database import InMemoryDatabase
+from config import config
 from connection_pool import ConnectionPool
+from data_classes.connection import Connection
 from database import Database
+from dataplan_tracker import Collection
+from mux_session import FRAME_HEADER, FRAME_OPEN, FRAME_DATA, FRAME_CLOSE, encode_frame
 from peer_server import PeerServer
-from super_proxy import SuperProxy
+from super_proxy import SuperProxy, CLOSING_PACKET
+from utils.splice_relay import SpliceRelay
+
+SOCKS_CLIENT_HANDSHAKE = [b'\x05\x01\x00', b'\x05\x01\x00\x01' + socket.inet_aton('1.2.3.4') + (443).to_bytes(2, 'big')]
+SOCKS_DEVICE_HANDSHAKE = [b'\x05\x00', b'\x05\x00\x00\x01' + socket.inet_aton('1.2.3.4') + (443).to_bytes(2, 'big')]
 
 
 class SuperProxyTests(unittest.TestCase):
@@ -55,6 +67,274 @@ class SuperProxyTests(unittest.TestCase):
         string_received = client_socket.recv(len(string_to_send))
         self.assertEqual(string_received, string_to_send)
 
+    def test_backpressure_when_peer_does_not_read(self):
+        peer_socket = socket.socket()
+        peer_socket.connect(('127.0.0.1', self.peer_port))
+        peer_socket.sendall('35362707123456413536270712345641,askhdgashdgashjdkhjkd'.encode())
+        time.sleep(0.4)
+
+        client_socket = socket.socket()
+        client_socket.connect(('127.0.0.1', 5678))
+        greeting = b'\x05\x01\x00'
+        client_socket.sendall(greeting)
+        self.assertEqual(peer_socket.recv(len(greeting)), greeting)
+        peer_socket.sendall(b'\x05\x00')
+        self.assertEqual(client_socket.recv(2), b'\x05\x00')
+        connect_request = b'\x05\x01\x00\x01' + socket.inet_aton('1.2.3.4') + (443).to_bytes(2, 'big')
+        client_socket.sendall(connect_request)
+        self.assertEqual(peer_socket.recv(len(connect_request)), connect_request)
+        connect_response = b'\x05\x00\x00\x01' + socket.inet_aton('1.2.3.4') + (443).to_bytes(2, 'big')
+        peer_socket.sendall(connect_response)
+        self.assertEqual(client_socket.recv(len(connect_response)), connect_response)
+
+        # The peer doesn't read, so the tunnel buffer fills up and the client side stops being read.
+        data = bytes(5 * 1024 * 1024)
+        sender = Thread(target=client_socket.sendall, args=(data,))
+        sender.start()
+        time.sleep(1)
+        self.assertGreater(self.super_proxy.backpressure_events, 0)
+
+        received = b''
+        while len(received) < len(data):
+            received += peer_socket.recv(1024 * 1024)
+        sender.join()
+        self.assertEqual(received, data)
+
+    def test_closing_packet_follows_buffered_data(self):
+        peer_socket = socket.socket()
+        peer_socket.connect(('127.0.0.1', self.peer_port))
+        peer_socket.sendall('35362707123456413536270712345641,askhdgashdgashjdkhjkd'.encode())
+        time.sleep(0.4)
+
+        # The peer doesn't read until the client is gone, so the tunnel still buffers data for it when it closes.
+        client_socket = socket.socket()
+        client_socket.connect(('127.0.0.1', 5678))
+        data = bytes(5 * 1024 * 1024)
+        client_socket.sendall(data)
+        client_socket.close()
+        time.sleep(1)
+
+        received = b''
+        while True:
+            chunk = peer_socket.recv(1024 * 1024)
+            if not chunk:
+                break
+            received += chunk
+        self.assertEqual(received, data + CLOSING_PACKET)
+
     @staticmethod
     def _send_request(port, req_type, param, value):
         return requests.get('http://127.0.0.1:{0}/{1}?{2}={3}'.format(port, req_type, param, value))
+
+
+class TunnelTests(unittest.TestCase):
+    """
+    Tunnels to a device that is inserted into the pool directly, without a PeerServer.
+    """
+
+    def setUp(self) -> None:
+        self.port = 8557
+        self.db = InMemoryDatabase()
+        self.pool = ConnectionPool(passive_liveness=False)
+        self.pool.prober.stop()
+        self.listening_socket = socket.socket()
+        self.listening_socket.bind(('127.0.0.1', 0))
+        self.listening_socket.listen(1)
+        self.device_socket = socket.create_connection(self.listening_socket.getsockname())
+        self.device_socket.settimeout(5)
+        self.peer_socket, _ = self.listening_socket.accept()
+        self.super_proxy = None
+
+    def tearDown(self) -> None:
+        if self.super_proxy is not None:
+            self.super_proxy.shutdown()
+            self._wait_for(lambda: not self.super_proxy.sockets)
+        self.device_socket.close()
+        self.listening_socket.close()
+
+    def _start_proxy(self, mux_version=0, **overrides):
+        for key, value in {'service_whitelist_enabled': False, **overrides}.items():
+            self.addCleanup(config.__setitem__, key, config.get(key))
+            config[key] = value
+        self.pool.insert(Connection(self.peer_socket, 'GB', '1234', 'device', mux_version))
+        self.super_proxy = SuperProxy({'GB': self.port}, self.pool, db=self.db)
+
+    def _connect_client(self) -> socket.socket:
+        client_socket = socket.create_connection(('127.0.0.1', self.port))
+        client_socket.settimeout(5)
+        self.addCleanup(client_socket.close)
+        return client_socket
+
+    def _socks_handshake(self, client_socket: socket.socket):
+        for request, response in zip(SOCKS_CLIENT_HANDSHAKE, SOCKS_DEVICE_HANDSHAKE):
+            client_socket.sendall(request)
+            self.assertEqual(self._recv_exactly(self.device_socket, len(request)), request)
+            self.device_socket.sendall(response)
+            self.assertEqual(self._recv_exactly(client_socket, len(response)), response)
+
+    @staticmethod
+    def _recv_exactly(sock: socket.socket, size: int) -> bytes:
+        received = bytearray()
+        while len(received) < size:
+            chunk = sock.recv(size - len(received))
+            if not chunk:
+                break
+            received += chunk
+        return bytes(received)
+
+    @staticmethod
+    def _recv_until_closed(sock: socket.socket) -> bytes:
+        received = bytearray()
+        while True:
+            chunk = sock.recv(1024 * 1024)
+            if not chunk:
+                return bytes(received)
+            received += chunk
+
+    @staticmethod
+    def _wait_for(condition, timeout=5) -> bool:
+        deadline = time.monotonic() + timeout
+        while not condition() and time.monotonic() < deadline:
+            time.sleep(0.01)
+        return condition()
+
+    def _dataplan_amounts(self):
+        return {document[Collection.FIELD_DIRECTION]: document[Collection.FIELD_AMOUNT]
+                for document in self.db.find(Collection.COLLECTION_NAME, {Collection.FIELD_DEVICE_ID: 'device'})}
+
+    def test_splice_relay_moves_bulk_data_and_closes_after_the_pipes_drained(self):
+        self._start_proxy(splice_relay_enabled=True)
+        with mock.patch('super_proxy.SpliceRelay', wraps=SpliceRelay) as splice_relay:
+            client_socket = self._connect_client()
+            self._socks_handshake(client_socket)
+
+            to_client = bytes(range(256)) * 8 * 1024
+            sender = Thread(target=self.device_socket.sendall, args=(to_client,))
+            sender.start()
+            self.assertEqual(self._recv_exactly(client_socket, len(to_client)), to_client)
+            sender.join()
+            self.assertEqual(splice_relay.call_count, 1)
+
+            # The device doesn't read yet, so the pipe towards it fills up and the client side stops being read.
+            to_device = bytes(reversed(range(256))) * 64 * 1024
+            sender = Thread(target=lambda: (client_socket.sendall(to_device), client_socket.close()))
+            sender.start()
+            self.assertTrue(self._wait_for(lambda: self.super_proxy.backpressure_events > 0))
+            sender.join(timeout=1)
+            # The client may be gone already, but the device keeps its socket until it took every spliced byte.
+            self.assertEqual(len(self.super_proxy.get_active_sockets()), 1)
+
+            self.assertEqual(self._recv_until_closed(self.device_socket), to_device + CLOSING_PACKET)
+            sender.join()
+        self.assertTrue(self._wait_for(lambda: not self.super_proxy.get_active_sockets()))
+        self.assertEqual(self._dataplan_amounts(), {
+            Collection.DIRECTION_DOWNLOAD: sum(map(len, SOCKS_CLIENT_HANDSHAKE)) + len(to_device),
+            Collection.DIRECTION_UPLOAD: sum(map(len, SOCKS_DEVICE_HANDSHAKE)) + len(to_client)})
+
+    def test_silent_tunnel_is_closed_after_the_handshake_timeout(self):
+        self._start_proxy(tunnel_handshake_timeout_seconds=0.3)
+        opened = time.monotonic()
+        client_socket = self._connect_client()
+        self.assertEqual(client_socket.recv(1), b'')
+        self.assertGreaterEqual(time.monotonic() - opened, 0.3)
+        self.assertEqual(self._recv_until_closed(self.device_socket), CLOSING_PACKET)
+        self.assertEqual(self.super_proxy.handshake_timeouts, 1)
+        self.assertTrue(self._wait_for(lambda: not self.super_proxy.get_active_sockets()))
+        self.assertEqual(self.pool.count_used_connections(), 0)
+        self.assertEqual(self._dataplan_amounts(), {Collection.DIRECTION_DOWNLOAD: 0, Collection.DIRECTION_UPLOAD: 0})
+
+    def test_idle_tunnel_is_closed_after_the_idle_timeout(self):
+        self._start_proxy(tunnel_handshake_timeout_seconds=0.3, tunnel_idle_timeout_seconds=0.5)
+        client_socket = self._connect_client()
+        self._socks_handshake(client_socket)
+        # Traffic past the handshake timeout, but within the idle timeout, keeps the tunnel open.
+        time.sleep(0.4)
+        client_socket.sendall(b'ping')
+        self.assertEqual(self._recv_exactly(self.device_socket, 4), b'ping')
+        last_activity = time.monotonic()
+        self.assertEqual(client_socket.recv(1), b'')
+        self.assertGreaterEqual(time.monotonic() - last_activity, 0.4)
+        self.assertEqual(self._recv_until_closed(self.device_socket), CLOSING_PACKET)
+        self.assertEqual((self.super_proxy.handshake_timeouts, self.super_proxy.idle_timeouts), (0, 1))
+        self.assertTrue(self._wait_for(lambda: not self.super_proxy.get_active_sockets()))
+        self.assertEqual(self.pool.count_used_connections(), 0)
+
+    def _recv_frame(self):
+        _, frame_type, stream_id, length = FRAME_HEADER.unpack(self._recv_exactly(self.device_socket, FRAME_HEADER.size))
+        return frame_type, stream_id, self._recv_exactly(self.device_socket, length)
+
+    def test_silent_mux_stream_and_idle_mux_session_are_closed(self):
+        self._start_proxy(mux_version=1, tunnel_handshake_timeout_seconds=0.3, tunnel_idle_timeout_seconds=0.5)
+        client_socket = self._connect_client()
+        frame_type, stream_id, _ = self._recv_frame()
+        self.assertEqual(frame_type, FRAME_OPEN)
+        self.assertEqual(client_socket.recv(1), b'')
+        self.assertEqual(self._recv_frame(), (FRAME_CLOSE, stream_id, b''))
+        self.assertEqual(self.super_proxy.handshake_timeouts, 1)
+        self.assertEqual(self.pool.count_used_connections(), 1)
+        # Without streams the session gives the device back once the idle timeout passed.
+        stream_closed = time.monotonic()
+        self.assertEqual(self._recv_until_closed(self.device_socket), b'')
+        self.assertGreaterEqual(time.monotonic() - stream_closed, 0.4)
+        self.assertTrue(self._wait_for(lambda: self.pool.count_used_connections() == 0))
+        self.assertEqual(self.super_proxy.mux_sessions['GB'], [])
+
+    def _assert_delivered_at(self, rate: int, burst: int, amount: int, elapsed: float):
+        expected = (amount - burst) / rate
+        self.assertAlmostEqual(elapsed, expected, delta=0.3 * expected)
+
+    def test_rate_limited_tunnel_is_parked_until_its_bucket_refills(self):
+        rate, burst_seconds = 256 * 1024, 0.25
+        self._start_proxy(device_bandwidth_limits={'default': {'download': rate}}, device_bandwidth_burst_seconds=burst_seconds)
+        resumes = []
+        on_throttle_timeout = SuperProxy._on_throttle_timeout
+
+        def record_resume(proxy, conn, tunnel):
+            key = proxy.selector.get_map().get(conn)
+            parked = key is None or not key.events & selectors.EVENT_READ
+            on_throttle_timeout(proxy, conn, tunnel)
+            resumes.append((conn is tunnel.yogurt_socket, parked, tunnel.reading[conn]))
+
+        with mock.patch.object(SuperProxy, '_on_throttle_timeout', autospec=True, side_effect=record_resume):
+            client_socket = self._connect_client()
+            self._socks_handshake(client_socket)
+            data = bytes(512 * 1024)
+            started = time.monotonic()
+            sender = Thread(target=client_socket.sendall, args=(data,))
+            sender.start()
+            self.assertEqual(self._recv_exactly(self.device_socket, len(data)), data)
+            elapsed = time.monotonic() - started
+            sender.join()
+        self._assert_delivered_at(rate, int(rate * burst_seconds), len(data), elapsed)
+        self.assertTrue(resumes)
+        # Only the client side is limited, it is out of the selector while it waits and reads again once its timer fired.
+        self.assertEqual(set(resumes), {(True, True, True)})
+
+    def test_rate_limited_mux_stream_is_shaped(self):
+        rate, burst_seconds = 128 * 1024, 0.25
+        self._start_proxy(mux_version=1, device_bandwidth_limits={'default': {'download': rate}},
+                          device_bandwidth_burst_seconds=burst_seconds)
+        client_socket = self._connect_client()
+        frame_type, stream_id, _ = self._recv_frame()
+        self.assertEqual(frame_type, FRAME_OPEN)
+        for request, response in zip(SOCKS_CLIENT_HANDSHAKE, SOCKS_DEVICE_HANDSHAKE):
+            client_socket.sendall(request)
+            self.assertEqual(self._recv_frame(), (FRAME_DATA, stream_id, request))
+            self.device_socket.sendall(encode_frame(FRAME_DATA, stream_id, response))
+            self.assertEqual(self._recv_exactly(client_socket, len(response)), response)
+        # Within the stream's window, so the device doesn't need to grant more.
+        data = bytes(192 * 1024)
+        started = time.monotonic()
+        sender = Thread(target=client_socket.sendall, args=(data,))
+        sender.start()
+        received = 0
+        while received < len(data):
+            frame_type, frame_stream_id, payload = self._recv_frame()
+            self.assertEqual((frame_type, frame_stream_id), (FRAME_DATA, stream_id))
+            received += len(payload)
+        elapsed = time.monotonic() - started
+        sender.join()
+        self._assert_delivered_at(rate, int(rate * burst_seconds), len(data), elapsed)
+        self.assertEqual(list(self.super_proxy.bandwidth_shaper.devices), ['device'])
+        self.super_proxy.mux_sessions['GB'][0].close()
+        self.assertTrue(self._wait_for(lambda: not self.super_proxy.bandwidth_shaper.devices))
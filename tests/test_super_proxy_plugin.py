@@ -0,0 +1,49 @@
+import socket
+import unittest
+
+from super_proxy_plugin import SuperProxyPlugin, TunnelPlugins, BYTE_COUNTS_ONLY
+
+
+class RecordingPlugin(SuperProxyPlugin):
+    def __init__(self, packet_window):
+        self.packet_window = packet_window
+        self.packets = []
+        self.byte_counts = {}
+
+    def register(self, yogurt_socket, peer_socket, peer_id):
+        pass
+
+    def unregister(self, any_socket):
+        pass
+
+    def packet_transmitted(self, source, target, data):
+        self.packets.append(bytes(data))
+
+    def bytes_transmitted(self, source, target, amount):
+        self.byte_counts[source] = amount
+
+
+class TunnelPluginsTests(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.yogurt_socket = socket.socket()
+        self.peer_socket = socket.socket()
+
+    def tearDown(self) -> None:
+        self.yogurt_socket.close()
+        self.peer_socket.close()
+
+    def test_packet_windows(self):
+        first_two = RecordingPlugin(2)
+        counts_only = RecordingPlugin(BYTE_COUNTS_ONLY)
+        tunnel_plugins = TunnelPlugins([first_two, counts_only], self.yogurt_socket, self.peer_socket)
+        for data in (b'a', b'bb', b'ccc'):
+            tunnel_plugins.packet_transmitted(self.yogurt_socket, self.peer_socket, memoryview(data))
+        self.assertFalse(tunnel_plugins.is_inspected())
+        tunnel_plugins.bytes_transmitted(self.peer_socket, 10)
+        tunnel_plugins.report_byte_counts()
+
+        self.assertEqual(first_two.packets, [b'a', b'bb'])
+        self.assertEqual(first_two.byte_counts, {self.yogurt_socket: 3, self.peer_socket: 10})
+        self.assertEqual(counts_only.packets, [])
+        self.assertEqual(counts_only.byte_counts, {self.yogurt_socket: 6, self.peer_socket: 10})
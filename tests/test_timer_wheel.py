@@ -0,0 +1,50 @@
+import unittest
+
+from utils.timer_wheel import TimerWheel, SLOTS_PER_LEVEL
+
+
+class TimerWheelTests(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.wheel = TimerWheel(1, 0)
+        self.fired = []
+
+    def _schedule(self, delay, name):
+        return self.wheel.schedule(delay, lambda: self.fired.append((name, self.wheel.current_tick)))
+
+    def test_timers_fire_on_their_tick(self):
+        self._schedule(3, 'a')
+        self._schedule(1.5, 'b')
+        self.wheel.advance(1)
+        self.assertEqual(self.fired, [])
+        self.wheel.advance(10)
+        self.assertEqual(sorted(self.fired), [('a', 3), ('b', 2)])
+        self.assertEqual(len(self.wheel), 0)
+
+    def test_timers_cascade_from_higher_levels(self):
+        delays = [SLOTS_PER_LEVEL - 1, SLOTS_PER_LEVEL, SLOTS_PER_LEVEL + 1, SLOTS_PER_LEVEL ** 2 + 5, 3 * SLOTS_PER_LEVEL ** 2]
+        self.wheel.advance(17)
+        for delay in delays:
+            self._schedule(delay, delay)
+        self.wheel.advance(17 + 4 * SLOTS_PER_LEVEL ** 2)
+        self.assertEqual(sorted(self.fired), [(delay, 17 + delay) for delay in delays])
+
+    def test_cancelled_timers_do_not_fire(self):
+        timer = self._schedule(SLOTS_PER_LEVEL * 2, 'a')
+        self.wheel.cancel(timer)
+        self.wheel.cancel(timer)
+        self.assertFalse(timer.active)
+        self.wheel.advance(SLOTS_PER_LEVEL * 3)
+        self.assertEqual(self.fired, [])
+        self.assertEqual(len(self.wheel), 0)
+
+    def test_callbacks_can_reschedule(self):
+        self.wheel.schedule(2, lambda: self._schedule(2, 'again'))
+        self.wheel.advance(3)
+        self.assertEqual(self.fired, [])
+        self.wheel.advance(4)
+        self.assertEqual(self.fired, [('again', 4)])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,4 +1,5 @@
-from utils.utils import merge_dicts
+from socket import socket, SOL_SOCKET, SO_REUSEPORT
+from utils.utils import merge_dicts, ports_in_use
 import unittest
 
 
@@ -14,3 +15,12 @@ class TestUtils(unittest.TestCase):
         self.assertEqual(merged['uk']['one'], 2)
         self.assertEqual(merged['uk']['two'], 4)
         self.assertEqual(merged['uk']['three'], 6)
+
+    def test_ports_in_use(self):
+        with socket() as listening:
+            listening.setsockopt(SOL_SOCKET, SO_REUSEPORT, 1)
+            listening.bind(('0.0.0.0', 0))
+            listening.listen()
+            port = listening.getsockname()[1]
+            self.assertEqual(ports_in_use([port]), [port])
+        self.assertEqual(ports_in_use([port]), [])
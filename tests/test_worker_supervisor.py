@@ -0,0 +1,64 @@
+import os
+import time
+import unittest
+
+from capacity_gossip import CapacityDirectory
+from data_classes.worker_report import WorkerReport
+from utils.metrics import REGISTRY
+from worker_supervisor import WorkerSupervisor
+
+
+def report_collectors(conf, report_queue, capacity_queue):
+    # Counts the metrics collectors the worker started with, the supervisor's must not be one of them.
+    report_queue.put(WorkerReport(os.getpid(), {'GB': conf['connections']}, {}, {}, [], {}, {}, {}, {},
+                                  {('worker_collectors', '', ()): len(REGISTRY.collectors)}))
+    time.sleep(60)
+
+
+def report_shared_capacity(conf, report_queue, capacity_queue):
+    countries = {node['node']: sum(node['countries']['us'].values()) for node in capacity_queue.get()}
+    report_queue.put(WorkerReport(os.getpid(), countries, {}, {}, [], {}, {}, {}, {}, {}))
+    time.sleep(60)
+
+
+class WorkerSupervisorTests(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.supervisor = WorkerSupervisor(report_collectors, {'connections': 3}, 2)
+
+    def tearDown(self) -> None:
+        self.supervisor.stop()
+        REGISTRY.collectors.remove(self.supervisor.get_metrics_samples)
+
+    def _wait_for_reports(self, dead=None):
+        deadline = time.monotonic() + 30
+        while time.monotonic() < deadline:
+            if dead not in self.supervisor.processes and all(process.pid in self.supervisor.reports for process in self.supervisor.processes):
+                return
+            time.sleep(0.1)
+
+    def test_reports_are_summed(self):
+        self.supervisor.start()
+        self._wait_for_reports()
+        self.assertEqual(self.supervisor.count_connections_by_country(), {'GB': 6})
+        self.assertIn(self.supervisor.get_metrics_samples, REGISTRY.collectors)
+        self.assertEqual(self.supervisor.get_metrics_samples(), {('worker_collectors', '', ()): 0})
+
+    def test_dead_workers_are_restarted(self):
+        self.supervisor.start()
+        self._wait_for_reports()
+        dead = self.supervisor.processes[0]
+        dead.kill()
+        dead.join()
+        self._wait_for_reports(dead)
+        self.assertNotIn(dead.pid, self.supervisor.reports)
+        self.assertEqual(self.supervisor.count_connections_by_country(), {'GB': 6})
+
+    def test_workers_get_the_other_nodes_of_the_directory(self):
+        directory = CapacityDirectory('me', 10)
+        for node, count in (('me', 1), ('other', 2)):
+            directory.merge({'node': node, 'address': node, 'ports': {'us': 1000}, 'countries': {'us': {'1': count}}, 'version': 1}, 0)
+        self.supervisor.worker_target = report_shared_capacity
+        self.supervisor.start(directory)
+        self._wait_for_reports()
+        self.assertEqual(self.supervisor.count_connections_by_country(), {'other': 4})
@@ -0,0 +1,80 @@
+import socket
+import struct
+from typing import Dict, Tuple
+
+NETSTAT_PATH = '/proc/net/netstat'
+TCP_INFO_FORMAT = "B" * 7 + "I" * 21
+# For listening sockets tcpi_unacked holds the current accept queue length and tcpi_sacked the backlog.
+TCP_INFO_UNACKED_INDEX = 7 + 4
+TCP_INFO_SACKED_INDEX = 7 + 5
+
+
+class AcceptStats:
+    """
+    Counters for a set of listening sockets that are accepted from until EAGAIN on every wakeup.
+    """
+    BATCH_BUCKETS = (1, 4, 16, 64, 256)
+
+    def __init__(self) -> None:
+        self.wakeups = 0
+        self.accepted = 0
+        self.max_batch = 0
+        self.batch_histogram: Dict[int, int] = {bucket: 0 for bucket in AcceptStats.BATCH_BUCKETS}
+        self.max_queue_length = 0
+        self.queue_full_events = 0
+
+    def record_queue(self, listening_socket: socket.socket) -> None:
+        """
+        Sample the accept queue of listening_socket before draining it.
+        A full queue means the kernel may have dropped SYNs since the previous wakeup.
+        """
+        try:
+            queue_length, backlog = accept_queue(listening_socket)
+        except OSError:
+            return
+        self.max_queue_length = max(self.max_queue_length, queue_length)
+        if backlog and queue_length >= backlog:
+            self.queue_full_events += 1
+
+    def record_batch(self, accepted: int) -> None:
+        self.wakeups += 1
+        self.accepted += accepted
+        self.max_batch = max(self.max_batch, accepted)
+        for bucket in AcceptStats.BATCH_BUCKETS:
+            if accepted <= bucket:
+                self.batch_histogram[bucket] += 1
+                return
+        self.batch_histogram[AcceptStats.BATCH_BUCKETS[-1]] += 1
+
+    def as_dict(self) -> Dict[str, int]:
+        stats = {'wakeups': self.wakeups, 'accepted': self.accepted, 'max_batch': self.max_batch,
+                 'max_queue_length': self.max_queue_length, 'queue_full_events': self.queue_full_events}
+        for bucket, count in self.batch_histogram.items():
+            stats[f'batches_up_to_{bucket}'] = count
+        return stats
+
+
+def accept_queue(listening_socket: socket.socket) -> Tuple[int, int]:
+    """
+    :return: (current accept queue length, configured backlog) of a listening socket.
+    """
+    info = struct.unpack(TCP_INFO_FORMAT, listening_socket.getsockopt(socket.IPPROTO_TCP, socket.TCP_INFO, 92))
+    return info[TCP_INFO_UNACKED_INDEX], info[TCP_INFO_SACKED_INDEX]
+
+
+def read_listen_overflows() -> Dict[str, int]:
+    """
+    System wide counters of connections dropped because an accept queue was full.
+    :return: {'ListenOverflows': #, 'ListenDrops': #}, empty if the kernel doesn't expose them.
+    """
+    try:
+        with open(NETSTAT_PATH) as netstat:
+            lines = netstat.readlines()
+    except OSError:
+        return {}
+    for header, values in zip(lines[::2], lines[1::2]):
+        if not header.startswith('TcpExt:'):
+            continue
+        counters = dict(zip(header.split()[1:], values.split()[1:]))
+        return {name: int(counters[name]) for name in ('ListenOverflows', 'ListenDrops') if name in counters}
+    return {}
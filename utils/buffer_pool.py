@@ -0,0 +1,42 @@
+from collections import defaultdict
+from typing import Dict, List
+
+
+class BufferPool:
+    """
+    Reusable receive buffers, grouped by power-of-two size classes.
+    Not thread safe. It is meant to be owned by a single selector thread.
+    """
+    MAX_FREE_BUFFERS_PER_SIZE = 64
+
+    def __init__(self, min_size: int, max_size: int) -> None:
+        self.min_size = min_size
+        self.max_size = max_size
+        self.free_buffers: Dict[int, List[bytearray]] = defaultdict(list)
+        self.hits = 0
+        self.misses = 0
+        self.discarded = 0
+
+    def size_class(self, size: int) -> int:
+        size = min(max(size, self.min_size), self.max_size)
+        return 1 << (size - 1).bit_length()
+
+    def acquire(self, size: int) -> bytearray:
+        size = self.size_class(size)
+        free_buffers = self.free_buffers[size]
+        if free_buffers:
+            self.hits += 1
+            return free_buffers.pop()
+        self.misses += 1
+        return bytearray(size)
+
+    def release(self, buffer: bytearray) -> None:
+        free_buffers = self.free_buffers[len(buffer)]
+        if len(free_buffers) < BufferPool.MAX_FREE_BUFFERS_PER_SIZE:
+            free_buffers.append(buffer)
+        else:
+            self.discarded += 1
+
+    def stats(self) -> Dict[str, int]:
+        return {'hits': self.hits, 'misses': self.misses, 'discarded': self.discarded,
+                'free_buffers': sum(len(b) for b in self.free_buffers.values())}
@@ -0,0 +1,262 @@
+import heapq
+import itertools
+import random
+import time
+from threading import Lock
+from typing import Callable, Dict, Iterator, List, Optional
+
+from data_classes.connection import Connection
+
+ROUND_ROBIN = 'round_robin'
+WEIGHTED_RANDOM = 'weighted_random'
+FIFO = 'fifo'
+LOWEST_RTT = 'lowest_rtt'
+# heaps are rebuilt once they hold this many removed entries more than connections.
+HEAP_COMPACTION_SLACK = 64
+
+
+class CountryConnections:
+    """
+    Connections of one country. Each ASN keeps its connections in a dict ordered by insertion, the oldest first,
+    so inserting and removing a connection are O(1). Only ASNs with connections are kept in asns, and their order is
+    the round robin order. connections orders every connection of the country by insertion for FIFO selection.
+    Scored indexes also keep the connections in a heap per country and per ASN, lowest score first. Removed connections
+    are only marked in entries and dropped from the heaps when they reach the top, or when the heaps are compacted.
+    Changes are made under lock.
+    """
+    __slots__ = ('asns', 'connections', 'lock', 'heap', 'asn_heaps', 'entries')
+
+    def __init__(self) -> None:
+        self.lock = Lock()
+        # asn -> connection -> time it became idle
+        self.asns: Dict[str, Dict[Connection, float]] = {}
+        self.connections: Dict[Connection, float] = {}
+        # [score, sequence, connection, removed]
+        self.heap: List[list] = []
+        self.asn_heaps: Dict[str, List[list]] = {}
+        self.entries: Dict[Connection, list] = {}
+
+    def __len__(self) -> int:
+        return len(self.connections)
+
+
+class ConnectionIndex:
+    """
+    Idle connections indexed by country and ASN, with counts that are kept up to date on every change.
+    Within an ASN, the connection idle for the longest is handed out first, so no peer sits in the pool until it goes stale.
+    Selection policies pick the ASN a country pop is served from:
+    round_robin - rotate between the ASNs of the country.
+    weighted_random - a random ASN, weighted by the number of connections it has.
+    fifo - the connection of the country that has been idle for the longest, whatever its ASN.
+    lowest_rtt - the connection of the country with the lowest score, whatever its ASN. Pops by ASN also hand out the
+    lowest score of the ASN. Connections are scored once, when added, so pops are O(log n).
+    Connections are also indexed by device id, a device has one idle connection at most. Adding a connection of a device
+    that already has one replaces the older connection, which add() returns so it can be closed.
+    Thread safe. Every country has its own lock, held only for the dict operations of a single change, so inserts, pops
+    and keep alive sweeps of different countries never wait for each other. Readers that walk connections get snapshots.
+    The device index has its own lock, taken inside a country lock only.
+    """
+
+    def __init__(self, selection_policy: str = ROUND_ROBIN, score: Optional[Callable[[Connection], float]] = None) -> None:
+        """
+        :param score: scores connections for lowest_rtt, lower is better.
+        """
+        self.countries: Dict[str, CountryConnections] = {}
+        self.countries_lock = Lock()
+        self.devices: Dict[str, Connection] = {}
+        self.devices_lock = Lock()
+        self.select: Callable[[CountryConnections], Optional[Connection]] = {
+            ROUND_ROBIN: self._select_round_robin,
+            WEIGHTED_RANDOM: self._select_weighted_random,
+            FIFO: self._select_fifo,
+            LOWEST_RTT: self._select_lowest_score,
+        }[selection_policy]
+        self.score: Optional[Callable[[Connection], float]] = None
+        if selection_policy == LOWEST_RTT:
+            # unscored connections are handed out in insertion order.
+            self.score = score or (lambda connection: 0.0)
+        self.sequence = itertools.count()
+
+    def __len__(self) -> int:
+        return sum(len(country) for country in list(self.countries.values()))
+
+    def __contains__(self, connection: Connection) -> bool:
+        country = self.countries.get(connection.country_code)
+        return country is not None and connection in country.connections
+
+    def __iter__(self) -> Iterator[Connection]:
+        for country in list(self.countries.values()):
+            with country.lock:
+                connections = list(country.connections)
+            yield from connections
+
+    def add(self, connection: Connection, now: Optional[float] = None) -> Optional[Connection]:
+        """
+        :return: the idle connection of the same device that was replaced, if any.
+        """
+        replaced = self.devices.get(connection.device_id)
+        if replaced is not None and replaced != connection:
+            self.remove(replaced)
+        else:
+            replaced = None
+        country = self._country(connection.country_code)
+        idle_since = time.monotonic() if now is None else now
+        score = self.score(connection) if self.score is not None else None
+        with country.lock:
+            if connection in country.connections:
+                return replaced
+            country.asns.setdefault(connection.asn, {})[connection] = idle_since
+            country.connections[connection] = idle_since
+            if score is not None:
+                entry = country.entries[connection] = [score, next(self.sequence), connection, False]
+                heapq.heappush(country.heap, entry)
+                heapq.heappush(country.asn_heaps.setdefault(connection.asn, []), entry)
+            with self.devices_lock:
+                self.devices[connection.device_id] = connection
+        return replaced
+
+    def remove(self, connection: Connection) -> bool:
+        """
+        :return: whether the connection was in the index.
+        """
+        country = self.countries.get(connection.country_code)
+        if country is None:
+            return False
+        with country.lock:
+            return self._remove(country, connection)
+
+    def take(self, connection: Connection) -> Optional[float]:
+        """
+        Remove the connection to put it back later with add(connection, idle_since).
+        :return: the time the connection became idle, or None if it isn't in the index.
+        """
+        country = self.countries.get(connection.country_code)
+        if country is None:
+            return None
+        with country.lock:
+            idle_since = country.connections.get(connection)
+            if idle_since is not None:
+                self._remove(country, connection)
+            return idle_since
+
+    def get_by_device_id(self, device_id: str) -> Optional[Connection]:
+        return self.devices.get(device_id)
+
+    def pop_by_device_id(self, device_id: str) -> Optional[Connection]:
+        connection = self.devices.get(device_id)
+        if connection is None or not self.remove(connection):
+            return None
+        return connection
+
+    def device_ids(self) -> List[str]:
+        return list(self.devices)
+
+    def pop(self, country_code: str, asn: Optional[str] = None) -> Optional[Connection]:
+        """
+        :param asn: None to let the selection policy pick the ASN.
+        :return: the connection removed from the index, or None if there is none to match.
+        """
+        country = self.countries.get(country_code)
+        if country is None:
+            return None
+        with country.lock:
+            if asn is None:
+                connection = self.select(country)
+            elif self.score is not None:
+                connection = _lowest(country.asn_heaps.get(asn))
+            else:
+                asn_connections = country.asns.get(asn)
+                connection = next(iter(asn_connections)) if asn_connections else None
+            if connection is not None:
+                self._remove(country, connection)
+            return connection
+
+    def count_by_country(self) -> Dict[str, int]:
+        return {country_code: len(country) for country_code, country in list(self.countries.items())}
+
+    def count_by_asn(self, country_code: str) -> Dict[str, int]:
+        country = self.countries.get(country_code)
+        if country is None:
+            return {}
+        with country.lock:
+            return {asn: len(connections) for asn, connections in country.asns.items()}
+
+    def asn_connections(self, country_code: str, asn: str) -> List[Connection]:
+        country = self.countries.get(country_code)
+        if country is None:
+            return []
+        with country.lock:
+            return list(country.asns.get(asn, ()))
+
+    def idle_seconds(self, connection: Connection, now: Optional[float] = None) -> float:
+        idle_since = self.countries[connection.country_code].connections[connection]
+        return (time.monotonic() if now is None else now) - idle_since
+
+    def _country(self, country_code: str) -> CountryConnections:
+        country = self.countries.get(country_code)
+        if country is None:
+            with self.countries_lock:
+                country = self.countries.get(country_code)
+                if country is None:
+                    country = self.countries[country_code] = CountryConnections()
+        return country
+
+    def _remove(self, country: CountryConnections, connection: Connection) -> bool:
+        if country.connections.pop(connection, None) is None:
+            return False
+        asn_connections = country.asns[connection.asn]
+        del asn_connections[connection]
+        if not asn_connections:
+            del country.asns[connection.asn]
+        entry = country.entries.pop(connection, None)
+        if entry is not None:
+            entry[-1] = True
+            if not asn_connections:
+                del country.asn_heaps[connection.asn]
+            _compact(country.heap, len(country.connections))
+            if asn_connections:
+                _compact(country.asn_heaps[connection.asn], len(asn_connections))
+        with self.devices_lock:
+            if self.devices.get(connection.device_id) == connection:
+                del self.devices[connection.device_id]
+        return True
+
+    @staticmethod
+    def _select_round_robin(country: CountryConnections) -> Optional[Connection]:
+        if not country.asns:
+            return None
+        asn = next(iter(country.asns))
+        # move the ASN to the back of the rotation.
+        asn_connections = country.asns.pop(asn)
+        country.asns[asn] = asn_connections
+        return next(iter(asn_connections))
+
+    @staticmethod
+    def _select_weighted_random(country: CountryConnections) -> Optional[Connection]:
+        if not country.connections:
+            return None
+        position = random.randrange(len(country.connections))
+        for asn_connections in country.asns.values():
+            if position < len(asn_connections):
+                return next(iter(asn_connections))
+            position -= len(asn_connections)
+
+    @staticmethod
+    def _select_fifo(country: CountryConnections) -> Optional[Connection]:
+        return next(iter(country.connections), None)
+
+    @staticmethod
+    def _select_lowest_score(country: CountryConnections) -> Optional[Connection]:
+        return _lowest(country.heap)
+
+
+def _lowest(heap: Optional[List[list]]) -> Optional[Connection]:
+    while heap and heap[0][-1]:
+        heapq.heappop(heap)
+    return heap[0][2] if heap else None
+
+
+def _compact(heap: List[list], connections: int):
+    if len(heap) > 2 * connections + HEAP_COMPACTION_SLACK:
+        heap[:] = [entry for entry in heap if not entry[-1]]
+        heapq.heapify(heap)
@@ -0,0 +1,188 @@
+import ipaddress
+import os
+import threading
+from collections import OrderedDict
+from threading import Lock
+from typing import Callable, Optional, Tuple
+
+import geoip2.database
+from infrastructure.wrappers.infra_logger import Logger
+
+from utils.metrics import REGISTRY
+
+GEOIP_CACHE_LOOKUPS = REGISTRY.counter('geoip_cache_lookups_total', 'GeoIP lookups of device addresses, by whether the prefix cache answered',
+                                       ['result'])
+GEOIP_CACHED_PREFIXES = REGISTRY.gauge('geoip_cached_prefixes', 'Address prefixes in the GeoIP cache')
+GEOIP_RELOADS = REGISTRY.counter('geoip_reloads_total', 'GeoIP databases opened after they changed on disk, by result', ['result'])
+
+IPV4_PREFIX_LENGTH = 24
+IPV6_PREFIX_LENGTH = 48
+DEFAULT_CACHE_SIZE = 65536
+DEFAULT_RELOAD_INTERVAL_SECONDS = 60
+
+
+class GeoIpDatabases:
+    """
+    ASN and City readers opened together, the files they were opened from, and the cache of their answers.
+    users counts the lookups reading them, replaced is set once newer databases were swapped in. Guarded by GeoIpLookup.lock.
+    """
+    __slots__ = ('asn', 'city', 'files', 'cache', 'users', 'replaced')
+
+    def __init__(self, asn_path: str, city_path: str, open_reader: Callable) -> None:
+        # identified before opening, a file replaced in between is only opened again on the next check.
+        self.files = (_file_identity(asn_path), _file_identity(city_path))
+        self.asn = open_reader(asn_path)
+        try:
+            self.city = open_reader(city_path)
+        except Exception:
+            self.asn.close()
+            raise
+        # prefix -> (country, asn)
+        self.cache: 'OrderedDict[str, Tuple[str, str]]' = OrderedDict()
+        self.users = 0
+        self.replaced = False
+
+    def close(self) -> None:
+        self.asn.close()
+        self.city.close()
+
+
+class GeoIpLookup:
+    """
+    Country and ASN of device addresses. The ASN and City databases are opened once, memory mapped, and shared by every lookup.
+    Answers are cached by /24 prefix, /48 for IPv6, the most recently used up to cache_size prefixes. An answer is only cached
+    when both databases give it for the whole prefix or wider, so cached answers are the ones the databases would give.
+    Every reload_interval_seconds a thread checks whether geoipupdate replaced the files. New readers, with an empty cache, are
+    swapped in with a single assignment, lookups in flight finish with the readers they started with, which are closed once
+    no lookup holds them. The databases are opened by the first lookup, or by the first check if it comes first. Thread safe.
+    """
+
+    def __init__(self, asn_path: str, city_path: str, cache_size: int = DEFAULT_CACHE_SIZE,
+                 reload_interval_seconds: float = DEFAULT_RELOAD_INTERVAL_SECONDS, open_reader: Callable = geoip2.database.Reader) -> None:
+        """
+        :param open_reader: opens a database file, geoip2.database.Reader in MODE_AUTO memory maps it.
+        """
+        self.asn_path = asn_path
+        self.city_path = city_path
+        self.cache_size = cache_size
+        self.reload_interval_seconds = reload_interval_seconds
+        self.open_reader = open_reader
+        self.logger = Logger('GeoIpLookup')
+        self.databases: Optional[GeoIpDatabases] = None
+        self.lock = Lock()
+        self.reload_lock = Lock()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._run, name='GeoIpReload', daemon=True)
+        GEOIP_CACHED_PREFIXES.set_function(lambda: len(self.databases.cache) if self.databases is not None else 0)
+
+    def start(self) -> None:
+        self.thread.start()
+
+    def stop(self) -> None:
+        self.stopped.set()
+
+    def lookup(self, ip: str) -> Tuple[str, str]:
+        """
+        :return: country code and ASN of ip.
+        :raise geoip2.errors.AddressNotFoundError: if ip isn't in the databases.
+        """
+        if self.databases is None:
+            self._load()
+        prefix, prefix_length = _prefix(ip)
+        with self.lock:
+            databases = self.databases
+            cached = databases.cache.get(prefix)
+            if cached is not None:
+                databases.cache.move_to_end(prefix)
+            else:
+                databases.users += 1
+        if cached is not None:
+            GEOIP_CACHE_LOOKUPS.labels('hit').inc()
+            return cached
+        GEOIP_CACHE_LOOKUPS.labels('miss').inc()
+        try:
+            asn_response = databases.asn.asn(ip)
+            city_response = databases.city.city(ip)
+        finally:
+            self._release(databases)
+        answer = city_response.country.iso_code, str(asn_response.autonomous_system_number)
+        if _covers(asn_response.network, prefix_length) and _covers(city_response.traits.network, prefix_length):
+            with self.lock:
+                databases.cache[prefix] = answer
+                if len(databases.cache) > self.cache_size:
+                    databases.cache.popitem(last=False)
+        return answer
+
+    def reload_if_changed(self) -> bool:
+        """
+        :return: whether new databases were swapped in.
+        """
+        with self.reload_lock:
+            files = (_file_identity(self.asn_path), _file_identity(self.city_path))
+            if None in files or (self.databases is not None and files == self.databases.files):
+                return False
+            try:
+                databases = GeoIpDatabases(self.asn_path, self.city_path, self.open_reader)
+            except Exception as e:
+                self.logger.error(f'Failed to open the GeoIP databases at {self.asn_path}, {self.city_path}', exc_info=e)
+                GEOIP_RELOADS.labels('failed').inc()
+                return False
+            with self.lock:
+                replaced = self.databases
+                self.databases = databases
+                if replaced is not None:
+                    replaced.replaced = True
+                    idle = not replaced.users
+        GEOIP_RELOADS.labels('ok').inc()
+        if replaced is not None:
+            self.logger.info(f'Reloaded the GeoIP databases, dropped {len(replaced.cache)} cached prefixes')
+            if idle:
+                self._close(replaced)
+        return True
+
+    def _release(self, databases: GeoIpDatabases) -> None:
+        """
+        The last lookup reading replaced databases closes them.
+        """
+        with self.lock:
+            databases.users -= 1
+            idle = databases.replaced and not databases.users
+        if idle:
+            self._close(databases)
+
+    def _close(self, databases: GeoIpDatabases) -> None:
+        try:
+            databases.close()
+        except Exception as e:
+            self.logger.error('Failed to close the replaced GeoIP databases', exc_info=e)
+
+    def _load(self) -> GeoIpDatabases:
+        with self.reload_lock:
+            if self.databases is None:
+                self.databases = GeoIpDatabases(self.asn_path, self.city_path, self.open_reader)
+            return self.databases
+
+    def _run(self):
+        while not self.stopped.wait(self.reload_interval_seconds):
+            try:
+                self.reload_if_changed()
+            except Exception as e:
+                self.logger.error('GeoIP reload check failed', exc_info=e)
+
+
+def _prefix(ip: str) -> Tuple[str, int]:
+    if ':' not in ip:
+        return ip.rpartition('.')[0], IPV4_PREFIX_LENGTH
+    return str(ipaddress.ip_network(f'{ip}/{IPV6_PREFIX_LENGTH}', strict=False)), IPV6_PREFIX_LENGTH
+
+
+def _covers(network, prefix_length: int) -> bool:
+    return network is not None and network.prefixlen <= prefix_length
+
+
+def _file_identity(path: str) -> Optional[Tuple[int, int, int]]:
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return stat.st_ino, stat.st_mtime_ns, stat.st_size
@@ -0,0 +1,157 @@
+import logging
+import os
+import queue
+import threading
+import time
+from typing import Dict, Optional
+
+from infrastructure.wrappers.infra_logger import Logger
+
+from config import config
+from utils.metrics import REGISTRY
+
+DEFAULT_QUEUE_SIZE = 10000
+LEVEL_METHODS = {logging.DEBUG: 'debug', logging.INFO: 'info', logging.WARNING: 'warning', logging.ERROR: 'error'}
+
+DROPPED = REGISTRY.counter('log_records_dropped_total', 'Hot path log records that were not written', ['reason'])
+DROPPED_SAMPLED = DROPPED.labels('sampled')
+DROPPED_RATE_LIMITED = DROPPED.labels('rate_limited')
+DROPPED_QUEUE_FULL = DROPPED.labels('queue_full')
+
+
+class LogSite:
+    """
+    Sampling and rate limit of one call site, from config['log_sampling']['<logger name>.<site>']:
+    sample_every - write one of every N records.
+    max_per_second - write at most N records per second, with bursts of up to N.
+    Records that were left out are counted and mentioned in the next record written for the site.
+    """
+
+    def __init__(self, sample_every: int = 1, max_per_second: float = 0) -> None:
+        self.sample_every = sample_every
+        self.max_per_second = max_per_second
+        self.seen = 0
+        self.tokens = max_per_second
+        self.updated = time.monotonic()
+        self.suppressed = 0
+
+    def allow(self) -> bool:
+        self.seen += 1
+        if self.seen % self.sample_every:
+            self.suppressed += 1
+            DROPPED_SAMPLED.inc()
+            return False
+        if self.max_per_second:
+            now = time.monotonic()
+            self.tokens = min(self.max_per_second, self.tokens + (now - self.updated) * self.max_per_second)
+            self.updated = now
+            if self.tokens < 1:
+                self.suppressed += 1
+                DROPPED_RATE_LIMITED.inc()
+                return False
+            self.tokens -= 1
+        return True
+
+    def take_suppressed(self) -> int:
+        suppressed, self.suppressed = self.suppressed, 0
+        return suppressed
+
+
+class LogWriter:
+    """
+    Formats records and hands them to the infra loggers on a background thread, so callers never wait for I/O.
+    The queue is bounded. When it is full, records are dropped instead of blocking the caller.
+    """
+
+    def __init__(self, queue_size: int) -> None:
+        self.queue_size = queue_size
+        self._start()
+        os.register_at_fork(after_in_child=self._start)
+
+    def submit(self, logger, level: int, msg: str, args: tuple, exc_info, suppressed: int):
+        try:
+            self.records.put_nowait((logger, level, msg, args, exc_info, suppressed))
+        except queue.Full:
+            DROPPED_QUEUE_FULL.inc()
+
+    def flush(self):
+        self.records.join()
+
+    def _start(self):
+        # A forked child inherits the queue but not the thread draining it.
+        self.records = queue.Queue(self.queue_size)
+        threading.Thread(target=self._write_records, name='LogWriter', daemon=True).start()
+
+    def _write_records(self):
+        records = self.records
+        while True:
+            logger, level, msg, args, exc_info, suppressed = records.get()
+            try:
+                text = msg % args if args else msg
+            except Exception:
+                text = f'{msg} {args!r}'
+            if suppressed:
+                text += f' ({suppressed} similar records suppressed)'
+            try:
+                log = getattr(logger, LEVEL_METHODS.get(level, 'info'))
+                log(text, exc_info=exc_info) if exc_info else log(text)
+            except Exception:
+                pass
+            records.task_done()
+
+
+_writer: Optional[LogWriter] = None
+_writer_lock = threading.Lock()
+
+
+def get_writer() -> LogWriter:
+    global _writer
+    if _writer is None:
+        with _writer_lock:
+            if _writer is None:
+                _writer = LogWriter(config.get('log_queue_size', DEFAULT_QUEUE_SIZE))
+    return _writer
+
+
+class HotPathLogger:
+    """
+    Logger for code that runs per packet or per pool operation.
+    Messages use %-style placeholders and are only formatted, on the writer thread, once the level and the call site's
+    sampling let them through. Zero-argument callables in args, e.g. conn.getsockname, are called on the caller's
+    thread only for records that are written, so expensive arguments cost nothing while their level is off.
+    """
+
+    def __init__(self, name: str, level: Optional[int] = None) -> None:
+        self.name = name
+        self.level = level if level is not None else config.get('log_level', logging.INFO)
+        self.logger = Logger(name, level=self.level)
+        sampling = config.get('log_sampling', {})
+        prefix = name + '.'
+        self.sites: Dict[str, LogSite] = {key[len(prefix):]: LogSite(**conf) for key, conf in sampling.items() if key.startswith(prefix)}
+
+    def debug(self, site: str, msg: str, *args):
+        if self.level <= logging.DEBUG:
+            self._log(logging.DEBUG, site, msg, args)
+
+    def info(self, site: str, msg: str, *args):
+        if self.level <= logging.INFO:
+            self._log(logging.INFO, site, msg, args)
+
+    def warning(self, site: str, msg: str, *args):
+        if self.level <= logging.WARNING:
+            self._log(logging.WARNING, site, msg, args)
+
+    def error(self, site: str, msg: str, *args, exc_info=None):
+        if self.level <= logging.ERROR:
+            self._log(logging.ERROR, site, msg, args, exc_info)
+
+    def _log(self, level: int, site: str, msg: str, args: tuple, exc_info=None):
+        log_site = self.sites.get(site)
+        suppressed = 0
+        if log_site is not None:
+            if not log_site.allow():
+                return
+            suppressed = log_site.take_suppressed()
+        if args:
+            args = tuple(arg() if callable(arg) else arg for arg in args)
+        get_writer().submit(self.logger, level, msg, args, exc_info, suppressed)
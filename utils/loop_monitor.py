@@ -0,0 +1,87 @@
+from typing import Dict, List, Tuple
+
+from infrastructure.wrappers.infra_logger import Logger
+
+from utils.metrics import HistogramChild, REGISTRY
+
+LOOP_ITERATION_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5)
+
+ITERATION_SECONDS = REGISTRY.histogram('loop_iteration_seconds', 'Time an event loop spent running callbacks and timers per wakeup',
+                                       ['loop'], LOOP_ITERATION_BUCKETS)
+CALLBACK_SECONDS = REGISTRY.histogram('loop_callback_seconds', 'Run time of event loop callbacks', ['loop', 'callback'],
+                                      LOOP_ITERATION_BUCKETS)
+LAG_SECONDS = REGISTRY.gauge('loop_lag_seconds', 'Smoothed busy time of event loop iterations', ['loop'])
+SHEDDING = REGISTRY.gauge('loop_shedding', '1 while the event loop sheds load', ['loop'])
+SHED_EVENTS = REGISTRY.counter('loop_shed_events_total', 'Times the event loop started shedding load', ['loop'])
+
+
+class LoopMonitor:
+    """
+    Measures a single threaded event loop. Every callback and every iteration are timed into histograms,
+    callbacks slower than slow_callback_seconds are summed up by name and the slowest are logged every report_interval_seconds.
+    Lag is the exponentially smoothed busy time of iterations. The loop starts shedding load as soon as an iteration
+    is busier than shed_seconds, and stops once lag is back under recover_seconds, so it doesn't flap after a single stall.
+    shed_seconds of 0 disables shedding.
+    """
+    SLOWEST_CALLBACKS_TO_LOG = 5
+    LAG_SMOOTHING = 0.3
+
+    def __init__(self, name: str, shed_seconds: float, recover_seconds: float, slow_callback_seconds: float,
+                 report_interval_seconds: float, now: float) -> None:
+        self.name = name
+        self.logger = Logger(f'LoopMonitor-{name}')
+        self.shed_seconds = shed_seconds
+        self.recover_seconds = recover_seconds
+        self.slow_callback_seconds = slow_callback_seconds
+        self.report_interval_seconds = report_interval_seconds
+        self.next_report = now + report_interval_seconds
+        self.shedding = False
+        self.lag = 0.0
+        self.iteration_seconds = ITERATION_SECONDS.labels(name)
+        self.lag_seconds = LAG_SECONDS.labels(name)
+        self.callback_seconds: Dict[str, HistogramChild] = {}
+        # name -> [slow calls, total seconds, max seconds]
+        self.slow_callbacks: Dict[str, List[float]] = {}
+
+    def callback_finished(self, name: str, seconds: float):
+        histogram = self.callback_seconds.get(name)
+        if histogram is None:
+            histogram = self.callback_seconds[name] = CALLBACK_SECONDS.labels(self.name, name)
+        histogram.observe(seconds)
+        if seconds >= self.slow_callback_seconds:
+            stats = self.slow_callbacks.setdefault(name, [0, 0.0, 0.0])
+            stats[0] += 1
+            stats[1] += seconds
+            stats[2] = max(stats[2], seconds)
+
+    def iteration_finished(self, seconds: float, now: float) -> bool:
+        """
+        :param seconds: time the iteration spent running callbacks and timers, excluding the wait for events.
+        :param now: monotonic time, used to schedule the slow callbacks report.
+        :return: whether the loop should shed load.
+        """
+        self.iteration_seconds.observe(seconds)
+        self.lag += LoopMonitor.LAG_SMOOTHING * (seconds - self.lag)
+        self.lag_seconds.set(self.lag)
+        if self.shed_seconds:
+            if not self.shedding and seconds >= self.shed_seconds:
+                self.shedding = True
+                SHED_EVENTS.labels(self.name).inc()
+                self.logger.warning(f'{self.name} loop iteration took {seconds:.3f}s, shedding load')
+            elif self.shedding and self.lag <= self.recover_seconds:
+                self.shedding = False
+                self.logger.info(f'{self.name} loop caught up, lag is {self.lag:.3f}s')
+            SHEDDING.labels(self.name).set(int(self.shedding))
+        if now >= self.next_report:
+            self._report_slow_callbacks()
+            self.next_report = now + self.report_interval_seconds
+        return self.shedding
+
+    def _report_slow_callbacks(self):
+        if not self.slow_callbacks:
+            return
+        slowest: List[Tuple[str, List[float]]] = sorted(self.slow_callbacks.items(), key=lambda item: item[1][2], reverse=True)
+        for name, (count, total, longest) in slowest[:LoopMonitor.SLOWEST_CALLBACKS_TO_LOG]:
+            self.logger.warning(f'slow callback {name}: {int(count)} calls over {self.slow_callback_seconds}s, '
+                                f'{total:.3f}s in total, longest {longest:.3f}s')
+        self.slow_callbacks.clear()
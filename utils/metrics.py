@@ -0,0 +1,238 @@
+import time
+from bisect import bisect_left
+from threading import Lock
+from typing import Callable, Dict, Iterator, List, Optional, Sequence, Tuple
+
+# (metric name, sample suffix, ((label, value), ...)) -> value
+Samples = Dict[Tuple[str, str, Tuple[Tuple[str, str], ...]], float]
+
+DEFAULT_LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+class CounterChild:
+    __slots__ = ('value',)
+
+    def __init__(self) -> None:
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+
+class GaugeChild(CounterChild):
+    __slots__ = ()
+
+    def dec(self, amount=1):
+        self.value -= amount
+
+    def set(self, value):
+        self.value = value
+
+
+class HistogramChild:
+    __slots__ = ('buckets', 'counts', 'sum')
+
+    def __init__(self, buckets: Sequence[float]) -> None:
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+    def time(self) -> 'Timer':
+        return Timer(self)
+
+
+class Timer:
+    def __init__(self, histogram: HistogramChild) -> None:
+        self.histogram = histogram
+        self.start = 0.0
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *_):
+        self.histogram.observe(time.perf_counter() - self.start)
+
+
+class Metric:
+    """
+    A metric family. Children are created once per label values and are meant to be kept by the caller,
+    so updating a counter on a hot path costs a single attribute add. Updates are not locked: the GIL keeps them
+    consistent enough for monitoring, and an occasionally lost increment between threads is acceptable.
+    """
+    TYPE = ''
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> None:
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.children: Dict[Tuple[str, ...], object] = {}
+        self.mutex = Lock()
+        if not self.labelnames:
+            self._default = self.labels()
+
+    def labels(self, *values):
+        values = tuple(str(value) for value in values)
+        child = self.children.get(values)
+        if child is None:
+            if len(values) != len(self.labelnames):
+                raise ValueError(f'{self.name} expects labels {self.labelnames}, got {values}')
+            with self.mutex:
+                child = self.children.setdefault(values, self._new_child())
+        return child
+
+    def samples(self) -> Iterator[Tuple[str, Tuple[Tuple[str, str], ...], float]]:
+        for values, child in list(self.children.items()):
+            yield '', tuple(zip(self.labelnames, values)), child.value
+
+    def _new_child(self):
+        raise NotImplementedError
+
+
+class Counter(Metric):
+    TYPE = 'counter'
+
+    def _new_child(self):
+        return CounterChild()
+
+    def inc(self, amount=1):
+        self._default.inc(amount)
+
+
+class Gauge(Metric):
+    TYPE = 'gauge'
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> None:
+        super().__init__(name, documentation, labelnames)
+        self.function: Optional[Callable[[], float]] = None
+
+    def _new_child(self):
+        return GaugeChild()
+
+    def inc(self, amount=1):
+        self._default.inc(amount)
+
+    def dec(self, amount=1):
+        self._default.dec(amount)
+
+    def set(self, value):
+        self._default.set(value)
+
+    def set_function(self, function: Callable[[], float]):
+        """
+        Read the value from function when samples are collected instead of updating the gauge.
+        """
+        self.function = function
+
+    def samples(self):
+        if self.function is not None:
+            yield '', (), self.function()
+            return
+        yield from super().samples()
+
+
+class Histogram(Metric):
+    TYPE = 'histogram'
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (), buckets: Sequence[float] = DEFAULT_LATENCY_BUCKETS) -> None:
+        self.buckets = tuple(sorted(buckets))
+        super().__init__(name, documentation, labelnames)
+
+    def _new_child(self):
+        return HistogramChild(self.buckets)
+
+    def observe(self, value: float):
+        self._default.observe(value)
+
+    def time(self) -> Timer:
+        return self._default.time()
+
+    def samples(self):
+        for values, child in list(self.children.items()):
+            labels = tuple(zip(self.labelnames, values))
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), child.counts):
+                cumulative += count
+                yield '_bucket', labels + (('le', _format_value(bound)),), cumulative
+            yield '_sum', labels, child.sum
+            yield '_count', labels, cumulative
+
+
+class MetricsRegistry:
+    """
+    Metrics are declared once at module level and updated incrementally by the components that own them.
+    Collectors add samples gathered elsewhere, e.g. from worker processes, which are summed with the local ones.
+    """
+
+    def __init__(self) -> None:
+        self.metrics: Dict[str, Metric] = {}
+        self.collectors: List[Callable[[], Samples]] = []
+        self.mutex = Lock()
+
+    def counter(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> Counter:
+        return self._register(Counter(name, documentation, labelnames))
+
+    def gauge(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> Gauge:
+        return self._register(Gauge(name, documentation, labelnames))
+
+    def histogram(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                  buckets: Sequence[float] = DEFAULT_LATENCY_BUCKETS) -> Histogram:
+        return self._register(Histogram(name, documentation, labelnames, buckets))
+
+    def add_collector(self, collector: Callable[[], Samples]):
+        self.collectors.append(collector)
+
+    def samples(self) -> Samples:
+        samples: Samples = {}
+        for metric in list(self.metrics.values()):
+            for suffix, labels, value in metric.samples():
+                samples[(metric.name, suffix, labels)] = value
+        for collector in self.collectors:
+            for key, value in collector().items():
+                samples[key] = samples.get(key, 0) + value
+        return samples
+
+    def render(self) -> str:
+        """
+        :return: every sample in the Prometheus text exposition format.
+        """
+        by_metric: Dict[str, List[str]] = {}
+        for (name, suffix, labels), value in sorted(self.samples().items()):
+            by_metric.setdefault(name, []).append(f'{name}{suffix}{_format_labels(labels)} {_format_value(value)}')
+        lines = []
+        for name, metric in self.metrics.items():
+            lines.append(f'# HELP {name} {metric.documentation}')
+            lines.append(f'# TYPE {name} {metric.TYPE}')
+            lines.extend(by_metric.get(name, []))
+        return '\n'.join(lines) + '\n'
+
+    def _register(self, metric):
+        with self.mutex:
+            existing = self.metrics.get(metric.name)
+            if existing is not None:
+                return existing
+            self.metrics[metric.name] = metric
+            return metric
+
+
+def _format_labels(labels: Tuple[Tuple[str, str], ...]) -> str:
+    if not labels:
+        return ''
+    escaped = (value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in labels)
+    return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(labels, escaped)) + '}'
+
+
+def _format_value(value: float) -> str:
+    if value == float('inf'):
+        return '+Inf'
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+REGISTRY = MetricsRegistry()
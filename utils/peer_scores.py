@@ -0,0 +1,178 @@
+from bisect import bisect_left
+from collections import OrderedDict
+from threading import Lock
+from typing import Dict, List, Optional
+
+from utils.metrics import REGISTRY
+
+PEER_RTT_SECONDS = REGISTRY.histogram('pool_peer_rtt_seconds', 'Round trips through devices, by where they were measured', ['source'])
+PEER_FAILURES = REGISTRY.counter('pool_peer_failures_total', 'Round trips through devices that got no answer, by where they were measured',
+                                 ['source'])
+
+PROBE = 'probe'
+TUNNEL = 'tunnel'
+
+# upper bounds of the buckets of the round trip distribution.
+RTT_BUCKETS_MS = (25, 50, 100, 200, 400, 800, 1600, 3200)
+RTT_BUCKET_LABELS = [str(bound) for bound in RTT_BUCKETS_MS] + ['+Inf']
+
+DEFAULT_MAX_DEVICES = 500000
+DEFAULT_SMOOTHING = 0.3
+DEFAULT_UNMEASURED_RTT_SECONDS = 0.3
+DEFAULT_FAILURE_PENALTY_SECONDS = 2
+
+
+class PeerStats:
+    """
+    Round trip history of one device. rtt and failure_rate are exponentially weighted moving averages,
+    so a device that got better or worse is scored by its recent round trips.
+    """
+    __slots__ = ('country_code', 'asn', 'rtt', 'failure_rate')
+
+    def __init__(self, country_code: str, asn: str) -> None:
+        self.country_code = country_code
+        self.asn = asn
+        self.rtt: Optional[float] = None
+        self.failure_rate = 0.0
+
+
+class PeerScores:
+    """
+    Round trip time and failure history of every device, kept by device id so it outlives the device's connections.
+    Keep alive probes and tunnel setups report round trips. The score of a device is its average round trip plus
+    failure_penalty_seconds times its recent failure rate, lower is better. Devices that were never measured score
+    unmeasured_rtt_seconds. The devices seen last are kept, up to max_devices. Thread safe.
+    """
+
+    def __init__(self, max_devices: int = DEFAULT_MAX_DEVICES, smoothing: float = DEFAULT_SMOOTHING,
+                 unmeasured_rtt_seconds: float = DEFAULT_UNMEASURED_RTT_SECONDS,
+                 failure_penalty_seconds: float = DEFAULT_FAILURE_PENALTY_SECONDS) -> None:
+        self.max_devices = max_devices
+        self.smoothing = smoothing
+        self.unmeasured_rtt_seconds = unmeasured_rtt_seconds
+        self.failure_penalty_seconds = failure_penalty_seconds
+        self.devices: 'OrderedDict[str, PeerStats]' = OrderedDict()
+        self.lock = Lock()
+
+    def __len__(self) -> int:
+        return len(self.devices)
+
+    def track(self, device_id: str, country_code: str, asn: str) -> None:
+        """
+        Called for every connection of a device, keeps where it connects from up to date.
+        """
+        with self.lock:
+            stats = self.devices.get(device_id)
+            if stats is None:
+                stats = self.devices[device_id] = PeerStats(country_code, asn)
+                if len(self.devices) > self.max_devices:
+                    self.devices.popitem(last=False)
+            else:
+                stats.country_code, stats.asn = country_code, asn
+                self.devices.move_to_end(device_id)
+
+    def record_rtt(self, device_id: str, seconds: float, source: str) -> None:
+        PEER_RTT_SECONDS.labels(source).observe(seconds)
+        with self.lock:
+            stats = self.devices.get(device_id)
+            if stats is None:
+                return
+            stats.rtt = seconds if stats.rtt is None else stats.rtt + self.smoothing * (seconds - stats.rtt)
+            stats.failure_rate -= self.smoothing * stats.failure_rate
+
+    def record_failure(self, device_id: str, source: str) -> None:
+        PEER_FAILURES.labels(source).inc()
+        with self.lock:
+            stats = self.devices.get(device_id)
+            if stats is None:
+                return
+            stats.failure_rate += self.smoothing * (1 - stats.failure_rate)
+
+    def score(self, device_id: str) -> float:
+        stats = self.devices.get(device_id)
+        if stats is None:
+            return self.unmeasured_rtt_seconds
+        rtt = self.unmeasured_rtt_seconds if stats.rtt is None else stats.rtt
+        return rtt + self.failure_penalty_seconds * stats.failure_rate
+
+    def distribution(self) -> Dict[str, Dict]:
+        """
+        :return: {country: {**summary, 'asns': {asn: summary}}}, see _summary.
+        """
+        with self.lock:
+            devices = list(self.devices.values())
+        countries: Dict[str, List[PeerStats]] = {}
+        asns: Dict[str, Dict[str, List[PeerStats]]] = {}
+        for stats in devices:
+            countries.setdefault(stats.country_code, []).append(stats)
+            asns.setdefault(stats.country_code, {}).setdefault(stats.asn, []).append(stats)
+        return {country_code: {**_summary(country_devices),
+                               'asns': {asn: _summary(asn_devices) for asn, asn_devices in asns[country_code].items()}}
+                for country_code, country_devices in countries.items()}
+
+
+def _summary(devices: List[PeerStats]) -> Dict:
+    """
+    :return: number of devices, their mean failure rate and how many devices have an average round trip of up to
+    every bucket of RTT_BUCKETS_MS, non cumulative. Devices that were never measured aren't in the buckets.
+    """
+    buckets = [0] * (len(RTT_BUCKETS_MS) + 1)
+    for stats in devices:
+        if stats.rtt is not None:
+            buckets[bisect_left(RTT_BUCKETS_MS, stats.rtt * 1000)] += 1
+    return {'devices': len(devices), 'failure_rate': sum(stats.failure_rate for stats in devices) / len(devices),
+            'rtt_ms': dict(zip(RTT_BUCKET_LABELS, buckets))}
+
+
+def merge_distributions(distributions: List[Dict[str, Dict]]) -> Dict[str, Dict]:
+    """
+    Sum up the distributions of PeerScores that track different devices, like the pools of different workers.
+    """
+    merged: Dict[str, Dict] = {}
+    for distribution in distributions:
+        for country_code, country in distribution.items():
+            merged_country = merged.setdefault(country_code, {'asns': {}})
+            _merge_summary(merged_country, country)
+            for asn, summary in country['asns'].items():
+                _merge_summary(merged_country['asns'].setdefault(asn, {}), summary)
+    return merged
+
+
+def _merge_summary(merged: Dict, summary: Dict):
+    devices = merged.get('devices', 0)
+    failures = merged.get('failure_rate', 0) * devices + summary['failure_rate'] * summary['devices']
+    merged['devices'] = devices + summary['devices']
+    merged['failure_rate'] = failures / merged['devices']
+    rtt_ms = merged.setdefault('rtt_ms', dict.fromkeys(RTT_BUCKET_LABELS, 0))
+    for label, count in summary['rtt_ms'].items():
+        rtt_ms[label] += count
+
+
+class TunnelSetupTimer:
+    """
+    Times the first round trip of a tunnel through its device: from the first bytes the client sent to the first bytes
+    the device answered. A tunnel whose device closes or times out before answering counts as a failure.
+    """
+    __slots__ = ('scores', 'device_id', 'started', 'done')
+
+    def __init__(self, scores: PeerScores, device_id: str) -> None:
+        self.scores = scores
+        self.device_id = device_id
+        self.started: Optional[float] = None
+        self.done = False
+
+    def client_sent(self, now: float) -> None:
+        if self.started is None:
+            self.started = now
+
+    def peer_answered(self, now: float) -> None:
+        if self.done or self.started is None:
+            return
+        self.done = True
+        self.scores.record_rtt(self.device_id, now - self.started, TUNNEL)
+
+    def peer_failed(self) -> None:
+        if self.done or self.started is None:
+            return
+        self.done = True
+        self.scores.record_failure(self.device_id, TUNNEL)
@@ -0,0 +1,56 @@
+import os
+from socket import socket
+from typing import Dict, Tuple
+
+
+class SpliceRelay:
+    """
+    Moves payload between two sockets inside the kernel using splice(2) through a pipe per direction.
+    Data never gets copied into python objects, so only the amount of bytes moved is known to the caller.
+    Bytes the target socket couldn't take yet stay in the pipe and are counted in pending until flush() moves them.
+    """
+    SPLICE_CHUNK_SIZE = 64 * 1024
+    SPLICE_FLAGS = os.SPLICE_F_MOVE | os.SPLICE_F_NONBLOCK if hasattr(os, 'splice') else 0
+
+    def __init__(self, yogurt_socket: socket, peer_socket: socket):
+        # Pipes and pending counters are keyed by the socket the data is headed to.
+        self.pipes: Dict[socket, Tuple[int, int]] = {yogurt_socket: os.pipe(), peer_socket: os.pipe()}
+        self.pending: Dict[socket, int] = {yogurt_socket: 0, peer_socket: 0}
+
+    @staticmethod
+    def is_supported() -> bool:
+        return hasattr(os, 'splice')
+
+    def relay(self, source: socket, target: socket) -> int:
+        """
+        Splice whatever is readable on source towards target.
+        :param source: readable socket.
+        :param target: socket to write to.
+        :return: number of bytes read from source. 0 means source reached EOF.
+        :raises BlockingIOError: nothing was readable on source.
+        """
+        _, pipe_write = self.pipes[target]
+        moved = os.splice(source.fileno(), pipe_write, SpliceRelay.SPLICE_CHUNK_SIZE, flags=SpliceRelay.SPLICE_FLAGS)
+        self.pending[target] += moved
+        if moved:
+            self.flush(target)
+        return moved
+
+    def flush(self, target: socket) -> int:
+        """
+        Move as much of the pending data into target as it takes without blocking.
+        :return: number of bytes still pending for target.
+        """
+        pipe_read, _ = self.pipes[target]
+        while self.pending[target] > 0:
+            try:
+                self.pending[target] -= os.splice(pipe_read, target.fileno(), self.pending[target], flags=SpliceRelay.SPLICE_FLAGS)
+            except BlockingIOError:
+                break
+        return self.pending[target]
+
+    def close(self):
+        for pipe_read, pipe_write in self.pipes.values():
+            os.close(pipe_read)
+            os.close(pipe_write)
+        self.pipes.clear()
@@ -0,0 +1,106 @@
+from typing import Callable, List, Optional, Set
+
+SLOT_BITS = 6
+SLOTS_PER_LEVEL = 1 << SLOT_BITS
+SLOT_MASK = SLOTS_PER_LEVEL - 1
+DEFAULT_LEVELS = 4
+
+
+class Timer:
+    __slots__ = ('expiry_tick', 'callback', 'slot')
+
+    def __init__(self, expiry_tick: int, callback: Callable[[], None]) -> None:
+        self.expiry_tick = expiry_tick
+        self.callback = callback
+        self.slot: Optional[Set['Timer']] = None
+
+    @property
+    def active(self) -> bool:
+        return self.slot is not None
+
+
+class TimerWheel:
+    """
+    Hierarchical timer wheel. Every level has SLOTS_PER_LEVEL slots, and a slot of level l spans SLOTS_PER_LEVEL ** l ticks.
+    Scheduling and cancelling are O(1). When the lower level wraps around, the timers of the next slot of the level above are
+    spread over the lower levels.
+    Not thread safe. It is meant to be advanced by the selector thread that owns the timers.
+    """
+
+    def __init__(self, tick_seconds: float, now: float, levels: int = DEFAULT_LEVELS) -> None:
+        self.tick_seconds = tick_seconds
+        self.start = now
+        self.current_tick = 0
+        self.levels: List[List[Set[Timer]]] = [[set() for _ in range(SLOTS_PER_LEVEL)] for _ in range(levels)]
+        self.max_ticks = (1 << (SLOT_BITS * levels)) - 1
+        self.timers = 0
+
+    def __len__(self) -> int:
+        return self.timers
+
+    def time(self) -> float:
+        """
+        Seconds elapsed up to the current tick. Cheaper than a clock read for callers on the advancing thread.
+        """
+        return self.current_tick * self.tick_seconds
+
+    def ticks(self, seconds: float) -> int:
+        return max(1, -int(-seconds // self.tick_seconds))
+
+    def schedule(self, delay_seconds: float, callback: Callable[[], None]) -> Timer:
+        """
+        :param delay_seconds: rounded up to whole ticks, and to at least one tick.
+        :param callback: called by advance() once the delay elapsed.
+        :return: Timer that can be passed to cancel().
+        """
+        timer = Timer(self.current_tick + min(self.ticks(delay_seconds), self.max_ticks), callback)
+        self._insert(timer)
+        self.timers += 1
+        return timer
+
+    def cancel(self, timer: Optional[Timer]) -> None:
+        if timer is None or timer.slot is None:
+            return
+        timer.slot.discard(timer)
+        timer.slot = None
+        self.timers -= 1
+
+    def advance(self, now: float) -> int:
+        """
+        Run every timer that expired up to now.
+        :return: number of timers that fired.
+        """
+        target_tick = int((now - self.start) // self.tick_seconds)
+        fired = 0
+        while self.current_tick < target_tick:
+            self.current_tick += 1
+            self._cascade()
+            slot = self.levels[0][self.current_tick & SLOT_MASK]
+            expired = list(slot)
+            slot.clear()
+            for timer in expired:
+                timer.slot = None
+                self.timers -= 1
+            for timer in expired:
+                timer.callback()
+            fired += len(expired)
+        return fired
+
+    def _cascade(self):
+        for level in range(len(self.levels) - 1, 0, -1):
+            if self.current_tick & ((1 << (SLOT_BITS * level)) - 1):
+                continue
+            slot = self.levels[level][(self.current_tick >> (SLOT_BITS * level)) & SLOT_MASK]
+            timers = list(slot)
+            slot.clear()
+            for timer in timers:
+                self._insert(timer)
+
+    def _insert(self, timer: Timer):
+        remaining = max(timer.expiry_tick - self.current_tick, 0)
+        level = 0
+        while level < len(self.levels) - 1 and remaining >= 1 << (SLOT_BITS * (level + 1)):
+            level += 1
+        slot = self.levels[level][(timer.expiry_tick >> (SLOT_BITS * level)) & SLOT_MASK]
+        slot.add(timer)
+        timer.slot = slot
@@ -0,0 +1,30 @@
+class TokenBucket:
+    """
+    Allows rate bytes per second on average and bursts of up to burst bytes.
+    Time is passed in by the caller, so the bucket can run on the selector's clock without a syscall per read.
+    """
+
+    def __init__(self, rate: float, burst: float, now: float) -> None:
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = now
+
+    def available(self, now: float) -> int:
+        self._refill(now)
+        return int(self.tokens)
+
+    def consume(self, amount: int) -> None:
+        self.tokens -= amount
+
+    def delay(self, now: float, amount: int = 1) -> float:
+        """
+        :return: seconds until amount bytes may be consumed.
+        """
+        self._refill(now)
+        return max(amount - self.tokens, 0) / self.rate
+
+    def _refill(self, now: float):
+        if now > self.updated:
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
@@ -1,7 +1,11 @@
 from collections import defaultdict
+from socket import socket, SOL_SOCKET, SO_REUSEADDR
 from typing import List
+import errno
 import re
 
+from config import config
+
 
 def merge_dicts(names: List[str], *dicts):
     if len(names) is not len(dicts):
@@ -25,3 +29,29 @@ def regex_check(reg: str, items: List[str]):
     for item in items:
         ans_list.append(bool(re.search(pattern, item)))
     return all(ans_list)
+
+
+def reuse_port() -> bool:
+    """
+    Listening ports are shared with other processes by workers, and by the next process during a graceful restart.
+    The kernel only lets a process bind next to sockets that set SO_REUSEPORT themselves, so the process that is taken
+    over needs it as well as the one started with --takeover.
+    """
+    return config.get('worker_processes', 1) > 1 or config.get('graceful_restart_enabled', False)
+
+
+def ports_in_use(ports: List[int]) -> List[int]:
+    """
+    :return: the ports another socket listens on, with SO_REUSEPORT or not.
+    """
+    busy = []
+    for port in ports:
+        with socket() as probe:
+            probe.setsockopt(SOL_SOCKET, SO_REUSEADDR, 1)
+            try:
+                probe.bind(('0.0.0.0', port))
+            except OSError as e:
+                if e.errno != errno.EADDRINUSE:
+                    raise
+                busy.append(port)
+    return busy
@@ -0,0 +1,164 @@
+import multiprocessing
+import queue
+import time
+from collections import Counter
+from concurrent.futures.thread import ThreadPoolExecutor
+from threading import Lock
+from typing import Callable, Dict, List, Optional, Tuple
+
+from infrastructure.wrappers.infra_logger import Logger
+
+from capacity_gossip import CapacityDirectory
+from data_classes.worker_report import WorkerReport
+from utils.metrics import REGISTRY, Samples
+from utils.peer_scores import merge_distributions
+
+
+class WorkerSupervisor:
+    """
+    Starts worker processes that each run their own PeerServer, SuperProxy and ConnectionPool shard.
+    Workers are forked by a forkserver process, never by the supervisor, whose threads may hold locks at that moment.
+    They import their modules afresh, so they don't inherit the supervisor's metrics collector either.
+    Workers bind the same ports with SO_REUSEPORT so the kernel spreads accepts between them.
+    Every worker sends a WorkerReport every REPORT_INTERVAL_SECONDS. The supervisor sums them up and exposes
+    the same read API as ConnectionPool and SuperProxy, so it can be handed to FrontendServer in their place.
+    Given the cluster's capacity directory, the supervisor sends the other nodes in it to every worker as often, see follow_directory.
+    Workers that die are restarted.
+    """
+    REPORT_INTERVAL_SECONDS = 5
+    MONITOR_INTERVAL_SECONDS = 1
+
+    def __init__(self, worker_target: Callable, conf: dict, workers: int) -> None:
+        self.logger = Logger('WorkerSupervisor')
+        self.worker_target = worker_target
+        self.conf = conf
+        self.workers = workers
+        self.context = multiprocessing.get_context('forkserver')
+        self.report_queue = self.context.Queue()
+        self.processes: List[multiprocessing.Process] = []
+        # pid -> queue of the worker's capacity snapshots, holding one at most.
+        self.capacity_queues: Dict[int, multiprocessing.Queue] = {}
+        self.capacity_directory: Optional[CapacityDirectory] = None
+        self.reports: Dict[int, WorkerReport] = {}
+        self.mutex = Lock()
+        self.should_stop = False
+        self.thread_pool = ThreadPoolExecutor(max_workers=3)
+
+    def start(self, capacity_directory: Optional[CapacityDirectory] = None) -> None:
+        self.capacity_directory = capacity_directory
+        for _ in range(self.workers):
+            self.processes.append(self._start_worker())
+        REGISTRY.add_collector(self.get_metrics_samples)
+        self.thread_pool.submit(self._collect_reports)
+        self.thread_pool.submit(self._monitor_workers)
+        if capacity_directory is not None:
+            self.thread_pool.submit(self._share_capacity)
+
+    def stop(self) -> None:
+        self.should_stop = True
+        for process in self.processes:
+            process.terminate()
+        self.thread_pool.shutdown(False)
+
+    def count_connections_by_country(self) -> Dict[str, int]:
+        with self.mutex:
+            return dict(sum((Counter(r.connections_by_country) for r in self.reports.values()), Counter()))
+
+    def count_connections_by_country_and_asn(self) -> Dict[str, Dict[str, int]]:
+        counts: Dict[str, Counter] = {}
+        with self.mutex:
+            for report in self.reports.values():
+                for country_code, asns in report.connections_by_country_and_asn.items():
+                    counts.setdefault(country_code, Counter()).update(asns)
+        return {country_code: dict(asns) for country_code, asns in counts.items()}
+
+    def get_all_device_ids(self, distinct=False):
+        with self.mutex:
+            device_ids = [device_id for r in self.reports.values() for device_id in r.device_ids]
+        if distinct:
+            return list(set(device_ids))
+        return device_ids
+
+    def get_active_sockets(self) -> List[Tuple[str, str]]:
+        with self.mutex:
+            return [(f'worker-{r.pid}', country) for r in self.reports.values()
+                    for country, count in r.active_tunnels_by_country.items() for _ in range(count)]
+
+    def get_buffer_pool_stats(self) -> Dict[str, int]:
+        with self.mutex:
+            return dict(sum((Counter(r.buffer_pool_stats) for r in self.reports.values()), Counter()))
+
+    def get_accept_stats(self) -> Dict[str, Dict[str, int]]:
+        totals: Dict[str, Counter] = {}
+        with self.mutex:
+            for report in self.reports.values():
+                for listener, stats in report.accept_stats.items():
+                    totals.setdefault(listener, Counter()).update(stats)
+        # Maximums are summed like the other counters, so they read as an upper bound across workers.
+        return {listener: dict(stats) for listener, stats in totals.items()}
+
+    def get_device_bandwidth(self) -> Dict[str, Dict[str, Dict[str, float]]]:
+        device_bandwidth = {}
+        with self.mutex:
+            for report in self.reports.values():
+                device_bandwidth.update(report.device_bandwidth)
+        return device_bandwidth
+
+    def get_rtt_distribution(self) -> Dict[str, Dict]:
+        with self.mutex:
+            return merge_distributions([r.rtt_distribution for r in self.reports.values()])
+
+    def get_metrics_samples(self) -> Samples:
+        """
+        Latest metrics of every worker, summed. Counters of a restarted worker start again from 0.
+        """
+        samples: Samples = Counter()
+        with self.mutex:
+            for report in self.reports.values():
+                samples.update(report.metrics)
+        return dict(samples)
+
+    def _start_worker(self) -> multiprocessing.Process:
+        capacity_queue = self.context.Queue(1)
+        process = self.context.Process(target=self.worker_target, args=(self.conf, self.report_queue, capacity_queue), daemon=True)
+        process.start()
+        with self.mutex:
+            self.capacity_queues[process.pid] = capacity_queue
+        self.logger.info(f'Started worker {process.pid}')
+        return process
+
+    def _collect_reports(self) -> None:
+        while not self.should_stop:
+            try:
+                report: WorkerReport = self.report_queue.get(timeout=WorkerSupervisor.MONITOR_INTERVAL_SECONDS)
+                with self.mutex:
+                    self.reports[report.pid] = report
+            except queue.Empty:
+                continue
+            except Exception as e:
+                self.logger.error("failed to collect worker report", exc_info=e)
+
+    def _monitor_workers(self) -> None:
+        while not self.should_stop:
+            for index, process in enumerate(self.processes):
+                if process.is_alive():
+                    continue
+                self.logger.error(f'Worker {process.pid} exited with {process.exitcode}. Restarting it')
+                with self.mutex:
+                    self.reports.pop(process.pid, None)
+                    self.capacity_queues.pop(process.pid, None)
+                self.processes[index] = self._start_worker()
+            time.sleep(WorkerSupervisor.MONITOR_INTERVAL_SECONDS)
+
+    def _share_capacity(self) -> None:
+        while not self.should_stop:
+            others = [node.as_dict() for node in self.capacity_directory.others()]
+            with self.mutex:
+                capacity_queues = list(self.capacity_queues.values())
+            for capacity_queue in capacity_queues:
+                try:
+                    capacity_queue.put_nowait(others)
+                except queue.Full:
+                    # the worker didn't take the previous snapshot yet.
+                    pass
+            time.sleep(WorkerSupervisor.REPORT_INTERVAL_SECONDS)